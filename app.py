@@ -2,34 +2,38 @@ import os
 from dotenv import load_dotenv
 load_dotenv()
 
-import sys
+import json
+import base64
 import unicodedata
-import subprocess
 import requests
-from flask import Flask, request, render_template, jsonify, redirect, url_for, send_from_directory
+from flask import (
+    Flask, Response, request, render_template, jsonify, redirect, url_for,
+    send_from_directory, stream_with_context
+)
 
 from spreadsheet_manager import (
-    update_spreadsheet,
     get_striker_list_from_sheet,
     get_special_list_from_sheet,
-    search_battlelog_output_sheet,
-    get_other_icon,
-    load_other_icon_cache,
+    search_battlelog_results,
+    search_battlelog_batch,
+    counter_team_stats,
+    character_usage_stats,
     append_battlelog_row_from_api,
-    fetch_latest_output_row_as_dict,
     get_latest_loser_teams
 )
-from config import CURRENT_SEASON, SEASON_LIST
+from config import (
+    CURRENT_SEASON, SEASON_LIST, SEARCH_PAGE_SIZE, SEARCH_PAGE_SIZE_MAX, SEARCH_BATCH_MAX_QUERIES,
+    COUNTER_STATS_TOP_K, COUNTER_STATS_TOP_K_MAX
+)
+from upload_queue import enqueue_upload
 
-from defense_suggester import suggest_defense_teams, suggest_team_for_template
+from defense_suggester import open_suggest_session, template_detail_from_session, suggest_team_for_template
 
 app = Flask(__name__)
 
 if not os.environ.get("GOOGLE_APPLICATION_CREDENTIALS"):
     print("GOOGLE_APPLICATION_CREDENTIALS not found in environment variables.")
 
-load_other_icon_cache()
-
 def normalize_sp_chars(chars: list, side: str) -> list:
     if not chars or len(chars) != 6:
         return chars
@@ -97,35 +101,17 @@ def upload():
 @app.route("/upload/confirm", methods=["POST"])
 def upload_confirm():
     try:
-        from main import call_apps_script
         row_data = [
             request.form.get(f"field{i}", "")
             for i in range(18)
         ]
         row_data = [unicodedata.normalize("NFKC", v) for v in row_data]
         season = request.form.get("season", CURRENT_SEASON)
-        update_spreadsheet(row_data, season=season)
-
-        subprocess.run(
-            [sys.executable, "call_gas.py"],
-            check=True
-        )
-
-        latest_row = fetch_latest_output_row_as_dict(season=season)
-        if latest_row:
-            append_battlelog_row_from_api(latest_row, season=season, source="限定")
-        else:
-            print("出力結果3行目の取得に失敗しました。")
-
+        # シート書き込み・しらす式変換・キャッシュ反映はキュー側で数秒おきにまとめて行う
+        enqueue_upload(row_data, season=season)
         return redirect(url_for("upload_complete"))
-    except subprocess.CalledProcessError as e:
-        print(f"しらす式変換エラー: {e}")
-        return render_template(
-            "complete.html",
-            message=f"しらす式変換が失敗しました: {e}"
-        )
     except Exception as e:
-        print(f"スプレッドシート更新エラー: {e}")
+        print(f"アップロードキュー追加エラー: {e}")
         return render_template(
             "complete.html",
             message=f"スプレッドシートの更新に失敗しました: {e}"
@@ -173,109 +159,206 @@ def search():
         loser_teams=loser_teams
     )
 
+def encode_search_cursor(positions):
+    """シーズンごとの読み位置 → 不透明なカーソル文字列"""
+    raw = json.dumps(positions, separators=(",", ":")).encode("utf-8")
+    return base64.urlsafe_b64encode(raw).decode("ascii").rstrip("=")
+
+def decode_search_cursor(cursor, seasons):
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4))
+        positions = json.loads(raw)
+    except Exception:
+        return None
+    if not isinstance(positions, dict) or any(
+            k not in seasons or not isinstance(v, int) for k, v in positions.items()):
+        return None
+    return positions
+
+# ========== 検索系APIの共通パラメータ ==========
+
+class InvalidParams(Exception):
+    """リクエストの値が不正（メッセージをそのまま400で返す）"""
+
+def _parse_seasons(data):
+    """season="all" なら全シーズンをまたいで検索（各結果に season を付ける）"""
+    season = data.get("season", CURRENT_SEASON)
+    return [s["key"] for s in SEASON_LIST] if season == "all" else [season]
+
+def _parse_count(data, key, default, maximum):
+    """件数の指定（省略なら default、1〜maximum に丸める）"""
+    try:
+        value = int(data.get(key) or default)
+    except (TypeError, ValueError):
+        raise InvalidParams(f"Invalid {key}")
+    return max(1, min(value, maximum))
+
+def _parse_page_size(data):
+    return _parse_count(data, "page_size", SEARCH_PAGE_SIZE, SEARCH_PAGE_SIZE_MAX)
+
+def _parse_query(data):
+    """検索する編成 (side, キャラ名6枠)"""
+    side = data.get("side") if isinstance(data, dict) else None
+    characters = data.get("characters") if isinstance(data, dict) else None
+    if side not in ["attack", "defense"] or not isinstance(characters, list) or len(characters) != 6:
+        raise InvalidParams("Invalid parameters")
+    if not any(characters):
+        raise InvalidParams("検索条件を1つ以上選択してください。")
+    return side, characters
+
+def _parse_filters(data):
+    """
+    (only_limited, strict_pos)。
+    strict_pos=false ならキャラは枠を問わない（防衛提案の「位置不問」と同じ）
+    """
+    return data.get("only_limited", False), bool(data.get("strict_pos", True))
+
+def _parse_cursor(data, seasons):
+    if not data.get("cursor"):
+        return None
+    positions = decode_search_cursor(data["cursor"], seasons)
+    if positions is None:
+        raise InvalidParams("Invalid cursor")
+    return positions
+
 @app.route("/api/search", methods=["POST"])
 def api_search():
+    """
+    編成検索。新しい順に page_size 件ずつ返し、続きがあれば next_cursor を付ける
+    （次はそれを cursor に渡す）。stream=true なら続きも含めて1件1行のNDJSONで流し、
+    最後の行に {"next_cursor": null} を付ける
+    """
     try:
-        from datetime import datetime
+        data = request.json
+        if not data:
+            return jsonify({"error": "No data received"}), 400
+        side, characters = _parse_query(data)
+        only_limited, strict_pos = _parse_filters(data)
+        page_size = _parse_page_size(data)
+        seasons = _parse_seasons(data)
+        positions = _parse_cursor(data, seasons)
+
+        def fetch_page(positions, use_cache=True):
+            # 相手側が勝った行（＝検索した編成への勝ち筋）だけを返す。同じページはキャッシュから
+            return search_battlelog_results(
+                characters, side, seasons, positions=positions, page_size=page_size,
+                only_limited=only_limited, strict_pos=strict_pos, use_cache=use_cache)
+
+        if data.get("stream"):
+            def generate(positions):
+                total = 0
+                while True:
+                    # 流すページはキャッシュに入れない（一度きりの全件取得で他の検索のページを追い出さない）
+                    results, positions = fetch_page(positions, use_cache=False)
+                    total += len(results)
+                    for entry in results:
+                        yield json.dumps(entry, ensure_ascii=False) + "\n"
+                    if positions is None:
+                        break
+                yield json.dumps({"next_cursor": None}) + "\n"
+                print(f"API返却データ（ストリーム）: {total}件")
+            return Response(stream_with_context(generate(positions)), mimetype="application/x-ndjson")
+
+        results, next_positions = fetch_page(positions)
+        print(f"API返却データ: {len(results)}件")
+        return jsonify({
+            "results": results,
+            "next_cursor": encode_search_cursor(next_positions) if next_positions else None,
+        })
+    except InvalidParams as e:
+        return jsonify({"error": str(e)}), 400
+    except Exception as e:
+        print(f"/api/search エラー: {e}")
+        return jsonify({"error": str(e)}), 500
 
+@app.route("/api/search_batch", methods=["POST"])
+def api_search_batch():
+    """
+    複数の編成検索をまとめて行う。
+    queries: [{"side", "characters", "cursor"(任意)}, ...]（season・only_limited・page_size は共通）。
+    results は queries と同じ順で、各要素は /api/search と同じ {results, next_cursor}
+    （そのクエリだけ不正なら {error}）
+    """
+    try:
         data = request.json
         if not data:
             return jsonify({"error": "No data received"}), 400
-        side = data.get("side")
-        characters = data.get("characters")
-        only_limited = data.get("only_limited", False)
-        season = data.get("season", CURRENT_SEASON)
-        if side not in ["attack", "defense"] or not isinstance(characters, list) or len(characters) != 6:
+        queries = data.get("queries")
+        if not isinstance(queries, list) or not queries:
             return jsonify({"error": "Invalid parameters"}), 400
-        if not any(characters):
-            return jsonify({"error": "検索条件を1つ以上選択してください。"}), 400
-
-        matched_rows = search_battlelog_output_sheet(characters, side, season=season)
-
-        def parse_date(row):
+        if len(queries) > SEARCH_BATCH_MAX_QUERIES:
+            return jsonify({"error": f"queries は{SEARCH_BATCH_MAX_QUERIES}件までです"}), 400
+        only_limited, strict_pos = _parse_filters(data)
+        page_size = _parse_page_size(data)
+        seasons = _parse_seasons(data)
+
+        # 不正なクエリはその位置にエラーを返し、残りはまとめて検索する
+        out = [None] * len(queries)
+        batch, batch_index = [], []
+        for i, q in enumerate(queries):
             try:
-                return datetime.strptime(row.get("日付", ""), "%Y-%m-%d %H:%M:%S")
-            except Exception:
-                return datetime.min
-
-        matched_rows = sorted(matched_rows, key=parse_date, reverse=True)
-
-        response = []
-        win_icon = get_other_icon("勝ち")
-        lose_icon = get_other_icon("負け")
-        attack_icon = get_other_icon("攻撃側")
-        defense_icon = get_other_icon("防衛側")
-
-        for row in matched_rows:
-            if only_limited and row.get("source") != "限定":
+                side, characters = _parse_query(q)
+                positions = _parse_cursor(q, seasons)
+            except InvalidParams as e:
+                out[i] = {"error": str(e)}
                 continue
+            batch.append((side, characters, positions))
+            batch_index.append(i)
+
+        batch_results = search_battlelog_batch(
+            batch, seasons, page_size=page_size, only_limited=only_limited, strict_pos=strict_pos)
+        for i, (results, next_positions) in zip(batch_index, batch_results):
+            out[i] = {
+                "results": results,
+                "next_cursor": encode_search_cursor(next_positions) if next_positions else None,
+            }
+        print(f"API返却データ（バッチ）: {len(queries)}クエリ / {sum(len(o.get('results', [])) for o in out)}件")
+        return jsonify({"results": out})
+    except InvalidParams as e:
+        return jsonify({"error": str(e)}), 400
+    except Exception as e:
+        print(f"/api/search_batch エラー: {e}")
+        return jsonify({"error": str(e)}), 500
+
+@app.route("/api/counter_stats", methods=["POST"])
+def api_counter_stats():
+    """
+    検索と同じ条件で、当たった相手側の編成（4キャラ＋SP順不同）ごとの
+    対戦数・勝ち数・勝率・ベイズ勝率を、ベイズ勝率の高い順に top_k 件返す
+    """
+    try:
+        data = request.json
+        if not data:
+            return jsonify({"error": "No data received"}), 400
+        side, characters = _parse_query(data)
+        only_limited, strict_pos = _parse_filters(data)
+        top_k = _parse_count(data, "top_k", COUNTER_STATS_TOP_K, COUNTER_STATS_TOP_K_MAX)
+        seasons = _parse_seasons(data)
+        stats = counter_team_stats(characters, side, seasons, top_k=top_k, only_limited=only_limited,
+                                   strict_pos=strict_pos)
+        print(f"勝ち筋集計: {stats['games']}戦 / {len(stats['teams'])}編成")
+        return jsonify(stats)
+    except InvalidParams as e:
+        return jsonify({"error": str(e)}), 400
+    except Exception as e:
+        print(f"/api/counter_stats エラー: {e}")
+        return jsonify({"error": str(e)}), 500
 
-            if side == "attack":
-                if row.get("勝敗_2", "") != "Win":
-                    continue
-                response.append({
-                    "source": row.get("source", ""),
-                    "winner_type": "defense",
-                    "winner_icon": defense_icon,
-                    "winner_winlose_icon": win_icon,
-                    "winner_player": row.get("プレイヤー名_2", ""),
-                    "winner_characters": [
-                        row.get("D1", ""),
-                        row.get("D2", ""),
-                        row.get("D3", ""),
-                        row.get("D4", ""),
-                        row.get("DSP1", ""),
-                        row.get("DSP2", ""),
-                    ],
-                    "loser_type": "attack",
-                    "loser_icon": attack_icon,
-                    "loser_winlose_icon": lose_icon,
-                    "loser_player": row.get("プレイヤー名", ""),
-                    "loser_characters": [
-                        row.get("A1", ""),
-                        row.get("A2", ""),
-                        row.get("A3", ""),
-                        row.get("A4", ""),
-                        row.get("ASP1", ""),
-                        row.get("ASP2", ""),
-                    ],
-                    "date": row.get("日付", ""),
-                })
-            else:
-                if row.get("勝敗", "") != "Win":
-                    continue
-                response.append({
-                    "source": row.get("source", ""),
-                    "winner_type": "attack",
-                    "winner_icon": attack_icon,
-                    "winner_winlose_icon": win_icon,
-                    "winner_player": row.get("プレイヤー名", ""),
-                    "winner_characters": [
-                        row.get("A1", ""),
-                        row.get("A2", ""),
-                        row.get("A3", ""),
-                        row.get("A4", ""),
-                        row.get("ASP1", ""),
-                        row.get("ASP2", ""),
-                    ],
-                    "loser_type": "defense",
-                    "loser_icon": defense_icon,
-                    "loser_winlose_icon": lose_icon,
-                    "loser_player": row.get("プレイヤー名_2", ""),
-                    "loser_characters": [
-                        row.get("D1", ""),
-                        row.get("D2", ""),
-                        row.get("D3", ""),
-                        row.get("D4", ""),
-                        row.get("DSP1", ""),
-                        row.get("DSP2", ""),
-                    ],
-                    "date": row.get("日付", ""),
-                })
-        print("API返却データ:", response)
-        return jsonify({"results": response})
+@app.route("/api/char_usage", methods=["POST"])
+def api_char_usage():
+    """
+    キャラ×side×枠（A1〜ASP2 / D1〜DSP2）ごとの出場数・勝ち数・勝率（出場数の多い順）。
+    side を省略すると攻撃・防衛の両方
+    """
+    try:
+        data = request.get_json(silent=True) or {}
+        side = data.get("side")
+        season = data.get("season", CURRENT_SEASON)
+        if side not in [None, "attack", "defense"]:
+            return jsonify({"error": "Invalid parameters"}), 400
+        return jsonify({"season": season, "characters": character_usage_stats(_parse_seasons(data), side=side)})
     except Exception as e:
-        print(f"/api/search エラー: {e}")
+        print(f"/api/char_usage エラー: {e}")
         return jsonify({"error": str(e)}), 500
 
 # ▼▼▼ 防衛提案ページ（POSTで攻撃編成も保持→再描画）
@@ -288,6 +371,7 @@ def defense_suggest():
     """
     message = None
     result = None
+    suggest_session = None
     season = request.form.get("season", CURRENT_SEASON)
     striker_list = get_striker_list_from_sheet()
     special_list = get_special_list_from_sheet()
@@ -313,7 +397,7 @@ def defense_suggest():
                 ]
             if not attacks:
                 attacks = [["", "", "", "", "", ""]]
-            result = suggest_defense_teams(attacks, season=season, strict_pos=strict_pos)
+            result, suggest_session = open_suggest_session(attacks, season=season, strict_pos=strict_pos)
         except Exception as e:
             message = f"提案ロジック実行時にエラーが発生しました: {e}"
     else:
@@ -327,6 +411,7 @@ def defense_suggest():
         CURRENT_SEASON=season,
         message=message,
         result=result,
+        suggest_session=suggest_session,
         strict_pos=strict_pos,
         attack_teams=attack_teams
     )
@@ -342,7 +427,12 @@ def api_template_detail():
         strict_pos = bool(data.get("strict_pos"))
         if not attacks or not any(any(x) for x in attacks):
             attacks = [["", "", "", "", "", ""]]
-        res = suggest_team_for_template(template_tags, attacks=attacks, season=season, strict_pos=strict_pos)
+        # 提案ページからの要求なら提案時の集計を使い回す（使えなければ作り直し）
+        res = None
+        if data.get("session"):
+            res = template_detail_from_session(data["session"], template_tags, attacks=attacks, season=season, strict_pos=strict_pos)
+        if res is None:
+            res = suggest_team_for_template(template_tags, attacks=attacks, season=season, strict_pos=strict_pos)
         return jsonify(res)
     except Exception as e:
         print(f"/api/template_detail エラー: {e}")
@@ -0,0 +1,424 @@
+# battlelog_cache.py
+# シーズン別戦闘ログキャッシュの永続化
+# バイナリスナップショット（cache/{season}.bin）＋追記専用ジャーナル（cache/{season}.journal.jsonl）
+# スナップショットの形式は battlelog_snapshot を参照。JSONは書き出し（デバッグ用）と旧形式の読込のみ
+# 複数ワーカーからの書き込みはファイルロックで排他し、スタンプ（cache/{season}.stamp.json）で
+# 最新の通し番号と世代（全件保存ごとに+1）を共有する。読み手はスタンプを見て差分だけ読み直す
+import os
+import json
+import time
+import atexit
+import itertools
+import threading
+
+from config import CACHE_DIR
+from battlelog_store import ROW_FIELDS
+from battlelog_snapshot import write_snapshot, read_snapshot_seq, SnapshotReader
+from shared_state import file_lock, is_leader, load_shared_json, save_shared_json
+
+_JOURNAL_FSYNC_EVERY = 32        # この件数たまったらfsync
+_JOURNAL_FSYNC_INTERVAL = 2.0    # 未同期分はこの秒数以内にfsync
+_COMPACT_INTERVAL = 10 * 60      # コンパクション判定の間隔（秒）
+_COMPACT_MIN_RECORDS = 500       # ジャーナルがこの件数を超えたらスナップショットへ畳み込む
+
+_journal_lock = threading.Lock()   # ジャーナル書き込み・ローテーション用
+_snapshot_lock = threading.Lock()  # スナップショット書き換え用（コンパクションと全件保存の排他）
+_journals = {}                     # season -> {"fh", "unsynced", "last_sync"}
+_readers = {}                      # season -> {"ino", "offset"}（他ワーカーの追記を読む位置）
+
+# プロセス間ロックの名前。取る順番は スナップショット → ジャーナル
+def _snapshot_lock_name(season):
+    return f"{season}.snapshot"
+
+def _journal_lock_name(season):
+    return f"{season}.journal"
+
+# ===== パス =====
+
+def get_snapshot_filepath(season):
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    return os.path.join(CACHE_DIR, f"{season}.bin")
+
+def get_cache_filepath(season):
+    """旧形式（JSON）のスナップショット。残っていれば初回読込時にバイナリへ変換する"""
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    return os.path.join(CACHE_DIR, f"{season}.json")
+
+def get_journal_filepath(season):
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    return os.path.join(CACHE_DIR, f"{season}.journal.jsonl")
+
+def get_sync_state_filepath(season):
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    return os.path.join(CACHE_DIR, f"{season}.sync.json")
+
+def _get_compacting_filepath(season):
+    return get_journal_filepath(season) + ".compacting"
+
+def has_output_cache(season):
+    return os.path.exists(get_snapshot_filepath(season)) or os.path.exists(get_cache_filepath(season))
+
+# ===== スナップショット =====
+
+def _read_json_snapshot(path):
+    """旧形式：(journal_seq, rows)。行リストのみの形式も読める"""
+    with open(path, "r", encoding="utf-8") as f:
+        try:
+            data = json.load(f)
+        except Exception as e:
+            print(f"キャッシュ読込失敗: {e}")
+            return 0, []
+    if isinstance(data, list):
+        return 0, data
+    return data.get("journal_seq", 0), data.get("rows", [])
+
+def _row_fields(row_dict):
+    # 行dict → スナップショットの1行（ROW_FIELDS 順の値タプル, 想定外の列）
+    fields = tuple(str(row_dict.get(k, "") or "") for k in ROW_FIELDS)
+    extra = {k: v for k, v in row_dict.items() if k not in _ROW_FIELD_SET}
+    return fields, extra or None
+
+_ROW_FIELD_SET = set(ROW_FIELDS)
+
+def _write_snapshot(season, rows, journal_seq):
+    # rows は新しい順の (値タプル, 想定外の列)
+    return write_snapshot(get_snapshot_filepath(season), rows, journal_seq)
+
+def _open_snapshot(season):
+    """
+    SnapshotReader を返す（無ければ None）。呼び出し側でスナップショットのロックを保持していること。
+    旧形式のJSONしか無ければここでバイナリへ変換する
+    """
+    path = get_snapshot_filepath(season)
+    if not os.path.exists(path):
+        json_path = get_cache_filepath(season)
+        if not os.path.exists(json_path):
+            print(f"キャッシュファイルなし: {path}")
+            return None
+        journal_seq, rows = _read_json_snapshot(json_path)
+        _write_snapshot(season, (_row_fields(r) for r in rows), journal_seq)
+        os.replace(json_path, json_path + ".migrated")
+        print(f"旧形式のキャッシュをバイナリへ変換しました: {path}（{len(rows)}件）")
+    try:
+        return SnapshotReader(path)
+    except Exception as e:
+        print(f"キャッシュ読込失敗: {e}")
+        return None
+
+def _read_snapshot_seq(season):
+    path = get_snapshot_filepath(season)
+    if os.path.exists(path):
+        return read_snapshot_seq(path)
+    json_path = get_cache_filepath(season)
+    if os.path.exists(json_path):
+        return _read_json_snapshot(json_path)[0]
+    return 0
+
+def save_output_cache(season, data):
+    """全件を新しいスナップショットとして保存（世代が変わり、読み手は全件を読み直す）"""
+    with _snapshot_lock, file_lock(_snapshot_lock_name(season)):
+        with _journal_lock, file_lock(_journal_lock_name(season)):
+            journal_seq = _load_stamp(season)["seq"]
+        _write_snapshot(season, (_row_fields(r) for r in data), journal_seq)
+        # スナップショットを置き換えてから世代を進める（先に進めると読み手が古い方を読む）
+        with _journal_lock, file_lock(_journal_lock_name(season)):
+            stamp = _load_stamp(season)
+            stamp["generation"] += 1
+            stamp["compacted_seq"] = journal_seq
+            _save_stamp(season, stamp)
+    print(f"キャッシュ保存完了: {get_snapshot_filepath(season)}（{len(data)}件）")
+
+def load_season_snapshot(season):
+    """
+    (ジャーナル末尾の行dict（新しい順）, SnapshotReader or None, 読み込んだ時点のスタンプ)。
+    行はジャーナル末尾→スナップショットの順に並べると全件（新しい順）になる。
+    スタンプの seq は含めた最後の通し番号（以降は read_journal_since で追いつく）。
+    SnapshotReader は呼び出し側で close() すること
+    """
+    # 畳み込みと重なるとジャーナルの一部を読み落とすので、スナップショットのロック下で読む
+    with _snapshot_lock, file_lock(_snapshot_lock_name(season)):
+        generation = _load_stamp(season)["generation"]
+        snapshot = _open_snapshot(season)
+        journal_seq = snapshot.journal_seq if snapshot is not None else 0
+        records = _read_journal(_get_compacting_filepath(season)) + _read_journal(get_journal_filepath(season))
+    tail = [rec for rec in records if rec["seq"] > journal_seq]
+    seq = max([journal_seq] + [rec["seq"] for rec in tail])
+    tail.sort(key=lambda rec: rec["seq"], reverse=True)
+    return [rec["row"] for rec in tail], snapshot, {"generation": generation, "seq": seq}
+
+def load_output_cache(season):
+    """スナップショット＋ジャーナル末尾を再生して、新しい順の行dictリストを返す（互換用）"""
+    tail, snapshot, _ = load_season_snapshot(season)
+    if snapshot is None:
+        return tail
+    with snapshot:
+        return tail + list(snapshot.iter_dicts())
+
+def export_output_cache_json(season, path=None):
+    """デバッグ用：現在の全件を旧形式と同じ整形JSONで書き出す"""
+    path = path or os.path.join(CACHE_DIR, f"{season}.export.json")
+    rows = load_output_cache(season)
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump({"journal_seq": read_stamp(season)["seq"], "rows": rows}, f, ensure_ascii=False, indent=2)
+    print(f"キャッシュ書き出し完了: {path}（{len(rows)}件）")
+    return path
+
+# ===== スタンプ（最新の通し番号・世代） =====
+
+def read_stamp(season):
+    """{"generation", "seq"}。小さいファイル1つを読むだけなので毎リクエスト呼んでよい"""
+    stamp = load_shared_json(f"{season}.stamp")
+    if stamp is None:
+        return {"generation": 0, "seq": 0}
+    return stamp
+
+def _load_stamp(season):
+    # 呼び出し側でジャーナルのロックを保持していること
+    stamp = load_shared_json(f"{season}.stamp")
+    if stamp is not None:
+        return stamp
+    # スタンプ導入前のキャッシュ：ジャーナルとスナップショットから通し番号を求める
+    return {"generation": 0, "seq": _last_written_seq(season)}
+
+def _last_written_seq(season):
+    # ジャーナル（畳み込み中のものを含む）とスナップショットにある最大の通し番号
+    records = _read_journal(_get_compacting_filepath(season)) + _read_journal(get_journal_filepath(season))
+    seq = max((rec["seq"] for rec in records), default=0)
+    return max(seq, _read_snapshot_seq(season))
+
+def _save_stamp(season, stamp, durable=True):
+    save_shared_json(f"{season}.stamp", stamp, durable=durable)
+
+def _recover_stamp(season):
+    """
+    追記のたびのスタンプは fsync しないので、電源断の後はジャーナルより古い番号に戻っていることがある。
+    プロセスで最初にジャーナルを開くときに、書かれている番号まで進めておく
+    （呼び出し側でジャーナルのロックを保持していること）
+    """
+    stamp = _load_stamp(season)
+    seq = _last_written_seq(season)
+    if stamp["seq"] < seq:
+        print(f"スタンプの通し番号をジャーナルに合わせました[{season}]: {stamp['seq']} -> {seq}")
+        stamp["seq"] = seq
+        _save_stamp(season, stamp)
+
+def _mark_compacted(season, journal_seq):
+    # スナップショットに含めた通し番号を記録（ジャーナルの残り件数 = seq - compacted_seq）
+    with _journal_lock, file_lock(_journal_lock_name(season)):
+        stamp = _load_stamp(season)
+        stamp["compacted_seq"] = journal_seq
+        _save_stamp(season, stamp)
+
+# ===== 差分同期の位置（ソースシートごとの最高水位） =====
+
+def load_sync_state(season):
+    path = get_sync_state_filepath(season)
+    if not os.path.exists(path):
+        return {}
+    with open(path, "r", encoding="utf-8") as f:
+        try:
+            return json.load(f)
+        except Exception as e:
+            print(f"同期位置の読込失敗: {e}")
+            return {}
+
+def save_sync_state(season, state):
+    path = get_sync_state_filepath(season)
+    tmp = path + ".tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(state, f, ensure_ascii=False)
+    os.replace(tmp, path)
+
+# ===== ジャーナル =====
+
+def _read_journal(path):
+    if not os.path.exists(path):
+        return []
+    records = []
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                records.append(json.loads(line))
+            except Exception:
+                # 書き込み途中で落ちた末尾行は捨てる
+                print(f"ジャーナルの壊れた行をスキップ: {path}")
+    return records
+
+def _get_journal_state(season):
+    # 呼び出し側で _journal_lock を保持していること
+    state = _journals.get(season)
+    if state is not None:
+        return state
+    _recover_stamp(season)
+    path = get_journal_filepath(season)
+    state = {
+        "fh": open(path, "a", encoding="utf-8"),
+        "unsynced": 0,
+        "last_sync": time.time(),
+    }
+    _journals[season] = state
+    return state
+
+def _reopen_if_rotated(season, state):
+    # 呼び出し側でジャーナルのロックを保持していること
+    # 他のワーカーが畳み込みでローテーションしていたら新しいファイルを開き直す
+    path = get_journal_filepath(season)
+    try:
+        current = os.stat(path).st_ino
+    except FileNotFoundError:
+        current = None
+    if current != os.fstat(state["fh"].fileno()).st_ino:
+        _sync_journal(state)
+        state["fh"].close()
+        state["fh"] = open(path, "a", encoding="utf-8")
+
+def _sync_journal(state):
+    if state["unsynced"]:
+        os.fsync(state["fh"].fileno())
+        state["unsynced"] = 0
+    state["last_sync"] = time.time()
+
+def append_journal(season, row_dict):
+    """1行を1レコードとしてジャーナルに追記（fsyncはまとめて行う）。振った通し番号を返す"""
+    with _journal_lock, file_lock(_journal_lock_name(season)):
+        state = _get_journal_state(season)
+        _reopen_if_rotated(season, state)
+        stamp = _load_stamp(season)
+        stamp["seq"] += 1
+        line = json.dumps({"seq": stamp["seq"], "row": row_dict}, ensure_ascii=False)
+        state["fh"].write(line + "\n")
+        state["fh"].flush()
+        # 行を書き切ってからスタンプを進める（読み手がスタンプを見た時点で行は読める）。
+        # 行と同じくここでは fsync しない（落ちた後は _recover_stamp でジャーナルから戻す）
+        _save_stamp(season, stamp, durable=False)
+        state["unsynced"] += 1
+        if state["unsynced"] >= _JOURNAL_FSYNC_EVERY:
+            _sync_journal(state)
+        return stamp["seq"]
+
+def _read_complete_lines(path, offset):
+    """offset 以降の書き切られた行だけを読む -> (records, 次のoffset, inode)"""
+    with open(path, "rb") as f:
+        ino = os.fstat(f.fileno()).st_ino
+        f.seek(offset)
+        data = f.read()
+    end = data.rfind(b"\n") + 1
+    records = []
+    for line in data[:end].splitlines():
+        if not line.strip():
+            continue
+        try:
+            records.append(json.loads(line.decode("utf-8")))
+        except Exception:
+            print(f"ジャーナルの壊れた行をスキップ: {path}")
+    return records, offset + end, ino
+
+def read_journal_since(season, seq):
+    """
+    通し番号 seq より後のレコード [(seq, row), ...]（古い順）を返す。
+    前回読んだ位置から続きだけ読む。畳み込みで既に消えて番号が飛んでいれば None（全件読み直しが必要）
+    """
+    path = get_journal_filepath(season)
+    cursor = _readers.get(season)
+    try:
+        ino = os.stat(path).st_ino
+    except FileNotFoundError:
+        ino = None
+    records = []
+    if cursor is not None and cursor["ino"] == ino:
+        records, offset, _ = _read_complete_lines(path, cursor["offset"])
+        cursor["offset"] = offset
+    else:
+        # 初回、またはローテーションされた後は両方のファイルを先頭から
+        compacting_path = _get_compacting_filepath(season)
+        if os.path.exists(compacting_path):
+            records += _read_complete_lines(compacting_path, 0)[0]
+        if ino is not None:
+            recs, offset, ino = _read_complete_lines(path, 0)
+            records += recs
+            _readers[season] = {"ino": ino, "offset": offset}
+    records = sorted((rec for rec in records if rec["seq"] > seq), key=lambda rec: rec["seq"])
+    for expected, rec in enumerate(records, start=seq + 1):
+        if rec["seq"] != expected:
+            return None
+    return [(rec["seq"], rec["row"]) for rec in records]
+
+def compact_journal(season):
+    """ジャーナルをスナップショットへ畳み込む。追記はローテーション後の新ファイルへ続行できる"""
+    journal_path = get_journal_filepath(season)
+    compacting_path = _get_compacting_filepath(season)
+    with _snapshot_lock, file_lock(_snapshot_lock_name(season)):
+        with _journal_lock, file_lock(_journal_lock_name(season)):
+            state = _get_journal_state(season)
+            _reopen_if_rotated(season, state)
+            # 前回中断した .compacting が残っていればそれを先に畳み込む
+            if not os.path.exists(compacting_path):
+                _sync_journal(state)
+                state["fh"].close()
+                os.replace(journal_path, compacting_path)
+                state["fh"] = open(journal_path, "a", encoding="utf-8")
+        snapshot = _open_snapshot(season)
+        try:
+            journal_seq = snapshot.journal_seq if snapshot is not None else 0
+            records = [rec for rec in _read_journal(compacting_path) if rec["seq"] > journal_seq]
+            if records:
+                records.sort(key=lambda rec: rec["seq"])
+                tail = (_row_fields(rec["row"]) for rec in reversed(records))
+                journal_seq = records[-1]["seq"]
+                # 既存の行は文字列表から読んだまま書き戻す（行dictに戻さない）
+                old = snapshot.iter_rows() if snapshot is not None else ()
+                _write_snapshot(season, itertools.chain(tail, old), journal_seq)
+        finally:
+            if snapshot is not None:
+                snapshot.close()
+        os.remove(compacting_path)
+        _mark_compacted(season, journal_seq)
+    print(f"ジャーナル畳み込み完了: {season}（{len(records)}件）")
+
+def _compact_targets():
+    # 他のワーカーが追記したシーズンも拾うため、ジャーナルファイルとスタンプから判定する
+    suffix = ".journal.jsonl"
+    targets = []
+    for name in os.listdir(CACHE_DIR):
+        if not name.endswith(suffix):
+            continue
+        season = name[:-len(suffix)]
+        stamp = read_stamp(season)
+        if stamp["seq"] - stamp.get("compacted_seq", 0) >= _COMPACT_MIN_RECORDS:
+            targets.append(season)
+    return targets
+
+def _journal_scheduler():
+    last_compact = time.time()
+    while True:
+        time.sleep(_JOURNAL_FSYNC_INTERVAL)
+        with _journal_lock:
+            for state in _journals.values():
+                _sync_journal(state)
+        # 畳み込みは代表ワーカーだけが行う
+        if time.time() - last_compact < _COMPACT_INTERVAL or not is_leader():
+            continue
+        last_compact = time.time()
+        try:
+            targets = _compact_targets()
+        except Exception as e:
+            print(f"畳み込み対象の判定失敗: {e}")
+            continue
+        for season in targets:
+            try:
+                compact_journal(season)
+            except Exception as e:
+                print(f"ジャーナル畳み込み失敗: {season}: {e}")
+
+def _close_journals():
+    with _journal_lock:
+        for state in _journals.values():
+            _sync_journal(state)
+            state["fh"].close()
+        _journals.clear()
+
+threading.Thread(target=_journal_scheduler, daemon=True).start()
+atexit.register(_close_journals)
@@ -0,0 +1,157 @@
+# battlelog_snapshot.py
+# シーズン別スナップショットのバイナリ形式（cache/{season}.bin）
+#
+#   ヘッダー   : マジック, journal_seq, 行数, 文字列数, 文字列本体の位置, 行データの位置
+#   文字列表   : 各文字列の開始位置（uint32 × (文字列数+1)）＋UTF-8本体を連結したもの
+#   行データ   : 1行 = 文字列番号（uint32）× (ROW_FIELDS の列数 + 1)。最後の1つは想定外の列(JSON)
+#
+# キャラ名・プレイヤー名は文字列表に1回だけ持ち、行は番号で参照する（番号0は空文字）。
+# 読み込みは mmap して文字列表を1回デコードするだけで、行は固定長なので任意の位置を直接読める
+import os
+import sys
+import json
+import mmap
+import struct
+import weakref
+
+from battlelog_store import ROW_FIELDS
+
+_MAGIC = b"BLSNAP01"
+_HEADER = struct.Struct("<8sQIIQQ")
+_ROW = struct.Struct(f"<{len(ROW_FIELDS) + 1}I")
+
+def write_snapshot(path, rows, journal_seq):
+    """
+    rows: 新しい順の (ROW_FIELDS 順の値タプル, 想定外の列dict or None) の反復。
+    一時ファイルに書いてから置き換える（途中で落ちても旧スナップショットが残る）
+    """
+    string_ids = {"": 0}
+    strings = [""]
+    packed = bytearray()
+    n_rows = 0
+    for fields, extra in rows:
+        values = list(fields)
+        values.append(json.dumps(extra, ensure_ascii=False) if extra else "")
+        ids = []
+        for v in values:
+            sid = string_ids.get(v)
+            if sid is None:
+                sid = string_ids[v] = len(strings)
+                strings.append(v)
+            ids.append(sid)
+        packed += _ROW.pack(*ids)
+        n_rows += 1
+
+    encoded = [s.encode("utf-8") for s in strings]
+    positions = [0]
+    for b in encoded:
+        positions.append(positions[-1] + len(b))
+    offsets = struct.pack(f"<{len(positions)}I", *positions)
+    blob_pos = _HEADER.size + len(offsets)
+    rows_pos = blob_pos + positions[-1]
+    rows_pos += -rows_pos % 4   # 行データは4バイト境界から
+
+    tmp = path + ".tmp"
+    with open(tmp, "wb") as f:
+        f.write(_HEADER.pack(_MAGIC, journal_seq, n_rows, len(strings), blob_pos, rows_pos))
+        f.write(offsets)
+        f.write(b"".join(encoded))
+        f.write(b"\0" * (rows_pos - f.tell()))
+        f.write(packed)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+    return n_rows
+
+def read_snapshot_seq(path):
+    """ヘッダーだけ読んで journal_seq を返す"""
+    with open(path, "rb") as f:
+        magic, journal_seq = _HEADER.unpack(f.read(_HEADER.size))[:2]
+    if magic != _MAGIC:
+        raise Exception(f"スナップショットの形式が不正です: {path}")
+    return journal_seq
+
+class SnapshotReader:
+    """
+    mmap したスナップショット。文字列表は開いたときに1回だけデコード（intern）し、
+    行は必要になった分だけ固定長レコードから読む。使い終わったら close() する
+    （途中で止まった iter_rows も close() が先に閉じる）
+    """
+    def __init__(self, path):
+        self.path = path
+        self._f = open(path, "rb")
+        self._mm = mmap.mmap(self._f.fileno(), 0, access=mmap.ACCESS_READ)
+        self._iterators = weakref.WeakSet()   # 読み終わっていない iter_rows
+        magic, self.journal_seq, self._n_rows, n_strings, blob_pos, self._rows_pos = \
+            _HEADER.unpack_from(self._mm, 0)
+        if magic != _MAGIC:
+            self.close()
+            raise Exception(f"スナップショットの形式が不正です: {path}")
+        offsets = struct.unpack_from(f"<{n_strings + 1}I", self._mm, _HEADER.size)
+        mm = self._mm
+        self._extras = {}
+        self.strings = [
+            sys.intern(mm[blob_pos + offsets[i]:blob_pos + offsets[i + 1]].decode("utf-8"))
+            for i in range(n_strings)
+        ]
+
+    def __len__(self):
+        return self._n_rows
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        if self._mm is not None:
+            # 例外で途中止まりの iter_rows が memoryview を握ったままだと mmap を閉じられない
+            # （BufferError で元の例外が隠れる）ので、先に閉じて view を解放させる
+            for rows in list(self._iterators):
+                rows.close()
+            self._mm.close()
+            self._f.close()
+            self._mm = None
+
+    def _decode(self, ids):
+        strings = self.strings
+        fields = tuple(strings[i] for i in ids[:-1])
+        extra = None
+        if ids[-1]:
+            # 想定外の列は大抵どの行も同じ内容なので、デコード結果を共有する（読み取り専用）
+            extra = self._extras.get(ids[-1])
+            if extra is None:
+                extra = self._extras[ids[-1]] = json.loads(strings[ids[-1]])
+        return fields, extra
+
+    def row(self, i):
+        """i 番目（新しい順）の (値タプル, 想定外の列dict or None)"""
+        if not 0 <= i < self._n_rows:
+            raise IndexError(i)
+        return self._decode(_ROW.unpack_from(self._mm, self._rows_pos + i * _ROW.size))
+
+    def iter_rows(self):
+        """新しい順に (値タプル, 想定外の列dict or None) を返す"""
+        rows = self._iter_rows()
+        self._iterators.add(rows)
+        return rows
+
+    def _iter_rows(self):
+        view = memoryview(self._mm)[self._rows_pos:self._rows_pos + self._n_rows * _ROW.size]
+        records = _ROW.iter_unpack(view)
+        try:
+            for ids in records:
+                yield self._decode(ids)
+        finally:
+            # mmap を閉じられるよう、参照を外してから解放する
+            del records
+            view.release()
+
+    def iter_dicts(self):
+        """行dict（JSON書き出し・互換用）"""
+        for fields, extra in self.iter_rows():
+            row_dict = dict(zip(ROW_FIELDS, fields))
+            if extra:
+                row_dict.update(extra)
+            yield row_dict
@@ -0,0 +1,465 @@
+# battlelog_store.py
+# プロセス常駐のシーズン別戦闘ログストア
+# JSONの行dict（日本語キーの繰り返し）ではなく、__slots__ の軽量行オブジェクトで保持する
+import re
+import sys
+import bisect
+import calendar
+import datetime
+import itertools
+import threading
+
+from character_registry import char_registry
+from template_registry import template_registry
+
+# 行dictのキー → BattleRow の属性（チーム系は4枠＋SP2枠をまとめてタプルで持つ）
+_SCALAR_KEYS = {
+    "日付": "date",
+    "プレイヤー名": "attacker",
+    "勝敗": "atk_result",
+    "プレイヤー名_2": "defender",
+    "勝敗_2": "def_result",
+    "source": "source",
+}
+_TEAM_KEYS = {
+    "a": ["A1", "A2", "A3", "A4"],
+    "asp": ["ASP1", "ASP2"],
+    "d": ["D1", "D2", "D3", "D4"],
+    "dsp": ["DSP1", "DSP2"],
+}
+_KNOWN_KEYS = set(_SCALAR_KEYS) | {k for keys in _TEAM_KEYS.values() for k in keys}
+
+# 1行を固定順の値タプルで扱うときの列順（バイナリスナップショットの行レイアウトと同じ）
+ROW_FIELDS = list(_SCALAR_KEYS) + [k for keys in _TEAM_KEYS.values() for k in keys]
+_TEAM_SLICES = {"a": slice(6, 10), "asp": slice(10, 12), "d": slice(12, 16), "dsp": slice(16, 18)}
+# side ごとの6枠（4キャラ＋SP2枠）の列名。キャラの使用数の slot（0〜5）はこの並び
+SIDE_SLOT_KEYS = {
+    "attack": _TEAM_KEYS["a"] + _TEAM_KEYS["asp"],
+    "defense": _TEAM_KEYS["d"] + _TEAM_KEYS["dsp"],
+}
+
+def _intern(v):
+    return sys.intern(str(v)) if v else ""
+
+# 並び順キー = (日時エポック秒 << _RID_BITS) | rid
+# 日時が同じなら後から取り込んだ行ほど新しい扱い
+_RID_BITS = 24
+_RID_MASK = (1 << _RID_BITS) - 1
+
+_DATE_RE = re.compile(r"([0-9]{4})-([0-9]{2})-([0-9]{2}) ([0-9]{2}):([0-9]{2}):([0-9]{2})")
+
+def parse_timestamp(date_str):
+    """「日付」列（%Y-%m-%d %H:%M:%S）→ エポック秒。読めなければ0（最も古い扱い）"""
+    try:
+        m = _DATE_RE.fullmatch(date_str)
+        if m:
+            # 全件読込で何万回も呼ぶので、いつもの桁揃えの形式は strptime を通さない
+            dt = datetime.datetime(*map(int, m.groups()))
+        else:
+            dt = datetime.datetime.strptime(date_str, "%Y-%m-%d %H:%M:%S")
+    except Exception:
+        return 0
+    return calendar.timegm(dt.timetuple())
+
+def _contains(sorted_keys, key):
+    i = bisect.bisect_left(sorted_keys, key)
+    return i < len(sorted_keys) and sorted_keys[i] == key
+
+def _insert(sorted_keys, key):
+    # 取り込みはほぼ最新行なので末尾追加が大半
+    if not sorted_keys or sorted_keys[-1] < key:
+        sorted_keys.append(key)
+    else:
+        bisect.insort(sorted_keys, key)
+
+def _push_recent(sorted_keys, key):
+    # 件数上限つきの昇順リストへ追加（溢れたら最も古いものを捨てる）
+    if len(sorted_keys) >= RECENT_LOSERS_SIZE and key < sorted_keys[0]:
+        return
+    _insert(sorted_keys, key)
+    if len(sorted_keys) > RECENT_LOSERS_SIZE:
+        del sorted_keys[0]
+
+_FINGERPRINT_TEAM_KEYS = [k for keys in _TEAM_KEYS.values() for k in keys]
+
+# 直近の「負けた編成」を保持する件数（トップページ・検索ページの表示用）
+RECENT_LOSERS_SIZE = 20
+
+# 1行あたりのメモリ量の目安（行オブジェクト＋チームのタプル＋各インデックスへの登録分。実測で約1KB）
+_ROW_BYTES_ESTIMATE = 1024
+
+# 行ごとの絞り込み用フラグ（検索時に行オブジェクトを引かずに判定する）
+FLAG_LIMITED = 1    # source が「限定」
+FLAG_ATK_WIN = 2    # 攻撃側の勝ち
+FLAG_DEF_WIN = 4    # 防衛側の勝ち
+
+def _row_flags(row):
+    flags = 0
+    if row.source == "限定":
+        flags |= FLAG_LIMITED
+    if row.atk_result == "Win":
+        flags |= FLAG_ATK_WIN
+    if row.def_result == "Win":
+        flags |= FLAG_DEF_WIN
+    return flags
+
+# ストアの version の払い出し元（プロセス内で一意。解放→再読込したストアが前と同じ値にならないように）
+_versions = itertools.count(1)
+
+def _fingerprint(date, ts, attacker, defender, team_ids):
+    # 日時はエポック秒（読めない日付だけ元の文字列）、キャラは正規化済みID。
+    # シートとAPIで日付の桁揃えやキャラ名の表記が違っても同じ対戦は同じ値になる
+    return hash((ts or date.strip(), attacker.strip(), defender.strip()) + team_ids)
+
+def row_fingerprint(row_dict):
+    """同じ対戦かどうかの判定用（日時・両プレイヤー・両編成。sourceは見ない）"""
+    def value(k):
+        return str(row_dict.get(k, "") or "")
+    date = value("日付")
+    get_id = char_registry.get_id
+    return _fingerprint(date, parse_timestamp(date), value("プレイヤー名"), value("プレイヤー名_2"),
+                        tuple(get_id(value(k)) for k in _FINGERPRINT_TEAM_KEYS))
+
+class BattleRow:
+    """
+    戦闘ログ1行。キャラ名・プレイヤー名などはinternして共有する。
+    a/asp/d/dsp は表示用の元の表記、*_ids は正規化済みのキャラID（空欄は0）、
+    a_tpl/d_tpl は4枠のテンプレID（template_registry。ストアが設定する）
+    """
+    __slots__ = (
+        "rid", "ts", "key", "date", "attacker", "atk_result", "a", "asp",
+        "defender", "def_result", "d", "dsp", "source", "extra",
+        "a_ids", "asp_ids", "d_ids", "dsp_ids", "a_tpl", "d_tpl",
+    )
+
+    @classmethod
+    def from_dict(cls, row_dict, rid=-1):
+        fields = tuple(_intern(row_dict.get(k, "")) for k in ROW_FIELDS)
+        # 想定外の列はそのまま残す（スナップショットへ書き戻すときに欠落させない）
+        extra = {k: v for k, v in row_dict.items() if k not in _KNOWN_KEYS}
+        return cls.from_fields(fields, extra or None, rid)
+
+    @classmethod
+    def from_fields(cls, fields, extra=None, rid=-1):
+        """ROW_FIELDS 順の値タプル（intern済みの文字列）から作る"""
+        row = cls()
+        row.rid = rid
+        row.date, row.attacker, row.atk_result, row.defender, row.def_result, row.source = fields[:6]
+        row.ts = parse_timestamp(row.date)
+        row.key = (row.ts << _RID_BITS) | rid
+        get_id = char_registry.get_id
+        for attr, sl in _TEAM_SLICES.items():
+            names = fields[sl]
+            setattr(row, attr, names)
+            setattr(row, attr + "_ids", tuple(get_id(n) for n in names))
+        row.extra = extra
+        return row
+
+    def fields(self):
+        """ROW_FIELDS 順の値タプル"""
+        return (self.date, self.attacker, self.atk_result, self.defender, self.def_result, self.source) \
+            + self.a + self.asp + self.d + self.dsp
+
+    def to_dict(self):
+        row_dict = {key: getattr(self, attr) for key, attr in _SCALAR_KEYS.items()}
+        for attr, keys in _TEAM_KEYS.items():
+            row_dict.update(zip(keys, getattr(self, attr)))
+        if self.extra:
+            row_dict.update(self.extra)
+        return row_dict
+
+    def fingerprint(self):
+        """row_fingerprint(self.to_dict()) と同じ値"""
+        return _fingerprint(self.date, self.ts, self.attacker, self.defender,
+                            self.a_ids + self.asp_ids + self.d_ids + self.dsp_ids)
+
+    def team(self, side):
+        """side="attack"/"defense" の6枠（4キャラ＋SP2枠）"""
+        if side == "attack":
+            return list(self.a + self.asp)
+        return list(self.d + self.dsp)
+
+    def team_ids(self, side):
+        """team() のキャラID版（タプル）"""
+        if side == "attack":
+            return self.a_ids + self.asp_ids
+        return self.d_ids + self.dsp_ids
+
+class SeasonStore:
+    """
+    1シーズン分の戦闘ログ。
+    行は取り込み順に rid（=リスト上の位置）を振って追記のみで保持する。
+    日付順は並び順キー（日時＋rid）の昇順リストで持ち、取り込み時は二分探索で挿入する。
+    キャラ→行 の転置インデックスも同じ並び順キーの昇順リストなので、
+    検索はリスト同士の積集合をとるだけで日付順の結果になる。
+    インデックスを引く間だけロックを取る（取り込み・全件読込と排他）。
+    version は内容が変わるたびに増える（プロセス内の全ストアで重ならない）。
+    load_version は全件を読み込み直したときの version（それまでの rid の行は変わらない）。
+    行のテンプレIDは取り込み時に求め、STRIKERマスタが変わったら refresh_templates で作り直す
+    （template_version はどのマスタの版で求めたか）。
+    キャラの使用数・勝ち数（side×枠ごと）も取り込み時に足していくので、読むときに全行を数え直さない。
+    applied はジャーナルをどこまで反映したか（spreadsheet_manager が sync_lock の下で更新する）。
+    """
+    def __init__(self, season):
+        self.season = season
+        self.version = next(_versions)
+        self.load_version = self.version
+        self.applied = {"generation": 0, "seq": 0}
+        self.sync_lock = threading.Lock()
+        self._lock = threading.Lock()
+        self._reset([])
+
+    def _reset(self, rows):
+        # 呼び出し側で _lock を保持していること
+        self._rows = rows
+        self._order = []          # 全行の並び順キー（古い→新しい）
+        self._postings = {}       # (side, slot, キャラID) -> [並び順キー, ...]
+        self._sp_postings = {}    # (side, SPキャラID) -> [並び順キー, ...]（SP1/SP2どちらでも）
+        self._sp_pair_postings = {}  # (side, (SP ID, SP ID) 昇順) -> [並び順キー, ...]
+        self._fingerprints = set()   # 差分同期で同じ対戦を二重に取り込まないため
+        self._flags = bytearray(len(rows))   # rid -> FLAG_* の組み合わせ
+        # 枠を問わない検索用。(side, キャラID) -> [並び順キー, ...]（4枠のどこかにいる行）と、
+        # rid -> 4枠のキャラ集合のビットマスク（キャラIDのビットを立てた整数）
+        self._any_postings = {}
+        self._striker_masks = {"attack": [0] * len(rows), "defense": [0] * len(rows)}
+        # 負け側がある行の直近 RECENT_LOSERS_SIZE 件（並び順キー, 古い→新しい）。True は限定のみ
+        self._recent_losers = {False: [], True: []}
+        # キャラの使用数・勝ち数（取り込みのたびに足していく）。
+        # (side, slot, キャラID) -> [件数, その side の勝ち数]（slot は SIDE_SLOT_KEYS の並び）と、
+        # 枠をまとめた件数 (side, "striker"（4枠）/"sp"（2枠）) -> {キャラID: 件数}
+        self._usage = {}
+        self._usage_totals = {(side, part): {} for side in ("attack", "defense") for part in ("striker", "sp")}
+        self.template_version = template_registry.version
+        for row in sorted(rows, key=lambda r: r.key):
+            self._index_row(row)
+
+    def _index_row(self, row):
+        key = row.key
+        _insert(self._order, key)
+        self._flags[row.rid] = _row_flags(row)
+        row.a_tpl = template_registry.template_id(row.a_ids)
+        row.d_tpl = template_registry.template_id(row.d_ids)
+        self._fingerprints.add(row.fingerprint())
+        if row.atk_result == "Lose" or row.def_result == "Lose":
+            _push_recent(self._recent_losers[False], key)
+            if row.source == "限定":
+                _push_recent(self._recent_losers[True], key)
+        for side, strikers, sps in (("attack", row.a_ids, row.asp_ids), ("defense", row.d_ids, row.dsp_ids)):
+            won = 1 if self._flags[row.rid] & (FLAG_ATK_WIN if side == "attack" else FLAG_DEF_WIN) else 0
+            for slot, cid in enumerate(strikers + sps):
+                if cid:
+                    usage = self._usage.get((side, slot, cid))
+                    if usage is None:
+                        usage = self._usage[(side, slot, cid)] = [0, 0]
+                    usage[0] += 1
+                    usage[1] += won
+                    totals = self._usage_totals[(side, "striker" if slot < 4 else "sp")]
+                    totals[cid] = totals.get(cid, 0) + 1
+            mask = 0
+            for slot, cid in enumerate(strikers):
+                if cid:
+                    _insert(self._postings.setdefault((side, slot, cid), []), key)
+                    if not mask >> cid & 1:
+                        _insert(self._any_postings.setdefault((side, cid), []), key)
+                    mask |= 1 << cid
+            self._striker_masks[side][row.rid] = mask
+            sp_keys = sorted(set(sps) - {0})
+            for sp in sp_keys:
+                _insert(self._sp_postings.setdefault((side, sp), []), key)
+            if len(sp_keys) == 2:
+                _insert(self._sp_pair_postings.setdefault((side, tuple(sp_keys)), []), key)
+
+    def load(self, records, snapshot=None):
+        """
+        新しい順の行で全件を置き換える。
+        records は行dict、snapshot（バイナリスナップショット）があればその後ろに続く古い行
+        """
+        n = len(records) + (len(snapshot) if snapshot is not None else 0)
+        rows = [BattleRow.from_dict(r, rid=n - 1 - i) for i, r in enumerate(records)]
+        if snapshot is not None:
+            rid = n - 1 - len(records)
+            for fields, extra in snapshot.iter_rows():
+                rows.append(BattleRow.from_fields(fields, extra, rid))
+                rid -= 1
+        rows.reverse()
+        with self._lock:
+            self._reset(rows)
+            self.version = next(_versions)
+            self.load_version = self.version
+        print(f"ストア読込完了: {self.season}（{n}件, version={self.version}）")
+
+    def add_row(self, row_dict):
+        with self._lock:
+            row = BattleRow.from_dict(row_dict, rid=len(self._rows))
+            # 先に行を追加してからインデックスへ（読み手が未登録のridを引かないように）
+            self._rows.append(row)
+            self._flags.append(0)
+            for masks in self._striker_masks.values():
+                masks.append(0)
+            self._index_row(row)
+            self.version = next(_versions)
+        return row
+
+    def refresh_templates(self):
+        """STRIKERマスタが変わっていれば全行のテンプレIDを求め直す（変わっていなければ何もしない）"""
+        version = template_registry.version
+        if self.template_version == version:
+            return
+        with self._lock:
+            template_id = template_registry.template_id
+            for row in self._rows:
+                row.a_tpl = template_id(row.a_ids)
+                row.d_tpl = template_id(row.d_ids)
+            self.template_version = version
+        print(f"テンプレIDを更新: {self.season}（{len(self._rows)}件）")
+
+    def has_row(self, row_dict):
+        """同じ対戦が既に取り込み済みか"""
+        return row_fingerprint(row_dict) in self._fingerprints
+
+    def _rows_for(self, keys):
+        rows = self._rows
+        return [rows[k & _RID_MASK] for k in keys]
+
+    @property
+    def rows(self):
+        """新しい順の行リスト（コピー）"""
+        with self._lock:
+            return self._rows_for(reversed(self._order))
+
+    def recent_losers(self, only_limited=False):
+        """負け側がある直近の行（新しい順, 最大 RECENT_LOSERS_SIZE 件）"""
+        with self._lock:
+            return self._rows_for(reversed(self._recent_losers[only_limited]))
+
+    def rows_since(self, rid):
+        """
+        rid 以降に取り込んだ行（rid順）と各行の FLAG_*、その時点の (load_version, version, template_version)
+        と防衛側の出場数（defense_usage）。列形式の集計（suggest_engine）が前回から増えた行だけを足すため
+        """
+        with self._lock:
+            return self._rows[rid:], bytes(self._flags[rid:]), \
+                (self.load_version, self.version, self.template_version), self._defense_usage()
+
+    def rows_with_usage(self):
+        """新しい順の行リスト（コピー）と防衛側の出場数、その時点の (version, template_version)"""
+        with self._lock:
+            return self._rows_for(reversed(self._order)), self._defense_usage(), \
+                (self.version, self.template_version)
+
+    def iter_rows(self):
+        """新しい順に行を返す（呼び出し時点の並びで固定）"""
+        return iter(self.rows)
+
+    def __len__(self):
+        return len(self._rows)
+
+    def approx_bytes(self):
+        """メモリ使用量の目安（シーズンの解放判定用）"""
+        return len(self._rows) * _ROW_BYTES_ESTIMATE
+
+    # ===== キャラの使用数 =====
+
+    def char_usage(self, side, slot, cid):
+        """side の slot 枠（SIDE_SLOT_KEYS の並び）でのキャラの (件数, 勝ち数)"""
+        usage = self._usage.get((side, slot, cid))
+        return (usage[0], usage[1]) if usage else (0, 0)
+
+    def usage_counts(self, side, part):
+        """part="striker"（4枠）/"sp"（2枠）をまとめたキャラごとの件数（キャラID -> 件数のコピー。0件は含まない）"""
+        with self._lock:
+            return dict(self._usage_totals[(side, part)])
+
+    def _defense_usage(self):
+        # 呼び出し側でロックを保持していること。{"striker": キャラID -> 件数, "sp": ...}（コピー）
+        return {part: dict(self._usage_totals[("defense", part)]) for part in ("striker", "sp")}
+
+    def usage_table(self):
+        """全キャラ×side×枠の [(side, slot, キャラID, 件数, 勝ち数), ...]"""
+        with self._lock:
+            return [(side, slot, cid, games, wins) for (side, slot, cid), (games, wins) in self._usage.items()]
+
+    # ===== 検索 =====
+
+    @staticmethod
+    def _union(lists):
+        # 表記ゆれ込みの条件は、それぞれのポスティングリストの和集合（並び順キー昇順）
+        lists = [l for l in lists if l is not None]
+        if len(lists) == 1:
+            return lists[0]
+        return sorted(set().union(*lists))
+
+    def search(self, query_ids, side, before_key=None, limit=None, flags=0, strict_pos=True):
+        """
+        6枠のキャラID（4キャラ＋SP2枠, 空欄は0）に一致する行を新しい順で返す。
+        各枠はIDのタプルでもよく、そのどれかに一致すればよい（表記ゆれの吸収用）。
+        strict_pos=True ならキャラは枠一致、False なら4枠のどこかにいればよい（集合として含む）。
+        SPはどちらも順不同。各条件のポスティングリストを積集合する
+        （枠を問わないときは、いちばん短いリスト以外のキャラ条件は行のビットマスクで判定）。
+        flags（FLAG_* の組み合わせ）を指定すると全て立っている行だけ。行フラグの表で判定するので
+        外れる行は行オブジェクトを引かない。
+        before_key があればそれより古い行だけ、limit 件たまったところで打ち切る
+        （ページ送り用。新しい側から見ていくので残りは読まない）
+        """
+        alts = [q if isinstance(q, tuple) else ((q,) if q else ()) for q in query_ids]
+        with self._lock:
+            terms = []
+            query_mask = 0      # 1通りしかないキャラ（全て含む）
+            alt_masks = []      # 表記ゆれのあるキャラ（それぞれどれか1つを含む）
+            if strict_pos:
+                for slot in range(4):
+                    if alts[slot]:
+                        terms.append(self._union(self._postings.get((side, slot, c)) for c in alts[slot]))
+            else:
+                for cids in dict.fromkeys(a for a in alts[:4] if a):
+                    terms.append(self._union(self._any_postings.get((side, c)) for c in cids))
+                    mask = sum(1 << c for c in set(cids))
+                    if len(cids) == 1:
+                        query_mask |= mask
+                    else:
+                        alt_masks.append(mask)
+            sp_term = None
+            if alts[4] and alts[5]:
+                # 2枠とも同じキャラなら「そのSPを含む」、違えばペアで引く
+                lists = {}
+                for x in alts[4]:
+                    for y in alts[5]:
+                        if x == y:
+                            lists[x] = self._sp_postings.get((side, x))
+                        else:
+                            pair = (min(x, y), max(x, y))
+                            lists[pair] = self._sp_pair_postings.get((side, pair))
+                sp_term = self._union(lists.values())
+            elif alts[4] or alts[5]:
+                sp_term = self._union(self._sp_postings.get((side, c)) for c in alts[4] or alts[5])
+            if sp_term is not None:
+                terms.append(sp_term)
+            if not terms:
+                return []
+            terms.sort(key=len)
+            driver = terms[0]
+            set_mode = not strict_pos and (query_mask or alt_masks)
+            if set_mode:
+                # キャラ条件はマスクでまとめて見るので、ポスティングで確かめるのはSPだけ
+                others = [sp_term] if sp_term is not None and sp_term is not driver else []
+                masks = self._striker_masks[side]
+            else:
+                others = terms[1:]
+            end = len(driver) if before_key is None else bisect.bisect_left(driver, before_key)
+            row_flags = self._flags
+            matched = []
+            for i in range(end - 1, -1, -1):
+                k = driver[i]
+                rid = k & _RID_MASK
+                if flags and row_flags[rid] & flags != flags:
+                    continue
+                if set_mode:
+                    mask = masks[rid]
+                    if mask & query_mask != query_mask or not all(mask & m for m in alt_masks):
+                        continue
+                if not all(_contains(t, k) for t in others):
+                    continue
+                matched.append(k)
+                if limit is not None and len(matched) >= limit:
+                    break
+            return self._rows_for(matched)
@@ -0,0 +1,195 @@
+# character_registry.py
+# キャラ名の正規化（表記ゆれ・OCR誤読の吸収）と整数IDの払い出し
+# 戦闘ログは取り込み時に一度だけここを通し、検索・防衛提案はIDで比較する
+import sys
+import threading
+import unicodedata
+
+from config import CHARACTER_ALIASES, FUZZY_NAME_MAX_EDITS
+
+def _fold(s):
+    # 全角/半角（英数・括弧・カナ）をNFKCで揃え、空白は全て除去
+    s = unicodedata.normalize("NFKC", str(s))
+    return "".join(s.split())
+
+_ALIASES = {_fold(k): _fold(v) for k, v in CHARACTER_ALIASES.items()}
+
+def canonicalize_name(name):
+    """表記ゆれを吸収した正規名（空欄は""）"""
+    if not name:
+        return ""
+    key = _fold(name)
+    return _ALIASES.get(key, key)
+
+# ========== あいまい一致（OCR誤読の吸収） ==========
+
+def _grams(key):
+    # 前後に番兵を付けた文字2-gram（多重集合）
+    padded = "\0" + key + "\0"
+    counts = {}
+    for i in range(len(padded) - 1):
+        g = padded[i:i + 2]
+        counts[g] = counts.get(g, 0) + 1
+    return counts
+
+def _max_edits(key, limit=FUZZY_NAME_MAX_EDITS):
+    # 短い名前ほど別キャラと取り違えやすいので許す編集数を減らす（2文字以下は完全一致のみ）
+    return min(limit, len(key) // 3)
+
+def edit_distance(a, b, limit):
+    """レーベンシュタイン距離。limit を超えると分かった時点で limit+1 を返す"""
+    if abs(len(a) - len(b)) > limit:
+        return limit + 1
+    prev = list(range(len(b) + 1))
+    for i, ca in enumerate(a, 1):
+        cur = [i]
+        for j, cb in enumerate(b, 1):
+            cur.append(min(prev[j] + 1, cur[j - 1] + 1, prev[j - 1] + (ca != cb)))
+        if min(cur) > limit:
+            return limit + 1
+        prev = cur
+    return prev[-1]
+
+class NameGramIndex:
+    """
+    正規名の2-gram転置インデックス。編集距離 k 以内の名前は共通の2-gramを
+    max(長さ) + 1 - 2k 個以上持つので、候補をそれで絞ってから距離を計算する（全件の距離計算はしない）
+    """
+    def __init__(self):
+        self._postings = {}   # 2-gram -> {正規名: 出現数}
+        self._keys = set()
+
+    def add(self, key):
+        if not key or key in self._keys:
+            return
+        self._keys.add(key)
+        for g, n in _grams(key).items():
+            self._postings.setdefault(g, {})[key] = n
+
+    def near(self, key, max_edits):
+        """編集距離 max_edits 以内の名前を [(距離, 名前), ...]（近い順）で返す"""
+        # 2-gram を1つも共有しなくても距離が収まりうる（必要な共有数が0以下になる）ときは全件を候補にする。
+        # 名前3文字につき1までの上限で呼ぶ限りは起きない
+        shared = dict.fromkeys(list(self._keys), 0) if 2 * max_edits >= len(key) + 1 else {}
+        for g, n in _grams(key).items():
+            # マスタ更新と並行して読まれるので、その時点の内容を写してから回す
+            for other, m in list(self._postings.get(g, {}).items()):
+                shared[other] = shared.get(other, 0) + min(n, m)
+        result = []
+        for other, count in shared.items():
+            if count < max(len(key), len(other)) + 1 - 2 * max_edits:
+                continue
+            d = edit_distance(key, other, max_edits)
+            if d <= max_edits:
+                result.append((d, other))
+        result.sort()
+        return result
+
+class CharacterRegistry:
+    """
+    正規名 ⇔ ID。ID 0 は空欄。IDはプロセス内で全シーズン共通。
+    マスタに無い名前（OCR誤読など）は、編集距離で最も近いマスタ名が1つに決まればその表記ゆれとみなす
+    （検索で広げるのは lookup_ids に max_edits を渡したときだけ）。
+    version は名前かマスタが増えるたびに変わる（検索結果のキャッシュの札用）
+    """
+    def __init__(self):
+        self._ids = {"": 0}
+        self._raw_ids = {"": 0}  # 元の表記 -> ID（同じ表記の正規化を繰り返さない）
+        self._names = [""]      # ID -> 表示名
+        self._lock = threading.Lock()
+        self._master_keys = set()
+        self._master_grams = NameGramIndex()
+        self._variants = None    # マスタの正規名 -> [(距離, 表記ゆれのID), ...]（None は作り直しが必要）
+        self.version = 0
+
+    def get_id(self, name):
+        """取り込み用：未登録の名前なら新しいIDを払い出す"""
+        cid = self._raw_ids.get(name)
+        if cid is not None:
+            return cid
+        key = canonicalize_name(name)
+        cid = self._ids.get(key)
+        if cid is None:
+            with self._lock:
+                cid = self._ids.get(key)
+                if cid is None:
+                    cid = len(self._names)
+                    self._names.append(sys.intern(str(name).strip()))
+                    self._ids[key] = cid
+                    self._variants = None
+                    self.version += 1
+        self._raw_ids[name] = cid
+        return cid
+
+    def lookup_id(self, name):
+        """検索用：未登録の名前は None（どの行とも一致しない）"""
+        return self._ids.get(canonicalize_name(name))
+
+    def name_of(self, cid):
+        return self._names[cid]
+
+    def register_master_names(self, names):
+        """マスタ（STRIKER/SPECIAL）の表記を表示名として優先させる"""
+        for name in names:
+            cid = self.get_id(name)
+            self._names[cid] = sys.intern(name)
+            key = canonicalize_name(name)
+            if key not in self._master_keys:
+                with self._lock:
+                    self._master_keys.add(key)
+                    self._master_grams.add(key)
+                    self._variants = None
+                    self.version += 1
+
+    def _nearest_master(self, key, limit=FUZZY_NAME_MAX_EDITS):
+        # 最も近いマスタ名が1つに決まるときだけ (距離, 正規名) を返す（同じ距離の候補が複数なら決めない）
+        if key in self._master_keys:
+            return 0, key
+        near = self._master_grams.near(key, _max_edits(key, limit))
+        if not near or (len(near) > 1 and near[0][0] == near[1][0]):
+            return None
+        return near[0]
+
+    def _nearest_master_key(self, key, limit=FUZZY_NAME_MAX_EDITS):
+        nearest = self._nearest_master(key, limit)
+        return nearest[1] if nearest else None
+
+    def nearest_master_name(self, name):
+        """取り込み用：OCR結果などに最も近いマスタの表示名（決まらなければ None）"""
+        key = canonicalize_name(name)
+        if not key:
+            return None
+        master = self._nearest_master_key(key)
+        return self._names[self._ids[master]] if master else None
+
+    def _get_variants(self):
+        variants = self._variants
+        if variants is None:
+            with self._lock:
+                variants = {}
+                for key, cid in list(self._ids.items()):
+                    if key and key not in self._master_keys:
+                        nearest = self._nearest_master(key)
+                        if nearest:
+                            variants.setdefault(nearest[1], []).append((nearest[0], cid))
+                self._variants = variants
+        return variants
+
+    def lookup_ids(self, name, max_edits=0):
+        """
+        検索用：一致するIDが1つならそのID、表記ゆれもあれば (ID, ...)、どれも無ければ None。
+        max_edits=0（既定）なら表記ゆれに広げず lookup_id と同じ。
+        広げるときはマスタ名から編集距離 max_edits 以内（名前3文字につき1まで）の名前だけ
+        """
+        key = canonicalize_name(name)
+        master = self._nearest_master_key(key, max_edits) if max_edits else None
+        if master is None:
+            return self._ids.get(key)
+        # 表記ゆれの距離は取り込み側の上限（名前3文字につき1まで）で既に絞ってある
+        ids = [self._ids[master]] + [cid for d, cid in self._get_variants().get(master, []) if d <= max_edits]
+        return ids[0] if len(ids) == 1 else tuple(ids)
+
+    def __len__(self):
+        return len(self._names)
+
+char_registry = CharacterRegistry()
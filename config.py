@@ -13,6 +13,45 @@ SEASON_LIST = [
 # キャッシュファイルのディレクトリ（ルートからの相対パス）
 CACHE_DIR = "cache"
 
+# 過去シーズンの戦闘ログをメモリに置いておく上限（MB, 目安）
+# 超えたら最近参照していないシーズンから解放する（現行シーズンは常に保持）
+SEASON_CACHE_MEMORY_MB = 512
+
+# /api/search の1ページの件数（既定・上限）。続きは next_cursor で取る
+SEARCH_PAGE_SIZE = 50
+SEARCH_PAGE_SIZE_MAX = 200
+# /api/search_batch で1回に受け付けるクエリ数の上限
+SEARCH_BATCH_MAX_QUERIES = 50
+
+# 検索結果ページのキャッシュ件数（LRU）。取り込みがあったシーズンの分は自動で作り直す
+SEARCH_RESULT_CACHE_SIZE = 512
+
+# 防衛サジェストの結果キャッシュ件数（LRU）と、攻めごとの絞り込み・テンプレ集計のキャッシュ件数。
+# どちらも取り込みやマスタ更新があったシーズンの分は自動で作り直す
+SUGGEST_RESULT_CACHE_SIZE = 64
+SUGGEST_ATTACK_CACHE_SIZE = 256
+# 提案結果ページからのテンプレ詳細で提案時の集計を使い回す期間（秒）と、同時に持つ数
+SUGGEST_SESSION_TTL = 600
+SUGGEST_SESSION_MAX = 256
+
+# /api/counter_stats（勝ち筋の編成別集計）の既定の返却件数・上限と、ベイズ勝率の事前対戦数
+COUNTER_STATS_TOP_K = 20
+COUNTER_STATS_TOP_K_MAX = 100
+COUNTER_STATS_PRIOR_GAMES = 8
+
+# キャラ名の表記ゆれ（OCR誤読など）→ 正式名
+# 全角/半角・空白・括弧の違いは自動で吸収されるので、それ以外の誤読だけ登録する
+CHARACTER_ALIASES = {
+    # "ホシノ(臨戦": "ホシノ（臨戦）",
+}
+
+# マスタに無いキャラ名（OCR誤読など）を最も近いマスタ名の表記ゆれとみなす編集距離の上限
+# 実際の上限は名前3文字につき1まで（2文字以下の名前は完全一致のみ）
+FUZZY_NAME_MAX_EDITS = 2
+# 検索で表記ゆれとして広げるときの編集距離の上限（取り込みより厳しくする。0 で広げない）
+# 別キャラ（マスタ未登録の新衣装など）を近いマスタ名の結果に混ぜないため
+FUZZY_QUERY_MAX_EDITS = 1
+
 # スプレッドシートの「戦闘ログ」用シート名（＝シーズン名と一致が前提）
 # 他に共通で使う名前・IDがあればここでまとめて定義
 
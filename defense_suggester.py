@@ -1,15 +1,28 @@
 import time
-from collections import defaultdict
+import uuid
+import threading
+from collections import defaultdict, OrderedDict
+import numpy as np
 from spreadsheet_manager import (
-    get_output_sheet_cache,
+    get_season_store,
     get_striker_list_from_sheet,
     get_special_list_from_sheet
 )
+from character_registry import char_registry
+from template_registry import template_registry
+from suggest_engine import get_season_columns
+from config import (
+    SUGGEST_RESULT_CACHE_SIZE,
+    SUGGEST_ATTACK_CACHE_SIZE,
+    SUGGEST_SESSION_TTL,
+    SUGGEST_SESSION_MAX
+)
 
 SUGGEST_CONFIG = {
     "FORCED_SP": "シロコ（水着）",
     "CHAR_MIN_GAMES": 30,
-    "PRIOR_GAMES": 8
+    "PRIOR_GAMES": 8,
+    "ENGINE": "numpy"    # "python" にすると行ループ版で集計する
 }
 UNKNOWN_SAMPLE_WR = 0.3  # サンプル0の場合に使う勝率
 
@@ -22,123 +35,135 @@ def safe_int(val):
     try: return int(val)
     except Exception: return 0
 
+_striker_master_cache = {"raw": None, "master": {}}
+
 def load_striker_master():
+    """
+    キャラID -> {射程, 遮蔽, image}。STRIKERマスタが更新されたときだけ作り直し、
+    行のテンプレID（template_registry）も同じマスタに揃える
+    """
     raw = get_striker_list_from_sheet()
-    m = {}
-    for c in raw:
-        m[c["name"]] = {
-            "射程": safe_int(c.get("射程")),
-            "遮蔽": boolify(c.get("遮蔽", False)),
-            "image": c.get("image")
-        }
-    return m
+    if raw is not _striker_master_cache["raw"]:
+        m = {}
+        for c in raw:
+            m[char_registry.get_id(c["name"])] = {
+                "射程": safe_int(c.get("射程")),
+                "遮蔽": boolify(c.get("遮蔽", False)),
+                "image": c.get("image")
+            }
+        template_registry.set_striker_master({cid: (info["射程"], info["遮蔽"]) for cid, info in m.items()})
+        _striker_master_cache["master"] = m
+        _striker_master_cache["raw"] = raw
+    return _striker_master_cache["master"]
 
 def load_special_master():
     raw = get_special_list_from_sheet()
     return {c["name"]: {"image": c.get("image")} for c in raw}
 
 def load_battlelog(season=None):
-    return get_output_sheet_cache(season)
+    return get_season_store(season).rows
+
+def to_attack_ids(attack):
+    """攻め編成（キャラ名6枠）→キャラID（空欄は0, 未知の名前は None）。提案は表記ゆれに広げず完全一致で数える"""
+    return [char_registry.lookup_id(c) if c else 0 for c in attack]
 
-def filter_records_by_attack_strikers(records, attack, strict_pos=False):
+def filter_records_by_attack_strikers(store, records, attack, strict_pos=False):
+    """
+    攻め編成に一致する行（新しい順）。キャラの一致条件は検索（SeasonStore.search）と同じで、
+    strict_pos=True なら枠一致、False なら4枠のどこかにいればよい。
+    SPは strict_pos=False なら順不同、True なら枠一致。全枠空欄なら records（全件）をそのまま返す
+    （records が None ならそのときだけストアの全行を取る）
+    """
     if not attack:
         return []
-    filtered = []
-    for r in records:
-        # --- ストライカー一致判定 ---
-        if strict_pos:
-            match = True
-            for i in range(4):
-                if attack[i]:
-                    if r.get(f"A{i+1}", "") != attack[i]:
-                        match = False
-                        break
-            if not match:
-                continue
-        else:
-            atk_chars = [c for c in attack[:4] if c]
-            row_chars = [r.get(f"A{i+1}", "") for i in range(4)]
-            if any(c and c not in row_chars for c in atk_chars):
-                continue
-        # --- スペシャル一致判定 ---
-        asp_input = [attack[4] if len(attack) > 4 else "", attack[5] if len(attack) > 5 else ""]
-        asp_input_nonempty = [x for x in asp_input if x]
-        row_sp = [r.get("ASP1", ""), r.get("ASP2", "")]
-        if strict_pos:
-            for i in range(2):
-                if asp_input[i]:
-                    if row_sp[i] != asp_input[i]:
-                        break
-            else:
-                filtered.append(r)
-                continue
-            continue
-        else:
-            if any(sp and sp not in row_sp for sp in asp_input_nonempty):
-                continue
-        filtered.append(r)
+    attack = to_attack_ids(attack)
+    if None in attack:
+        # 一度も記録に出てこないキャラを含む攻めには一致しない
+        return []
+    return _filter_records_by_attack_ids(store, records, attack, strict_pos)
+
+def _filter_records_by_attack_ids(store, records, attack, strict_pos):
+    # attack は to_attack_ids 済み（未知のキャラを含まない）
+    if not any(attack):
+        return store.rows if records is None else records
+    filtered = store.search(attack, "attack", strict_pos=strict_pos)
+    if strict_pos and any(attack[4:6]):
+        # 位置指定ありのときはSPも枠一致
+        filtered = [r for r in filtered
+                    if all(not q or r.asp_ids[i] in (q if isinstance(q, tuple) else (q,))
+                           for i, q in enumerate(attack[4:6]))]
     return filtered
 
-def get_striker_templates(records, master):
-    templates = defaultdict(lambda: {"games": 0, "wins": 0, "rows": []})
+def get_striker_templates(records):
+    """防衛4枠のテンプレごとに行をまとめる（行のテンプレIDで数えるだけ。0 はテンプレ扱いしない）"""
+    by_id = {}
     for r in records:
-        tags = []
-        for i in range(4):
-            info = master.get(r.get(f"D{i+1}", ""))
-            if not info:
-                tags = []
-                break
-            tags.append((info["射程"], info["遮蔽"]))
-        if len(tags) != 4:
+        tid = r.d_tpl
+        if not tid:
             continue
-        tpl = tuple(tags)
-        tpl_data = templates[tpl]
+        tpl_data = by_id.get(tid)
+        if tpl_data is None:
+            tpl_data = by_id[tid] = {"games": 0, "wins": 0, "rows": []}
         tpl_data["games"] += 1
-        if r.get("勝敗_2") == "Win":
+        if r.def_result == "Win":
             tpl_data["wins"] += 1
         tpl_data["rows"].append(r)
-    return templates
+    return {template_registry.tags_of(tid): tpl_data for tid, tpl_data in by_id.items()}
 
 def bayes_wr(wins, games, prior_games, prior_wr):
     return (wins + prior_games * prior_wr) / (games + prior_games) if (games + prior_games) > 0 else 0
 
-def get_global_counts(records, fields):
+def get_global_counts(records, attr):
+    """attr="d_ids"（D1〜D4）/"dsp_ids"（DSP1/DSP2）の出現回数をキャラIDごとに数える"""
     counts = defaultdict(int)
     for r in records:
-        for f in fields:
-            name = r.get(f, "")
-            if name:
-                counts[name] += 1
+        for cid in getattr(r, attr):
+            if cid:
+                counts[cid] += 1
     return counts
 
-def pick_strikers_for_template(tpl, tpl_data, striker_master, global_striker_counts, char_min_games, prior_games, overall_wr):
-    picked_strikers = []
-    slot_counts = defaultdict(int)
-    for row in tpl_data["rows"]:
-        for idx in range(4):
-            name = row.get(f"D{idx+1}", "")
-            if name:
-                slot_counts[(idx, name)] += 1
+def _striker_stats(tpl, rows, striker_master):
+    """枠ごとの キャラID -> {"games", "wins"}（rows 上の初出順）。その枠のタグに合うキャラだけ数える"""
+    slot_stats = []
     for idx, tag in enumerate(tpl):
         char_stats = defaultdict(lambda: {"games": 0, "wins": 0})
-        for row in tpl_data["rows"]:
-            name = row.get(f"D{idx+1}", "")
-            info = striker_master.get(name)
+        for row in rows:
+            cid = row.d_ids[idx]
+            info = striker_master.get(cid)
             if info and (info["射程"], info["遮蔽"]) == tag:
-                char_stats[name]["games"] += 1
-                if row.get("勝敗_2") == "Win":
-                    char_stats[name]["wins"] += 1
-        candidates = {n: s for n, s in char_stats.items() if global_striker_counts[n] >= char_min_games}
+                char_stats[cid]["games"] += 1
+                if row.def_result == "Win":
+                    char_stats[cid]["wins"] += 1
+        slot_stats.append(char_stats)
+    return slot_stats
+
+def _sp_stats(rows):
+    """SPの キャラID -> {"games", "wins"}（rows 上の初出順。行ごとに SP1, SP2 の順）"""
+    sp_stats = defaultdict(lambda: {"games": 0, "wins": 0})
+    for row in rows:
+        for cid in row.dsp_ids:
+            if cid:
+                sp_stats[cid]["games"] += 1
+                if row.def_result == "Win":
+                    sp_stats[cid]["wins"] += 1
+    return sp_stats
+
+def _pick_strikers(tpl, slot_stats, global_striker_counts, char_min_games, prior_games, overall_wr):
+    # 同率のときは slot_stats の並び（初出順）で先のキャラ
+    picked_strikers = []
+    for idx, tag in enumerate(tpl):
+        char_stats = slot_stats[idx]
+        candidates = {n: s for n, s in char_stats.items() if global_striker_counts.get(n, 0) >= char_min_games}
         if candidates:
             def char_wr(s): return bayes_wr(s["wins"], s["games"], prior_games, overall_wr)
             best_char, stat = max(candidates.items(), key=lambda kv: char_wr(kv[1]))
             picked_strikers.append({
                 "枠": f"D{idx+1}",
-                "キャラ": best_char,
+                "キャラ": char_registry.name_of(best_char),
                 "キャラ勝率": round(char_wr(stat), 3),
                 "候補数": len(candidates),
                 "件数": stat["games"],  # タグ内件数
-                "参考": global_striker_counts[best_char] < char_min_games,
+                "参考": global_striker_counts.get(best_char, 0) < char_min_games,
                 "タグ": tag
             })
         else:
@@ -146,11 +171,11 @@ def pick_strikers_for_template(tpl, tpl_data, striker_master, global_striker_cou
                 best_char, stat = max(char_stats.items(), key=lambda kv: kv[1]["games"])
                 picked_strikers.append({
                     "枠": f"D{idx+1}",
-                    "キャラ": best_char,
+                    "キャラ": char_registry.name_of(best_char),
                     "キャラ勝率": None,
                     "候補数": 0,
                     "件数": stat["games"],
-                    "参考": global_striker_counts[best_char] < char_min_games,
+                    "参考": global_striker_counts.get(best_char, 0) < char_min_games,
                     "タグ": tag
                 })
             else:
@@ -165,30 +190,24 @@ def pick_strikers_for_template(tpl, tpl_data, striker_master, global_striker_cou
                 })
     return picked_strikers
 
-def pick_sp_for_template(tpl_data_rows, forced_sp, char_min_games, prior_games, overall_wr, global_sp_counts):
-    sp_stats = defaultdict(lambda: {"games": 0, "wins": 0})
-    for row in tpl_data_rows:
-        for f in ["DSP1", "DSP2"]:
-            name = row.get(f, "")
-            if name and name != forced_sp:
-                sp_stats[name]["games"] += 1
-                if row.get("勝敗_2") == "Win":
-                    sp_stats[name]["wins"] += 1
+def _pick_sp(sp_stats, forced_sp, char_min_games, prior_games, overall_wr, global_sp_counts):
+    forced_sp_id = char_registry.lookup_id(forced_sp)
+    sp_stats = {n: s for n, s in sp_stats.items() if n != forced_sp_id}
     candidates = {n: s for n, s in sp_stats.items() if global_sp_counts.get(n, 0) >= char_min_games}
     sp_detail = []
     picked_sp = [forced_sp]
     if candidates:
         def sp_wr(s): return bayes_wr(s["wins"], s["games"], prior_games, overall_wr)
         best_sp, stat = max(candidates.items(), key=lambda kv: sp_wr(kv[1]))
-        picked_sp.append(best_sp)
+        picked_sp.append(char_registry.name_of(best_sp))
     elif sp_stats:
         best_sp, stat = max(sp_stats.items(), key=lambda kv: kv[1]["games"])
-        picked_sp.append(best_sp)
+        picked_sp.append(char_registry.name_of(best_sp))
     else:
         picked_sp.append("候補なし")
     for n, s in sorted(sp_stats.items(), key=lambda kv: kv[1]["games"], reverse=True):
         sp_detail.append({
-            "name": n,
+            "name": char_registry.name_of(n),
             "games": s["games"],
             "wins": s["wins"],
             "勝率": (s["wins"]/s["games"]) if s["games"] else None,
@@ -197,51 +216,77 @@ def pick_sp_for_template(tpl_data_rows, forced_sp, char_min_games, prior_games,
         })
     return picked_sp, sp_detail
 
-def suggest_defense_teams(attacks=None, season=None, strict_pos=False):
-    FORCED_SP = SUGGEST_CONFIG["FORCED_SP"]
-    CHAR_MIN_GAMES = SUGGEST_CONFIG["CHAR_MIN_GAMES"]
-    PRIOR_GAMES = SUGGEST_CONFIG["PRIOR_GAMES"]
+def pick_strikers_for_template(tpl, tpl_data, striker_master, global_striker_counts, char_min_games, prior_games, overall_wr):
+    slot_stats = _striker_stats(tpl, tpl_data["rows"], striker_master)
+    return _pick_strikers(tpl, slot_stats, global_striker_counts, char_min_games, prior_games, overall_wr)
 
-    records = load_battlelog(season)
-    striker_master = load_striker_master()
-    global_striker_counts = get_global_counts(records, [f"D{i+1}" for i in range(4)])
-    global_sp_counts = get_global_counts(records, ["DSP1", "DSP2"])
+def pick_sp_for_template(tpl_data_rows, forced_sp, char_min_games, prior_games, overall_wr, global_sp_counts):
+    return _pick_sp(_sp_stats(tpl_data_rows), forced_sp, char_min_games, prior_games, overall_wr, global_sp_counts)
 
-    attacks = attacks or []
-    template_table = {}
-    per_attack_templates = []
-    per_attack_labels = []
-    ignored_attacks = []
+# ========== 集計エンジン ==========
+# どちらも attack_templates（攻め1つのキャラID → テンプレタグ -> {"games", "wins", ...}, 一致なしは None）と
+# template_stats（テンプレの攻めごとの集計を連結した行の 枠ごと/SP の集計）、
+# 集計に使ったデータの version（同じ version のエンジン同士なら attack_templates の結果を使い回せる）を持つ。
+# 勝率の計算と選び方は共通なので、集計が同じなら結果も同じになる
 
-    for idx, attack in enumerate(attacks):
-        filtered = filter_records_by_attack_strikers(records, attack, strict_pos)
-        label = "・".join([c for c in attack[:4] if c])
-        sp_label = ""
-        if len(attack) > 4 and (attack[4] or (len(attack) > 5 and attack[5])):
-            sp_label = " / SP:" + "・".join([x for x in attack[4:6] if x])
-        per_attack_labels.append(label + sp_label)
+class RowEngine:
+    """行を1件ずつ見る版（基準実装）"""
+    def __init__(self, store, striker_master):
+        self.store = store
+        self.striker_master = striker_master
+        # 行・出場数（ストアが取り込み時に数えているもの）・版は同じ時点のものを取る
+        self.records, usage, self.version = store.rows_with_usage()
+        self.global_striker_counts = usage["striker"]
+        self.global_sp_counts = usage["sp"]
+
+    def attack_templates(self, attack_ids, strict_pos):
+        filtered = _filter_records_by_attack_ids(self.store, self.records, attack_ids, strict_pos)
         if not filtered:
-            ignored_attacks.append(idx)
-            per_attack_templates.append({})
-            continue
-        templates = get_striker_templates(filtered, striker_master)
-        per_attack_templates.append(templates)
-        for tpl, tpl_data in templates.items():
-            if tpl not in template_table:
-                template_table[tpl] = {}
-            template_table[tpl][idx] = tpl_data
+            return None
+        return get_striker_templates(filtered)
+
+    def template_stats(self, tpl, parts):
+        rows = []
+        for tpl_data in parts:
+            rows.extend(tpl_data["rows"])
+        return _striker_stats(tpl, rows, self.striker_master), _sp_stats(rows)
+
+class ColumnEngine:
+    """シーズンの行列（suggest_engine）をまとめて数える版"""
+    def __init__(self, store, striker_master):
+        self.columns = get_season_columns(store)
+        self.version = (self.columns.version, self.columns.template_version)
+        self.global_striker_counts = self.columns.global_counts("d")
+        self.global_sp_counts = self.columns.global_counts("dsp")
+
+    def attack_templates(self, attack_ids, strict_pos):
+        idx = self.columns.filter_attack(attack_ids, strict_pos)
+        if not idx.size:
+            return None
+        return {
+            template_registry.tags_of(tid): {"games": games, "wins": wins, "tid": tid, "idx": idx}
+            for tid, games, wins in self.columns.template_counts(idx)
+        }
+
+    def template_stats(self, tpl, parts):
+        cols = self.columns
+        idx = np.concatenate([cols.template_rows(p["idx"], p["tid"]) for p in parts])
+        # テンプレの行は4枠ともタグが合っているので、枠ごとのキャラをそのまま数えればよい
+        return cols.defense_stats(idx)
 
-    candidate_tpls = list(template_table.keys())
+_ENGINES = {"python": RowEngine, "numpy": ColumnEngine}
+
+def _score_templates(template_table, n_attacks, prior_games):
     template_scores = []
-    for tpl in candidate_tpls:
+    for tpl in template_table:
         wr_list = []
         attack_stats = []
-        for idx in range(len(attacks)):
+        for idx in range(n_attacks):
             tpl_data = template_table[tpl].get(idx)
             if tpl_data:
                 games = tpl_data["games"]
                 wins = tpl_data["wins"]
-                wr = bayes_wr(wins, games, PRIOR_GAMES, 0.5)
+                wr = bayes_wr(wins, games, prior_games, 0.5)
                 wr_list.append(wr)
                 attack_stats.append({
                     "games": games,
@@ -258,27 +303,151 @@ def suggest_defense_teams(attacks=None, season=None, strict_pos=False):
             "mean_wr": mean_wr,
             "攻めごと勝率": attack_stats
         })
+    return sorted(template_scores, key=lambda x: (x["mean_wr"] if x["mean_wr"] is not None else -1), reverse=True)
+
+# ========== 結果キャッシュ ==========
+# 提案結果と、攻めごとの絞り込み・テンプレ集計を LRU で持つ。
+# 版（ストアの行・テンプレID・キャラ名の登録）が変わったものは使わない。返した結果は書き換えないこと
+_suggest_cache = OrderedDict()   # (シーズン, strict_pos, 攻め, エンジン, 設定) -> {"version", "value"}
+_attack_cache = OrderedDict()    # (エンジン, シーズン, strict_pos, 攻めのキャラID) -> {"version", "value"}
+_suggest_cache_lock = threading.Lock()
+
+def _cache_get(cache, key, version):
+    with _suggest_cache_lock:
+        cached = cache.get(key)
+        if cached is None or cached["version"] != version:
+            return None
+        cache.move_to_end(key)
+        return cached
+
+def _cache_put(cache, key, version, value, max_size):
+    with _suggest_cache_lock:
+        cache[key] = {"version": version, "value": value}
+        cache.move_to_end(key)
+        while len(cache) > max_size:
+            cache.popitem(last=False)
+
+def _canonical_attack_ids(attack_ids, strict_pos):
+    # 枠を問わないときはキャラ4枠・SP2枠とも順不同なので並べ替えて同じキーにする
+    if strict_pos:
+        return tuple(attack_ids)
+    def order(x):
+        return x if isinstance(x, tuple) else (x,)
+    return tuple(sorted(attack_ids[:4], key=order)) + tuple(sorted(attack_ids[4:6], key=order))
 
-    template_scores = sorted(template_scores, key=lambda x: (x["mean_wr"] if x["mean_wr"] is not None else -1), reverse=True)
+def _attack_templates(engine, engine_name, season, version, attack, strict_pos):
+    """攻め1つのテンプレ集計（一致なしは None）。同じ攻め（並び・表記ゆれ違いを含む）は前回の集計を使う"""
+    if not attack:
+        return None
+    attack_ids = to_attack_ids(attack)
+    if None in attack_ids:
+        # 一度も記録に出てこないキャラを含む攻めには一致しない
+        return None
+    key = (engine_name, season, bool(strict_pos), _canonical_attack_ids(attack_ids, strict_pos))
+    cached = _cache_get(_attack_cache, key, version)
+    if cached is not None:
+        return cached["value"]
+    templates = engine.attack_templates(attack_ids, strict_pos)
+    _cache_put(_attack_cache, key, version, templates, SUGGEST_ATTACK_CACHE_SIZE)
+    return templates
+
+def _template_picks(engine, tpl, parts, global_striker_counts, global_sp_counts):
+    """テンプレの攻めごとの集計（攻めの順）→ (ピックキャラ, SP案, SP詳細)"""
+    FORCED_SP = SUGGEST_CONFIG["FORCED_SP"]
+    CHAR_MIN_GAMES = SUGGEST_CONFIG["CHAR_MIN_GAMES"]
+    PRIOR_GAMES = SUGGEST_CONFIG["PRIOR_GAMES"]
+    if parts:
+        # 攻めの順に、その攻めでこのテンプレだった行をつなげて数える
+        slot_stats, sp_stats = engine.template_stats(tpl, parts)
+    else:
+        slot_stats, sp_stats = [{} for _ in tpl], {}
+    picked_strikers = _pick_strikers(
+        tpl, slot_stats, global_striker_counts,
+        CHAR_MIN_GAMES, PRIOR_GAMES, 0.5
+    )
+    picked_sp, sp_detail = _pick_sp(
+        sp_stats, FORCED_SP, CHAR_MIN_GAMES, PRIOR_GAMES, 0.5, global_sp_counts
+    )
+    return picked_strikers, picked_sp, sp_detail
+
+def _collect_templates(engine, engine_name, season, attacks, strict_pos):
+    """攻めごとのテンプレ集計を テンプレタグ -> {攻めの番号: 集計} にまとめる。(表, 一致なしの攻めの番号)"""
+    template_table = {}
+    ignored_attacks = []
+    for idx, attack in enumerate(attacks):
+        templates = _attack_templates(engine, engine_name, season, engine.version, attack, strict_pos)
+        if templates is None:
+            ignored_attacks.append(idx)
+            continue
+        for tpl, tpl_data in templates.items():
+            if tpl not in template_table:
+                template_table[tpl] = {}
+            template_table[tpl][idx] = tpl_data
+    return template_table, ignored_attacks
+
+def suggest_defense_teams(attacks=None, season=None, strict_pos=False, engine=None):
+    """
+    engine: "numpy"（既定, SUGGEST_CONFIG["ENGINE"]）/"python"（行ループの基準実装）。結果は同じ。
+    同じ条件・同じ版なら前回の結果（共有。書き換えないこと）を返す
+    """
+    return _suggest_defense_teams(attacks, season, strict_pos, engine)[0]
+
+def _suggest_defense_teams(attacks, season, strict_pos, engine=None, with_state=False):
+    # (結果, テンプレ詳細用の集計 or None) を返す。集計は with_state=True のときだけ作る
+    PRIOR_GAMES = SUGGEST_CONFIG["PRIOR_GAMES"]
+    engine_name = engine or SUGGEST_CONFIG["ENGINE"]
+
+    store = get_season_store(season)
+    striker_master = load_striker_master()
+    store.refresh_templates()
+    attacks = attacks or []
+    result_key = (
+        season, bool(strict_pos), tuple(tuple(a) for a in attacks),
+        engine_name, tuple(sorted(SUGGEST_CONFIG.items()))
+    )
+    # 結果キャッシュはストアの版だけで引く（当たればエンジン＝行列の用意もしない）
+    registry_version = char_registry.version
+    cached = _cache_get(_suggest_cache, result_key, (store.version, store.template_version, registry_version))
+    if cached is not None and not with_state:
+        return cached["value"], None
+
+    engine = _ENGINES[engine_name](store, striker_master)
+    # 入れるときは実際に集計した版で（上で読んだ後に取り込みがあっても、その版の札になる）
+    version = engine.version + (registry_version,)
+    # 攻めごとの集計は攻めのキャッシュから（結果がキャッシュにあるときはふつう全部当たる）
+    template_table, ignored_attacks = _collect_templates(engine, engine_name, store.season, attacks, strict_pos)
+    if with_state:
+        # エンジン（行列）は持たず、詳細のときに同じ版の行列を引き直す
+        state = {
+            "engine": engine_name,
+            "version": engine.version,
+            "template_table": template_table,
+            "global_striker_counts": engine.global_striker_counts,
+            "global_sp_counts": engine.global_sp_counts,
+            "conditions": (season, bool(strict_pos), tuple(tuple(a) for a in attacks)),
+        }
+    else:
+        state = None
+    if cached is not None and cached["version"] == version:
+        return cached["value"], state
+
+    per_attack_labels = []
+    for attack in attacks:
+        label = "・".join([c for c in attack[:4] if c])
+        sp_label = ""
+        if len(attack) > 4 and (attack[4] or (len(attack) > 5 and attack[5])):
+            sp_label = " / SP:" + "・".join([x for x in attack[4:6] if x])
+        per_attack_labels.append(label + sp_label)
+
+    template_scores = _score_templates(template_table, len(attacks), PRIOR_GAMES)
     best_tpls = template_scores[:5]
 
     top_template_results = []
     for rank, s in enumerate(best_tpls, 1):
         tpl = s["タグセット"]
-        merged_tpl_data = {"rows": [], "games": 0, "wins": 0}
-        for idx in range(len(attacks)):
-            tpl_data = template_table[tpl].get(idx)
-            if tpl_data:
-                merged_tpl_data["rows"].extend(tpl_data["rows"])
-                merged_tpl_data["games"] += tpl_data["games"]
-                merged_tpl_data["wins"] += tpl_data["wins"]
-        picked_strikers = pick_strikers_for_template(
-            tpl, merged_tpl_data, striker_master, global_striker_counts,
-            CHAR_MIN_GAMES, PRIOR_GAMES, 0.5
-        )
-        picked_sp, sp_detail = pick_sp_for_template(
-            merged_tpl_data["rows"], FORCED_SP, CHAR_MIN_GAMES, PRIOR_GAMES, 0.5, global_sp_counts
-        )
+        parts = [template_table[tpl][idx] for idx in range(len(attacks)) if idx in template_table[tpl]]
+        picked_strikers, picked_sp, sp_detail = _template_picks(
+            engine, tpl, parts, engine.global_striker_counts, engine.global_sp_counts)
         top_template_results.append({
             "順位": rank,
             "テンプレタグ": tpl,
@@ -313,62 +482,103 @@ def suggest_defense_teams(attacks=None, season=None, strict_pos=False):
         })
     template_judgement = sorted(template_judgement, key=lambda x: (x["mean_wr"] if x["mean_wr"] is not None else -1), reverse=True)
 
-    return {
+    result = {
         "season": season,
         "上位テンプレ詳細": top_template_results,
         "攻めラベル": attack_labels,
         "無視攻め": ignored_labels,
         "テンプレ決定過程": template_judgement
     }
+    _cache_put(_suggest_cache, result_key, version, result, SUGGEST_RESULT_CACHE_SIZE)
+    return result, state
+
+# ========== テンプレ詳細用セッション ==========
+# 提案のときの集計（攻めごとのテンプレ集計・出場数とその版）をしばらく取っておき、
+# 決定過程の表からのテンプレ詳細はピック（キャラ・SPの選び方）だけで返す。
+# 行列は持たず、詳細のときにストアがまだ同じ版なら引き直して使う。プロセス内に持つだけなので、
+# 別のワーカーに来た要求・期限切れ・版が進んだときは suggest_team_for_template で作り直す
+_sessions = OrderedDict()   # セッションID -> {"expires", "state"}（古い順）
+_sessions_lock = threading.Lock()
+
+def open_suggest_session(attacks=None, season=None, strict_pos=False):
+    """suggest_defense_teams の結果と、テンプレ詳細（template_detail_from_session）用のセッションID"""
+    result, state = _suggest_defense_teams(attacks, season, strict_pos, with_state=True)
+    handle = uuid.uuid4().hex
+    now = time.time()
+    with _sessions_lock:
+        _sessions[handle] = {"expires": now + SUGGEST_SESSION_TTL, "state": state}
+        while len(_sessions) > SUGGEST_SESSION_MAX or next(iter(_sessions.values()))["expires"] < now:
+            _sessions.popitem(last=False)
+    return result, handle
+
+def template_detail_from_session(handle, template_tags, attacks=None, season=None, strict_pos=False):
+    """
+    セッションの集計から任意テンプレの編成案（suggest_team_for_template と同じ形）。
+    セッションが無い・期限切れ・条件（攻め・シーズン・モード）が提案のときと違う・
+    ストアの版が進んでいるなら None
+    """
+    with _sessions_lock:
+        session = _sessions.get(handle)
+    if session is None or session["expires"] < time.time():
+        return None
+    state = session["state"]
+    if state["conditions"] != (season, bool(strict_pos), tuple(tuple(a) for a in attacks or [])):
+        return None
+    template_tags = _to_native_tagset(template_tags)
+    if not template_tags:
+        # テンプレ外の行（ID 0）は提案の集計に入っていない
+        return None
+    store = get_season_store(season)
+    striker_master = load_striker_master()
+    store.refresh_templates()
+    engine = _ENGINES[state["engine"]](store, striker_master)
+    if engine.version != state["version"]:
+        return None
+    per_attack = state["template_table"].get(template_tags, {})
+    parts = [per_attack[idx] for idx in sorted(per_attack)]
+    picked_strikers, picked_sp, sp_detail = _template_picks(
+        engine, template_tags, parts, state["global_striker_counts"], state["global_sp_counts"])
+    return {
+        "テンプレタグ": template_tags,
+        "ピックキャラ": picked_strikers,
+        "SP案": picked_sp,
+        "SP詳細": sp_detail
+    }
 
 # ▼▼▼ 任意テンプレ（タグセット）での編成案を返す関数（API用）
+def _to_native_tagset(tags):
+    return tuple((int(tag[0]), bool(tag[1])) for tag in tags)
+
 def suggest_team_for_template(template_tags, attacks=None, season=None, strict_pos=False):
     """
     任意テンプレ（タグセット）に対して、攻め編成・シーズン・モードを考慮した
     キャラ・SP案（ピックキャラ/SP/詳細）を返す
     """
     # --- 修正: 受信データの型を必ず tuple(int, bool)にする ---
-    def to_native_tagset(tags):
-        return tuple((int(tag[0]), bool(tag[1])) for tag in tags)
-    template_tags = to_native_tagset(template_tags)
+    template_tags = _to_native_tagset(template_tags)
 
     FORCED_SP = SUGGEST_CONFIG["FORCED_SP"]
     CHAR_MIN_GAMES = SUGGEST_CONFIG["CHAR_MIN_GAMES"]
     PRIOR_GAMES = SUGGEST_CONFIG["PRIOR_GAMES"]
 
-    records = load_battlelog(season)
+    store = get_season_store(season)
     striker_master = load_striker_master()
-    global_striker_counts = get_global_counts(records, [f"D{i+1}" for i in range(4)])
-    global_sp_counts = get_global_counts(records, ["DSP1", "DSP2"])
+    store.refresh_templates()
+    # 出場数はストアが取り込み時に数えているものを使う（全件を数え直さない）
+    global_striker_counts = store.usage_counts("defense", "striker")
+    global_sp_counts = store.usage_counts("defense", "sp")
 
-    # 任意テンプレの母集団をつくる
+    # 任意テンプレの母集団をつくる（防衛側4枠のテンプレIDが一致する行。空のタグセットはテンプレ外の行）
+    template_id = template_registry.id_of(template_tags) if template_tags else 0
     filtered_records = []
     if attacks:
         for attack in attacks:
-            filtered = filter_records_by_attack_strikers(records, attack, strict_pos)
-            for r in filtered:
-                # 防衛側4枠のタグがテンプレ一致
-                tags = []
-                for i in range(4):
-                    info = striker_master.get(r.get(f"D{i+1}", ""))
-                    if not info:
-                        tags = []
-                        break
-                    tags.append((info["射程"], info["遮蔽"]))
-                if tuple(tags) == template_tags:
-                    filtered_records.append(r)
+            # 全行は全枠空欄の攻めがあるときだけ取る
+            filtered = filter_records_by_attack_strikers(store, None, attack, strict_pos)
+            filtered_records.extend(r for r in filtered if r.d_tpl == template_id)
     else:
         # 攻め編成条件がない場合は全件
-        for r in records:
-            tags = []
-            for i in range(4):
-                info = striker_master.get(r.get(f"D{i+1}", ""))
-                if not info:
-                    tags = []
-                    break
-                tags.append((info["射程"], info["遮蔽"]))
-            if tuple(tags) == template_tags:
-                filtered_records.append(r)
+        filtered_records = [r for r in store.rows if r.d_tpl == template_id]
 
     tpl_data = {"rows": filtered_records}
     picked_strikers = pick_strikers_for_template(
@@ -397,3 +607,26 @@ if __name__ == "__main__":
     print("\n単一テンプレ案：")
     tpl_example = ((650, False), (350, False), (350, False), (750, False))
     pprint(suggest_team_for_template(tpl_example, attacks=atk_sample, season=None, strict_pos=False))
+
+    # 行列版と行ループ版の結果が一致するか（記録にある攻め編成をいくつか組み合わせて比べる）
+    print("\nエンジン比較：")
+    recent = [r.team("attack") for r in load_battlelog()[:200]]
+    attack_sets = [atk_sample, [["", "", "", "", "", ""]]]
+    attack_sets += [recent[i:i + 5] for i in range(0, len(recent), 5)]
+    attack_sets += [[a[:2] + ["", ""] + a[4:] for a in recent[i:i + 3]] for i in range(0, 60, 3)]
+    mismatches = 0
+    elapsed = {"python": 0.0, "numpy": 0.0}
+    for attacks in attack_sets:
+        for strict_pos in (False, True):
+            results = {}
+            for engine in elapsed:
+                t0 = time.perf_counter()
+                results[engine] = suggest_defense_teams(attacks, season=None, strict_pos=strict_pos, engine=engine)
+                elapsed[engine] += time.perf_counter() - t0
+            if results["python"] != results["numpy"]:
+                mismatches += 1
+                print("不一致:", attacks, strict_pos)
+    n_runs = len(attack_sets) * 2
+    print(f"{n_runs}通り中 不一致 {mismatches}件")
+    for engine, sec in elapsed.items():
+        print(f"  {engine}: 平均 {sec / n_runs * 1000:.1f}ms")
@@ -0,0 +1,136 @@
+# google_clients.py
+# Google API クライアントの共有
+# 認証情報・HTTPセッション（keep-alive）・開いたスプレッドシート/ワークシートをプロセス内で使い回す
+# シートを読み書きするときは with_worksheet を通す（古くなったハンドルを捨てて開き直す）
+import os
+import json
+import time
+import datetime
+import threading
+
+import gspread
+import requests
+from google.oauth2.service_account import Credentials
+from google.auth.transport.requests import Request, AuthorizedSession
+
+SHEETS_SCOPES = ["https://www.googleapis.com/auth/spreadsheets"]
+SCRIPT_SCOPES = ["https://www.googleapis.com/auth/script.external_request"]
+
+_TOKEN_REFRESH_MARGIN = 5 * 60   # 有効期限のこの秒数前に先回りで更新
+_TOKEN_CHECK_INTERVAL = 60       # 期限チェックの間隔（秒）
+
+_lock = threading.RLock()
+_sheets = {"creds": None, "client": None}
+_script = {"creds": None, "session": None}
+_token_http = requests.Session()   # トークン更新用（接続を使い回す）
+_spreadsheets = {}   # spreadsheet_id -> Spreadsheet
+_worksheets = {}     # (spreadsheet_id, sheet_name) -> Worksheet
+
+# ========== トークン ==========
+
+def _needs_refresh(creds):
+    if not creds.token or creds.expiry is None:
+        return True
+    # google-auth の expiry はUTCのnaive datetime
+    remaining = (creds.expiry - datetime.datetime.utcnow()).total_seconds()
+    return remaining < _TOKEN_REFRESH_MARGIN
+
+def _refresh_tokens():
+    with _lock:
+        targets = [c for c in (_sheets["creds"], _script["creds"]) if c is not None]
+    for creds in targets:
+        if _needs_refresh(creds):
+            try:
+                creds.refresh(Request(_token_http))
+            except Exception as e:
+                print(f"トークン更新失敗: {e}")
+
+def _token_scheduler():
+    while True:
+        time.sleep(_TOKEN_CHECK_INTERVAL)
+        _refresh_tokens()
+
+# ========== スプレッドシート ==========
+
+def get_sheets_client():
+    with _lock:
+        if _sheets["client"] is None:
+            creds_path = os.environ.get("GOOGLE_APPLICATION_CREDENTIALS")
+            if not creds_path:
+                raise Exception("GOOGLE_APPLICATION_CREDENTIALS environment variable is not set.")
+            creds = Credentials.from_service_account_file(creds_path, scopes=SHEETS_SCOPES)
+            _sheets["creds"] = creds
+            _sheets["client"] = gspread.authorize(creds)
+        return _sheets["client"]
+
+def get_spreadsheet(spreadsheet_id):
+    with _lock:
+        sh = _spreadsheets.get(spreadsheet_id)
+        if sh is None:
+            sh = get_sheets_client().open_by_key(spreadsheet_id)
+            _spreadsheets[spreadsheet_id] = sh
+        return sh
+
+def get_worksheet(spreadsheet_id, sheet_name):
+    """開いたワークシートはキャッシュして、以降のメタデータ取得を省く"""
+    key = (spreadsheet_id, sheet_name)
+    with _lock:
+        ws = _worksheets.get(key)
+        if ws is None:
+            ws = get_spreadsheet(spreadsheet_id).worksheet(sheet_name)
+            _worksheets[key] = ws
+        return ws
+
+def invalidate_worksheet(spreadsheet_id, sheet_name):
+    """シート名変更・削除などでハンドルが古くなったときに捨てる（スプレッドシートも開き直す）"""
+    with _lock:
+        _worksheets.pop((spreadsheet_id, sheet_name), None)
+        _spreadsheets.pop(spreadsheet_id, None)
+
+# 開いたハンドルが古くなっている（シートの作り直し・権限変更など）ときに出るエラー
+_STALE_HANDLE_ERRORS = (gspread.exceptions.APIError, gspread.exceptions.WorksheetNotFound)
+
+def with_worksheet(spreadsheet_id, sheet_name, fn, retry=True):
+    """
+    fn(ワークシート) の結果を返す。
+    APIError・WorksheetNotFound ならキャッシュしたハンドルを捨て、開き直して1回だけやり直す。
+    二重に反映されうる書き込みは retry=False（ハンドルを捨ててそのまま投げる。次の呼び出しで開き直す）
+    """
+    try:
+        return fn(get_worksheet(spreadsheet_id, sheet_name))
+    except _STALE_HANDLE_ERRORS as e:
+        invalidate_worksheet(spreadsheet_id, sheet_name)
+        if not retry:
+            raise
+        print(f"[{sheet_name}]シートを開き直して再試行します: {e}")
+    return fn(get_worksheet(spreadsheet_id, sheet_name))
+
+# ========== Apps Script ==========
+
+def _get_script_session():
+    with _lock:
+        if _script["session"] is None:
+            # 環境変数 'credentials' にサービスアカウントキー JSON 全文を設定している前提
+            cred_cont = os.environ.get("credentials")
+            if not cred_cont:
+                raise Exception("Environment variable 'credentials' is not set or empty.")
+            creds = Credentials.from_service_account_info(json.loads(cred_cont), scopes=SCRIPT_SCOPES)
+            _script["creds"] = creds
+            _script["session"] = AuthorizedSession(creds)
+        return _script["session"]
+
+def call_apps_script(function="main"):
+    """
+    Apps Script（しらす式変換）の呼び出し。
+    GASエンドポイントURLは環境変数「GAS_SCRIPT_URL」から取得
+    """
+    url = os.environ.get("GAS_SCRIPT_URL")
+    if not url:
+        raise Exception("GAS_SCRIPT_URL environment variable is not set.")
+    session = _get_script_session()
+    resp = session.post(url, json={"function": function})
+    if resp.status_code != 200:
+        raise Exception(f"Error calling Apps Script: {resp.status_code} {resp.text}")
+    return resp.text
+
+threading.Thread(target=_token_scheduler, daemon=True).start()
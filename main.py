@@ -4,9 +4,9 @@ import datetime
 import numpy as np
 import requests  # URLからの画像ダウンロード用
 import subprocess
-from google.oauth2.service_account import Credentials
-from google.auth.transport.requests import Request
 from spreadsheet_manager import update_spreadsheet
+from character_registry import char_registry
+from google_clients import call_apps_script  # しらす式変換（認証・接続は共有）
 from config import CURRENT_SEASON  # ← season対応
 
 # 日本時間 (JST) 定義
@@ -50,6 +50,18 @@ def clean_text(text):
     """
     return "".join(text.replace('*','').replace('\n','').replace('\r','').split())
 
+def correct_char_name(text):
+    """
+    OCRで読んだキャラ名を、編集距離で最も近いマスタ名に寄せる（1つに決まらなければそのまま）。
+    確認画面で手直しできるので、ここでは候補を入れておくだけ
+    """
+    if not text:
+        return text
+    name = char_registry.nearest_master_name(text)
+    if name and name != text:
+        print(f"キャラ名を補正: {text} → {name}")
+    return name or text
+
 def preprocess_image(image_path):
     """
     画像の前処理：グレースケール→二値化→最大輪郭でクロップ→1611×696にリサイズ。
@@ -190,40 +202,14 @@ def process_image(image_path, season=None):
         atk_chars  = [ocr_region(img, r) for r in right_regs]
         def_chars  = [ocr_region(img, r) for r in left_regs]
 
+    atk_chars = [correct_char_name(c) for c in atk_chars]
+    def_chars = [correct_char_name(c) for c in def_chars]
+
     # 日付・結果行組立
     date_str = datetime.datetime.now(JST).strftime("%Y-%m-%d %H:%M:%S")
     row = [date_str, atk_name, atk_res] + atk_chars + [""] + [def_name, def_res] + def_chars
     return row
 
-def call_apps_script():
-    """
-    Apps Script 呼び出し。サービスアカウント認証で token を取得し POST。
-    GASエンドポイントURLは環境変数「GAS_SCRIPT_URL」から取得
-    """
-    cred_cont = os.environ.get("credentials")
-    if not cred_cont:
-        raise Exception("Environment variable 'credentials' is not set or empty.")
-    tmp = "/tmp/google_credentials.json"
-    with open(tmp, "w") as f:
-        f.write(cred_cont)
-
-    SCOPES = ['https://www.googleapis.com/auth/script.external_request']
-    creds = Credentials.from_service_account_file(tmp, scopes=SCOPES)
-    if not creds.valid or creds.expired:
-        creds.refresh(Request())
-    token = creds.token
-
-    url = os.environ.get("GAS_SCRIPT_URL")  # ← 環境変数から取得
-    if not url:
-        raise Exception("GAS_SCRIPT_URL environment variable is not set.")
-    payload = {'function': 'main'}
-    headers = {'Authorization': f'Bearer {token}', 'Content-Type': 'application/json'}
-
-    resp = requests.post(url, headers=headers, json=payload)
-    if resp.status_code != 200:
-        raise Exception(f"Error calling Apps Script: {resp.status_code} {resp.text}")
-    return resp.text
-
 def main():
     """
     CLI実行用。引数に画像パスを渡すと、一連の処理を行う。
@@ -0,0 +1,75 @@
+# season_shards.py
+# シーズン別ストアの読み込み管理
+# 必要になったシーズンだけ読み込み、メモリ予算を超えたら最近使っていないものから捨てる。
+# 現行シーズンなど固定指定のものは捨てない。複数シーズンにまたがる集計は fan_out で各シーズンに投げる
+import threading
+from collections import OrderedDict
+
+class SeasonShardManager:
+    """
+    loader(season) -> ストア（approx_bytes() を持つ）。
+    読み込み中は同じシーズンへの要求だけ待たせ、他のシーズンの参照は止めない
+    """
+    def __init__(self, loader, pinned=(), budget_bytes=None):
+        self._loader = loader
+        self._pinned = set(pinned)
+        self._budget = budget_bytes
+        self._shards = OrderedDict()   # season -> store（古く使った順）
+        self._loading = {}             # season -> Lock
+        self._lock = threading.Lock()
+
+    def get(self, season):
+        with self._lock:
+            store = self._shards.get(season)
+            if store is not None:
+                self._shards.move_to_end(season)
+                return store
+            load_lock = self._loading.setdefault(season, threading.Lock())
+        with load_lock:
+            with self._lock:
+                store = self._shards.get(season)
+                if store is not None:
+                    return store
+            store = self._loader(season)
+            with self._lock:
+                self._shards[season] = store
+                self._loading.pop(season, None)
+                self._evict_over_budget(keep=season)
+        return store
+
+    def peek(self, season):
+        """読み込み済みなら返す（読み込みも順番の更新もしない）"""
+        return self._shards.get(season)
+
+    def loaded_seasons(self):
+        with self._lock:
+            return list(self._shards)
+
+    def approx_bytes(self):
+        with self._lock:
+            return sum(store.approx_bytes() for store in self._shards.values())
+
+    def evict(self, season):
+        with self._lock:
+            if self._shards.pop(season, None) is not None:
+                print(f"シーズン{season}のストアを解放しました")
+
+    def _evict_over_budget(self, keep):
+        # 呼び出し側で _lock を保持していること
+        if self._budget is None:
+            return
+        total = sum(store.approx_bytes() for store in self._shards.values())
+        for season in list(self._shards):
+            if total <= self._budget:
+                break
+            if season in self._pinned or season == keep:
+                continue
+            total -= self._shards.pop(season).approx_bytes()
+            print(f"メモリ予算超過のためシーズン{season}のストアを解放しました")
+
+    def fan_out(self, seasons, fn):
+        """各シーズンのストアに fn(season, store) を順に適用して {season: 結果} を返す"""
+        results = {}
+        for season in seasons:
+            results[season] = fn(season, self.get(season))
+        return results
@@ -0,0 +1,119 @@
+# shared_state.py
+# gunicorn の複数ワーカー（別プロセス）間で cache/ 以下を共有するための仕組み
+# ・ファイルロック（書き込みの排他）
+# ・代表ワーカーの選出（シート取得・畳み込みなどの定期処理は1プロセスだけが行う）
+# ・共有JSONファイル（マスタなど）の保存と変更検知
+import os
+import json
+import threading
+import contextlib
+
+try:
+    import fcntl
+except ImportError:
+    # Windows など。単一プロセスで動かす前提でロックは何もしない
+    fcntl = None
+
+from config import CACHE_DIR
+
+_held = threading.local()     # スレッドごとに保持中のロック名 -> 深さ（同じロックの入れ子を許す）
+_leader = {"fh": None}
+_leader_lock = threading.Lock()
+
+def _get_lock_filepath(name):
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    return os.path.join(CACHE_DIR, f"{name}.lock")
+
+# ===== ファイルロック =====
+
+@contextlib.contextmanager
+def file_lock(name):
+    """
+    プロセス間の排他ロック（cache/{name}.lock に flock）。
+    開くたびに別のファイル記述になるので、同じプロセスの別スレッド同士でも排他になる。
+    同じスレッドでの入れ子は素通しする
+    """
+    depth = getattr(_held, "locks", None)
+    if depth is None:
+        depth = _held.locks = {}
+    if depth.get(name):
+        depth[name] += 1
+        try:
+            yield
+        finally:
+            depth[name] -= 1
+        return
+    with open(_get_lock_filepath(name), "a") as f:
+        if fcntl is not None:
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+        depth[name] = 1
+        try:
+            yield
+        finally:
+            depth[name] = 0
+            if fcntl is not None:
+                fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+
+# ===== 代表ワーカー =====
+
+def is_leader():
+    """
+    定期処理を担当するワーカーか。最初にロックを取れたプロセスが担当し、
+    担当プロセスが落ちるとロックが外れるので、次に呼んだ別のプロセスが引き継ぐ
+    """
+    if _leader["fh"] is not None:
+        return True
+    with _leader_lock:
+        if _leader["fh"] is not None:
+            return True
+        if fcntl is None:
+            _leader["fh"] = True
+            return True
+        fh = open(_get_lock_filepath("leader"), "a")
+        try:
+            fcntl.flock(fh.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            fh.close()
+            return False
+        _leader["fh"] = fh
+    print(f"定期処理の担当ワーカーになりました（pid={os.getpid()}）")
+    return True
+
+# ===== 共有JSONファイル =====
+
+def get_shared_filepath(name):
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    return os.path.join(CACHE_DIR, f"{name}.json")
+
+def file_signature(path):
+    """変更検知用（存在しなければ None）。stat 1回だけなので毎リクエスト呼んでよい"""
+    try:
+        st = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return (st.st_ino, st.st_mtime_ns, st.st_size)
+
+def load_shared_json(name, default=None):
+    path = get_shared_filepath(name)
+    if not os.path.exists(path):
+        return default
+    with open(path, "r", encoding="utf-8") as f:
+        try:
+            return json.load(f)
+        except Exception as e:
+            print(f"共有ファイル読込失敗: {path}: {e}")
+            return default
+
+def save_shared_json(name, data, durable=True):
+    """
+    一時ファイルに書いてから置き換え（読み手が書きかけを読まないように）。
+    durable=False なら fsync しない（電源断で失われてもよい・作り直せるもの用）
+    """
+    path = get_shared_filepath(name)
+    tmp = f"{path}.{os.getpid()}.tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(data, f, ensure_ascii=False)
+        if durable:
+            f.flush()
+            os.fsync(f.fileno())
+    os.replace(tmp, path)
@@ -1,72 +1,73 @@
 import os
-import gspread
-from google.oauth2.service_account import Credentials
 import threading
 import time
-import json
-
-from config import CURRENT_SEASON, SEASON_LIST, CACHE_DIR
+import heapq
+import hashlib
+from collections import OrderedDict
+
+from config import (
+    CURRENT_SEASON, SEASON_LIST, SEASON_CACHE_MEMORY_MB, SEARCH_PAGE_SIZE, SEARCH_RESULT_CACHE_SIZE,
+    COUNTER_STATS_TOP_K, COUNTER_STATS_PRIOR_GAMES, FUZZY_QUERY_MAX_EDITS,
+)
+from google_clients import with_worksheet
+from battlelog_cache import (
+    save_output_cache,
+    load_season_snapshot,
+    append_journal,
+    read_journal_since,
+    read_stamp,
+    load_sync_state,
+    save_sync_state,
+)
+from shared_state import file_lock, is_leader, file_signature, get_shared_filepath, load_shared_json, save_shared_json
+from battlelog_store import (
+    SeasonStore, parse_timestamp, RECENT_LOSERS_SIZE, FLAG_LIMITED, FLAG_ATK_WIN, FLAG_DEF_WIN, SIDE_SLOT_KEYS
+)
+from season_shards import SeasonShardManager
+from character_registry import char_registry
 
 # ========== アップロード時スプレッドシート追加 ==========
 
-def update_spreadsheet(data, season=None):
-    SCOPES = ["https://www.googleapis.com/auth/spreadsheets"]
-    creds_path = os.environ.get("GOOGLE_APPLICATION_CREDENTIALS")
-    if not creds_path:
-        raise Exception("GOOGLE_APPLICATION_CREDENTIALS environment variable is not set.")
-    creds = Credentials.from_service_account_file(creds_path, scopes=SCOPES)
-    client = gspread.authorize(creds)
+def _write_input_worksheet(season_key, fn):
     SPREADSHEET_ID = os.environ.get("BATTLELOG_SHEET_ID")
     if not SPREADSHEET_ID:
         raise Exception("BATTLELOG_SHEET_ID environment variable is not set.")
+    # 挿入は二重にならないようやり直さない（失敗はアップロードキューが後で送り直す）
+    return with_worksheet(SPREADSHEET_ID, f"変換前_{season_key}", fn, retry=False)
+
+def update_spreadsheet(data, season=None):
     season_key = season or CURRENT_SEASON
-    sheet_name = f"変換前_{season_key}"
-    worksheet = client.open_by_key(SPREADSHEET_ID).worksheet(sheet_name)
-    worksheet.insert_row(data, 3)
-    print(f"[{sheet_name}]シートにスプレッドシートを更新しました:", data)
+    _write_input_worksheet(season_key, lambda ws: ws.insert_row(data, 3))
+    print(f"[変換前_{season_key}]シートにスプレッドシートを更新しました:", data)
+
+def update_spreadsheet_rows(rows, season=None):
+    """
+    複数行をまとめて3行目に挿入（1回のAPI呼び出し）。
+    rows は古い順。1行ずつ update_spreadsheet した場合と同じ並び（最新が3行目）になる
+    """
+    if not rows:
+        return
+    season_key = season or CURRENT_SEASON
+    _write_input_worksheet(season_key, lambda ws: ws.insert_rows(list(reversed(rows)), 3))
+    print(f"[変換前_{season_key}]シートに{len(rows)}行まとめて追加しました")
 
 # ===== シーズンごとのキャッシュ管理 =====
+# 保存形式（スナップショット＋追記ジャーナル）は battlelog_cache 側で管理
+# 通常は refresh_output_sheet_cache の差分同期のみ。全件取得は repair_output_sheet_cache（末尾の repair コマンド）で明示的に行う
+# どちらもシーズンごとのプロセス間ロック下で行う（複数ワーカーが同じシートを同時に取りに行かない）
 
-def get_cache_filepath(season):
-    os.makedirs(CACHE_DIR, exist_ok=True)
-    return os.path.join(CACHE_DIR, f"{season}.json")
-
-def save_output_cache(season, data):
-    path = get_cache_filepath(season)
-    with open(path, "w", encoding="utf-8") as f:
-        json.dump(data, f, ensure_ascii=False, indent=2)
-    print(f"キャッシュ保存完了: {path}（{len(data)}件）")
-
-def load_output_cache(season):
-    path = get_cache_filepath(season)
-    if not os.path.exists(path):
-        print(f"キャッシュファイルなし: {path}")
-        return []
-    with open(path, "r", encoding="utf-8") as f:
-        try:
-            data = json.load(f)
-            return data
-        except Exception as e:
-            print(f"キャッシュ読込失敗: {e}")
-            return []
+_SYNC_WINDOW = 50          # 差分同期で最初に読む行数（足りなければ4倍ずつ広げる）
+_SYNC_MAX_WINDOW = 3200    # ここまで遡っても前回位置が見つからなければ修復が必要
 
-def refresh_output_sheet_cache(season=None):
+def _output_source_sheets(season_key):
     """
-    限定版：限定DB「出力結果_シーズン名」と「一般版から転送」シート両方から取得し
-    source="限定"/"一般"を付けてマージ、日付順でまとめてキャッシュ保存
+    出力結果の取得元シート [(source, spreadsheet_id, sheet_name), ...]
+    どちらも2行目がヘッダー、3行目が最新（新しい行は上に挿入される）前提
     """
-    SCOPES = ["https://www.googleapis.com/auth/spreadsheets"]
-    creds_path = os.environ.get("GOOGLE_APPLICATION_CREDENTIALS")
-    if not creds_path:
-        raise Exception("GOOGLE_APPLICATION_CREDENTIALS environment variable is not set.")
-    creds = Credentials.from_service_account_file(creds_path, scopes=SCOPES)
-    client = gspread.authorize(creds)
-
     # 限定DBのスプレッドシートID
     LIMITED_OUTPUT_SHEET_ID = os.environ.get("OUTPUT_SHEET_ID")
     if not LIMITED_OUTPUT_SHEET_ID:
         raise Exception("OUTPUT_SHEET_ID environment variable is not set.")
-    season_key = season or CURRENT_SEASON
 
     # 一般DBの「転送」シートID（＝同じファイル内 or 環境変数で取得可）
     GENERAL_TRANSFER_SHEET_ID = os.environ.get("GENERAL_TRANSFER_SHEET_ID") \
@@ -74,70 +75,212 @@ def refresh_output_sheet_cache(season=None):
 
     # 1. 限定データ
     limited_sheet_name = f"出力結果_{season_key}"
-    limited_ws = client.open_by_key(LIMITED_OUTPUT_SHEET_ID).worksheet(limited_sheet_name)
-    limited_records = get_sheet_records_with_empty_safe(limited_ws, head_row=2)
-    for row in limited_records:
-        row["source"] = "限定"
-
-    # 2. 一般版から転送
-    try:
-        general_ws = client.open_by_key(GENERAL_TRANSFER_SHEET_ID).worksheet("一般版から転送")
-        general_records = get_sheet_records_with_empty_safe(general_ws, head_row=2)
-        for row in general_records:
-            row["source"] = "一般"
-    except Exception as e:
-        print(f"一般版から転送シートの取得失敗: {e}")
-        general_records = []
+    # 2. 一般版から転送（取得に失敗しても限定データだけで続ける）
+    return [
+        ("限定", LIMITED_OUTPUT_SHEET_ID, limited_sheet_name),
+        ("一般", GENERAL_TRANSFER_SHEET_ID, "一般版から転送"),
+    ]
+
+def _row_values_fingerprint(values):
+    # シートAPIは末尾の空セルを省くので揃えてから比較
+    values = list(values)
+    while values and values[-1] == "":
+        values.pop()
+    return hashlib.sha1("\t".join(values).encode("utf-8")).hexdigest()
+
+def repair_output_sheet_cache(season=None):
+    """
+    全件再構築（修復用・キャッシュが無いときの初回構築用）。
+    限定DB「出力結果_シーズン名」と「一般版から転送」シート両方を全件取得し
+    source="限定"/"一般"を付けてマージ、日付順でまとめてキャッシュ保存
+    """
+    season_key = season or CURRENT_SEASON
+    with file_lock(f"{season_key}.sync"):
+        return _repair_output_sheet_cache(season_key)
 
-    # 3. 日付順に結合（新しい順）へ
-    def parse_datetime(row):
-        import datetime
-        v = row.get("日付", "")
+def _repair_output_sheet_cache(season_key):
+    all_data = []
+    sync_state = {}
+    for source, sheet_id, sheet_name in _output_source_sheets(season_key):
         try:
-            return datetime.datetime.strptime(v, "%Y-%m-%d %H:%M:%S")
-        except Exception:
-            return datetime.datetime.min
+            rows = with_worksheet(sheet_id, sheet_name, lambda ws: ws.get_all_values())
+        except Exception as e:
+            if source == "限定":
+                raise
+            print(f"{source}シートの取得失敗: {e}")
+            continue
+        records = _records_from_values(_uniq_headers(rows[1]), rows[2:])
+        for row in records:
+            row["source"] = source
+        all_data.extend(records)
+        # 次回の差分同期は、この時点の先頭行より上だけを読む
+        sync_state[source] = {
+            "anchor": _row_values_fingerprint(rows[2]) if len(rows) > 2 else None,
+            "rows": len(records),
+        }
 
-    all_data = limited_records + general_records
-    all_data.sort(key=parse_datetime, reverse=True)
+    # 3. 日付順に結合（新しい順）へ
+    all_data.sort(key=lambda row: parse_timestamp(row.get("日付", "")), reverse=True)
 
     save_output_cache(season_key, all_data)
+    save_sync_state(season_key, sync_state)
+    # 常駐ストアが読込済みなら世代の変化を見て読み直す（他のワーカーも次の参照時に読み直す）
+    store = _season_shards.peek(season_key)
+    if store is not None:
+        _catch_up_store(season_key, store)
     return all_data
 
-def get_output_sheet_cache(season=None):
+def _fetch_new_sheet_rows(ws, anchor):
+    """
+    前回同期時の先頭行(anchor)より上にある新しい行だけを取得して (headers, rows) を返す。
+    ウィンドウ内に前回位置が見つからなければ None（修復が必要）
+    """
+    window = _SYNC_WINDOW
+    while True:
+        header_range, body = ws.batch_get(["2:2", f"3:{2 + window}"])
+        fingerprints = [_row_values_fingerprint(v) for v in body]
+        headers = _uniq_headers(header_range[0] if header_range else [])
+        if anchor in fingerprints:
+            return headers, body[:fingerprints.index(anchor)]
+        if len(body) < window:
+            # シート末尾まで読んだ。前回が空シートなら全部が新しい行
+            return (headers, body) if anchor is None else None
+        if window >= _SYNC_MAX_WINDOW:
+            return None
+        window *= 4
+
+def refresh_output_sheet_cache(season=None):
+    """
+    差分同期：各ソースシートの前回位置より新しい行だけ取得してジャーナル＋ストアへ追加する。
+    前回位置が無ければ初回構築、見つからなければ何もしない（repair_output_sheet_cache ／ repair コマンドで修復）。
+    追加した件数を返す
+    """
     season_key = season or CURRENT_SEASON
-    data = load_output_cache(season_key)
-    if not data:
-        print(f"{season_key}のキャッシュが無いので再生成します")
-        data = refresh_output_sheet_cache(season_key)
-    return data
+    # 初回構築が要る場合はロックの外で済ませておく
+    store = get_season_store(season_key)
+    with file_lock(f"{season_key}.sync"):
+        sync_state = load_sync_state(season_key)
+        if not sync_state:
+            print(f"{season_key}の同期位置が無いので全件構築します")
+            return len(_repair_output_sheet_cache(season_key))
+        # 他のワーカーがAPI経由で追加した行も重複判定に使う
+        _catch_up_store(season_key, store)
+        return _refresh_output_sheet_cache(season_key, store, sync_state)
+
+def _refresh_output_sheet_cache(season_key, store, sync_state):
+    added = 0
+    for source, sheet_id, sheet_name in _output_source_sheets(season_key):
+        state = sync_state.get(source) or {"anchor": None, "rows": 0}
+        try:
+            result = with_worksheet(sheet_id, sheet_name, lambda ws: _fetch_new_sheet_rows(ws, state["anchor"]))
+        except Exception as e:
+            if source == "限定":
+                raise
+            print(f"{source}シートの取得失敗: {e}")
+            continue
+        if result is None:
+            print(f"[{season_key}/{source}] 前回の同期位置が見つかりません。python spreadsheet_manager.py repair {season_key} で再構築してください")
+            continue
+        headers, new_values = result
+        if not new_values:
+            continue
+        records = _records_from_values(headers, new_values)
+        # シートは新しい順なので古い方から取り込む
+        for row in reversed(records):
+            row["source"] = source
+            # API経由で先に取り込まれている対戦は飛ばす
+            if store.has_row(row):
+                continue
+            append_journal(season_key, row)
+            _catch_up_store(season_key, store)
+            added += 1
+        sync_state[source] = {
+            "anchor": _row_values_fingerprint(new_values[0]),
+            "rows": state["rows"] + len(new_values),
+        }
+    save_sync_state(season_key, sync_state)
+    print(f"差分同期完了: {season_key}（{added}件追加）")
+    return added
+
+# ===== 常駐シーズンストア =====
+# 検索・防衛提案・トップページは全てここを経由し、リクエストごとにJSONを読み直さない
+# 参照のたびにスタンプ（小さなファイル）を見て、他のワーカーが追記した分だけジャーナルから取り込む
+
+def _load_store(season_key, store):
+    """スナップショット（mmap）＋ジャーナル末尾からストアを作り直し、件数を返す"""
+    tail, snapshot, stamp = load_season_snapshot(season_key)
+    try:
+        store.load(tail, snapshot)
+    finally:
+        if snapshot is not None:
+            snapshot.close()
+    store.applied.update(generation=stamp["generation"], seq=stamp["seq"])
+    return len(store)
+
+def _catch_up_store(season_key, store):
+    applied = store.applied
+    stamp = read_stamp(season_key)
+    if stamp["generation"] == applied["generation"] and stamp["seq"] <= applied["seq"]:
+        return
+    with store.sync_lock:
+        stamp = read_stamp(season_key)
+        if stamp["generation"] != applied["generation"]:
+            print(f"{season_key}のキャッシュが全件更新されたので読み直します")
+            _load_store(season_key, store)
+            return
+        if stamp["seq"] <= applied["seq"]:
+            return
+        records = read_journal_since(season_key, applied["seq"])
+        if records is None or applied["seq"] + len(records) < stamp["seq"]:
+            # 畳み込みで読み落とした分がある
+            print(f"{season_key}のジャーナルを追いきれないので全件読み直します")
+            _load_store(season_key, store)
+            return
+        for seq, row in records:
+            store.add_row(row)
+            applied["seq"] = seq
+
+def _build_season_store(season_key):
+    store = SeasonStore(season_key)
+    if not _load_store(season_key, store):
+        with file_lock(f"{season_key}.sync"):
+            # ロック待ちの間に他のワーカーが作っていればそれを読む
+            if not _load_store(season_key, store):
+                print(f"{season_key}のキャッシュが無いので再生成します")
+                _repair_output_sheet_cache(season_key)
+                _load_store(season_key, store)
+    return store
+
+# 現行シーズンは常駐、過去シーズンは参照されたときに読み込んでメモリ予算内で入れ替える
+_season_shards = SeasonShardManager(
+    _build_season_store,
+    pinned=[CURRENT_SEASON],
+    budget_bytes=SEASON_CACHE_MEMORY_MB * 1024 * 1024,
+)
+
+def get_season_store(season=None):
+    season_key = season or CURRENT_SEASON
+    store = _season_shards.get(season_key)
+    _catch_up_store(season_key, store)
+    return store
+
+def all_season_keys():
+    return [s["key"] for s in SEASON_LIST]
+
+def get_output_sheet_cache(season=None):
+    """互換用：行dictのリスト（新しい順）を返す"""
+    return [row.to_dict() for row in get_season_store(season).rows]
 
 def fetch_latest_output_row_as_dict(season=None):
-    SCOPES = ["https://www.googleapis.com/auth/spreadsheets"]
-    creds_path = os.environ.get("GOOGLE_APPLICATION_CREDENTIALS")
-    if not creds_path:
-        raise Exception("GOOGLE_APPLICATION_CREDENTIALS environment variable is not set.")
-    creds = Credentials.from_service_account_file(creds_path, scopes=SCOPES)
-    client = gspread.authorize(creds)
     SPREADSHEET_ID = os.environ.get("OUTPUT_SHEET_ID")
     if not SPREADSHEET_ID:
         raise Exception("OUTPUT_SHEET_ID environment variable is not set.")
     season_key = season or CURRENT_SEASON
     sheet_name = f"出力結果_{season_key}"
-    worksheet = client.open_by_key(SPREADSHEET_ID).worksheet(sheet_name)
-    headers = worksheet.row_values(2)    # 2行目がヘッダー
-    latest_row = worksheet.row_values(3) # 3行目が最新データ
+    # 2行目がヘッダー、3行目が最新データ
+    headers, latest_row = with_worksheet(SPREADSHEET_ID, sheet_name, lambda ws: (ws.row_values(2), ws.row_values(3)))
 
-    seen = {}
-    uniq_headers = []
-    for h in headers:
-        base = h.strip() if h.strip() else "空欄"
-        count = seen.get(base, 0)
-        if count > 0:
-            uniq_headers.append(f"{base}_{count+1}")
-        else:
-            uniq_headers.append(base)
-        seen[base] = count + 1
+    uniq_headers = _uniq_headers(headers)
 
     row_dict = {}
     for idx, key in enumerate(uniq_headers):
@@ -146,15 +289,21 @@ def fetch_latest_output_row_as_dict(season=None):
 
 def append_battlelog_row_from_api(row_dict, season=None, source="一般"):
     season_key = season or CURRENT_SEASON
-    data = get_output_sheet_cache(season_key)
+    # キャッシュ未生成ならここでシートから全件取得される
+    store = get_season_store(season_key)
     row_dict["source"] = source
-    data.insert(0, row_dict)
-    save_output_cache(season_key, data)
+    # 全件を書き直さず、ジャーナルに1行追記してストアへその場で反映
+    append_journal(season_key, row_dict)
+    _catch_up_store(season_key, store)
     print(f"API経由で{source}データをキャッシュ[{season_key}]に追加: {row_dict}")
 
 # ========== キャラデータ（STRIKER/SPECIAL）6時間キャッシュ ==========
+# シートから取り直すのは代表ワーカーだけ。結果は cache/masters.json に書き出し、
+# 他のワーカーはファイルの変更を見て読み込む
 
 _CHAR_CACHE_LIFETIME = 6 * 60 * 60  # 6時間（秒）
+_MASTERS_CHECK_INTERVAL = 60        # 期限切れ・他ワーカーの更新を確認する間隔（秒）
+_masters_file = {"signature": None}
 
 _striker_cache = {
     "data": None,
@@ -169,17 +318,10 @@ def _update_striker_cache():
     global _striker_cache
     try:
         print("STRIKERキャッシュを更新します...")
-        SCOPES = ["https://www.googleapis.com/auth/spreadsheets"]
-        creds_path = os.environ.get("GOOGLE_APPLICATION_CREDENTIALS")
-        if not creds_path:
-            raise Exception("GOOGLE_APPLICATION_CREDENTIALS environment variable is not set.")
-        creds = Credentials.from_service_account_file(creds_path, scopes=SCOPES)
-        client = gspread.authorize(creds)
         SPREADSHEET_ID = os.environ.get("CHARDATA_SHEET_ID")
         if not SPREADSHEET_ID:
             raise Exception("CHARDATA_SHEET_ID environment variable is not set.")
-        worksheet = client.open_by_key(SPREADSHEET_ID).worksheet("STRIKER")
-        records = worksheet.get_all_records()
+        records = with_worksheet(SPREADSHEET_ID, "STRIKER", lambda ws: ws.get_all_records())
         char_list = []
         for row in records:
             name = row.get("キャラ名")
@@ -205,10 +347,12 @@ def _update_striker_cache():
                     "射程": s_range,
                     "遮蔽": shield,
                 })
+        char_registry.register_master_names(c["name"] for c in char_list)
         _striker_cache = {
             "data": char_list,
             "timestamp": time.time()
         }
+        _save_master("striker", _striker_cache)
         print(f"STRIKERキャッシュ更新完了（{len(char_list)}件）")
     except Exception as e:
         print(f"STRIKERキャッシュ更新失敗: {e}")
@@ -217,91 +361,157 @@ def _update_special_cache():
     global _special_cache
     try:
         print("SPECIALキャッシュを更新します...")
-        SCOPES = ["https://www.googleapis.com/auth/spreadsheets"]
-        creds_path = os.environ.get("GOOGLE_APPLICATION_CREDENTIALS")
-        if not creds_path:
-            raise Exception("GOOGLE_APPLICATION_CREDENTIALS environment variable is not set.")
-        creds = Credentials.from_service_account_file(creds_path, scopes=SCOPES)
-        client = gspread.authorize(creds)
         SPREADSHEET_ID = os.environ.get("CHARDATA_SHEET_ID")
         if not SPREADSHEET_ID:
             raise Exception("CHARDATA_SHEET_ID environment variable is not set.")
-        worksheet = client.open_by_key(SPREADSHEET_ID).worksheet("SPECIAL")
-        records = worksheet.get_all_records()
+        records = with_worksheet(SPREADSHEET_ID, "SPECIAL", lambda ws: ws.get_all_records())
         char_list = []
         for row in records:
             name = row.get("キャラ名")
             icon_url = row.get("アイコン")
             if name and icon_url:
                 char_list.append({"name": name, "image": icon_url})
+        char_registry.register_master_names(c["name"] for c in char_list)
         _special_cache = {
             "data": char_list,
             "timestamp": time.time()
         }
+        _save_master("special", _special_cache)
         print(f"SPECIALキャッシュ更新完了（{len(char_list)}件）")
     except Exception as e:
         print(f"SPECIALキャッシュ更新失敗: {e}")
 
+def _save_master(kind, cache):
+    with file_lock("masters"):
+        masters = load_shared_json("masters", {})
+        masters[kind] = cache
+        save_shared_json("masters", masters)
+
+def _sync_masters_from_file():
+    """他のワーカーが書き出したマスタが自分のものより新しければ取り込む（stat 1回で変更判定）"""
+    global _striker_cache, _special_cache, _other_icon_cache
+    signature = file_signature(get_shared_filepath("masters"))
+    if signature is None or signature == _masters_file["signature"]:
+        return
+    _masters_file["signature"] = signature
+    masters = load_shared_json("masters", {})
+    striker = masters.get("striker")
+    if striker and striker["timestamp"] > _striker_cache["timestamp"]:
+        char_registry.register_master_names(c["name"] for c in striker["data"])
+        _striker_cache = striker
+    special = masters.get("special")
+    if special and special["timestamp"] > _special_cache["timestamp"]:
+        char_registry.register_master_names(c["name"] for c in special["data"])
+        _special_cache = special
+    other_icon = masters.get("other_icon")
+    if other_icon and other_icon["timestamp"] > _other_icon_cache["timestamp"]:
+        _other_icon_cache = other_icon
+
+def _master_needs_update(cache):
+    # 期限切れの取り直しは代表ワーカーだけ。まだ何も無いときはどのワーカーも取りに行く
+    if cache["data"] is None:
+        return True
+    return is_leader() and time.time() - cache["timestamp"] > _CHAR_CACHE_LIFETIME
+
+def _request_masters_refresh(cache):
+    # 古くてもそのまま返し、取り直しは裏のスレッドに任せる（リクエストはシートを待たない）
+    if _master_needs_update(cache):
+        _masters_wakeup.set()
+
 def get_striker_list_from_sheet():
-    global _striker_cache
-    now = time.time()
-    if (_striker_cache["data"] is None) or (now - _striker_cache["timestamp"] > _CHAR_CACHE_LIFETIME):
-        _update_striker_cache()
+    _sync_masters_from_file()
+    _request_masters_refresh(_striker_cache)
     return _striker_cache["data"] or []
 
 def get_special_list_from_sheet():
-    global _special_cache
-    now = time.time()
-    if (_special_cache["data"] is None) or (now - _special_cache["timestamp"] > _CHAR_CACHE_LIFETIME):
-        _update_special_cache()
+    _sync_masters_from_file()
+    _request_masters_refresh(_special_cache)
     return _special_cache["data"] or []
 
-_update_striker_cache()
-_update_special_cache()
-
-def char_cache_scheduler():
-    while True:
-        time.sleep(_CHAR_CACHE_LIFETIME)
-        _update_striker_cache()
-        _update_special_cache()
-
-threading.Thread(target=char_cache_scheduler, daemon=True).start()
-
 # ========== その他アイコンのキャッシュ ==========
 
 _OTHER_ICON_SPREADSHEET_ID = os.environ.get("CHARDATA_SHEET_ID")
 _OTHER_ICON_SHEET = "その他アイコン"
-_other_icon_cache = {}
+_other_icon_cache = {
+    "data": None,
+    "timestamp": 0
+}
 
 def load_other_icon_cache():
     global _other_icon_cache
-    SCOPES = ["https://www.googleapis.com/auth/spreadsheets"]
-    creds_path = os.environ.get("GOOGLE_APPLICATION_CREDENTIALS")
-    if not creds_path:
-        raise Exception("GOOGLE_APPLICATION_CREDENTIALS environment variable is not set.")
-    creds = Credentials.from_service_account_file(creds_path, scopes=SCOPES)
-    client = gspread.authorize(creds)
-    ws = client.open_by_key(_OTHER_ICON_SPREADSHEET_ID).worksheet(_OTHER_ICON_SHEET)
-    records = ws.get_all_records()
+    records = with_worksheet(_OTHER_ICON_SPREADSHEET_ID, _OTHER_ICON_SHEET, lambda ws: ws.get_all_records())
     cache = {}
     for row in records:
         key = row.get('種別', '').strip()
         url = row.get('アイコン', '').strip()
         if key and url:
             cache[key] = url
-    _other_icon_cache = cache
+    _other_icon_cache = {
+        "data": cache,
+        "timestamp": time.time()
+    }
+    _save_master("other_icon", _other_icon_cache)
+
+def _update_other_icon_cache():
+    try:
+        print("その他アイコンキャッシュを更新します...")
+        load_other_icon_cache()
+        print(f"その他アイコンキャッシュ更新完了（{len(_other_icon_cache['data'])}件）")
+    except Exception as e:
+        print(f"その他アイコンキャッシュ更新失敗: {e}")
 
 def get_other_icon(key):
-    return _other_icon_cache.get(key, "")
+    _sync_masters_from_file()
+    _request_masters_refresh(_other_icon_cache)
+    return (_other_icon_cache["data"] or {}).get(key, "")
 
 def reload_other_icon_cache():
     load_other_icon_cache()
 
+# ========== マスタの裏更新（stale-while-revalidate） ==========
+# 起動時はシートを待たず、前回書き出した cache/masters.json を読むだけ
+
+_MASTERS_RETRY_INTERVAL = 60   # 取得に失敗したマスタを再試行するまでの間隔（秒）
+_masters_wakeup = threading.Event()
+_master_attempts = {"striker": 0, "special": 0, "other_icon": 0}
+
+def _master_caches():
+    return {
+        "striker": (_striker_cache, _update_striker_cache),
+        "special": (_special_cache, _update_special_cache),
+        "other_icon": (_other_icon_cache, _update_other_icon_cache),
+    }
+
+def _refresh_masters():
+    """未取得・期限切れのマスタをシートから取り直す"""
+    _sync_masters_from_file()
+    for kind, (cache, update) in _master_caches().items():
+        if not _master_needs_update(cache):
+            continue
+        if time.time() - _master_attempts[kind] < _MASTERS_RETRY_INTERVAL:
+            continue
+        with file_lock("masters.fetch"):
+            # ロック待ちの間に他のワーカーが取得していればそれを使う
+            _sync_masters_from_file()
+            if _master_needs_update(_master_caches()[kind][0]):
+                _master_attempts[kind] = time.time()
+                update()
+
+def char_cache_scheduler():
+    while True:
+        try:
+            _refresh_masters()
+        except Exception as e:
+            print(f"マスタ更新失敗: {e}")
+        _masters_wakeup.wait(_MASTERS_CHECK_INTERVAL)
+        _masters_wakeup.clear()
+
+_sync_masters_from_file()
+threading.Thread(target=char_cache_scheduler, daemon=True).start()
+
 # ========== 空欄・重複ヘッダーでも安全な取得関数 ==========
 
-def get_sheet_records_with_empty_safe(worksheet, head_row=2):
-    rows = worksheet.get_all_values()
-    headers = rows[head_row - 1]
+def _uniq_headers(headers):
     seen = {}
     uniq_headers = []
     for h in headers:
@@ -312,9 +522,11 @@ def get_sheet_records_with_empty_safe(worksheet, head_row=2):
         else:
             uniq_headers.append(base)
         seen[base] = count + 1
+    return uniq_headers
 
+def _records_from_values(uniq_headers, rows):
     data = []
-    for row in rows[head_row:]:
+    for row in rows:
         record = {}
         for idx, val in enumerate(row):
             if idx < len(uniq_headers):
@@ -322,60 +534,356 @@ def get_sheet_records_with_empty_safe(worksheet, head_row=2):
         data.append(record)
     return data
 
+def get_sheet_records_with_empty_safe(worksheet, head_row=2):
+    rows = worksheet.get_all_values()
+    return _records_from_values(_uniq_headers(rows[head_row - 1]), rows[head_row:])
+
 # ========== 表記ゆれを吸収して一致判定 ==========
+# 正規化は取り込み時に character_registry で一度だけ行い、以降はキャラIDで比較する
 
-def normalize(s):
-    if s is None:
-        return ""
-    s = str(s)
-    s = s.replace(" ", "").replace("　", "").replace("＊", "*")
-    s = s.replace("（", "(").replace("）", ")").replace("(", "(").replace(")", ")")
-    return s.strip()
+def lookup_query_ids(query):
+    """
+    検索条件のキャラ名→ID（空欄は0, 一度も出てこない名前は None）。
+    OCR誤読などの表記ゆれ（マスタ名から FUZZY_QUERY_MAX_EDITS 以内）が取り込まれていれば、その枠は (ID, ...) になる
+    """
+    return [char_registry.lookup_ids(x, max_edits=FUZZY_QUERY_MAX_EDITS) if x else 0 for x in query]
 
 # ========== キャッシュ参照での検索 ==========
 
-def search_battlelog_output_sheet(query, search_side, season=None, only_limited=False):
-    cache = get_output_sheet_cache(season)
-    all_records_main = cache or []
+def _is_blank_query(query):
+    """全枠空欄の検索条件か（空欄なら何も引かずに空の結果を返す）"""
+    if any(query):
+        return False
+    print("全枠空欄のため検索しません")
+    return True
 
-    if only_limited:
-        all_records_main = [r for r in all_records_main if r.get("source") == "限定"]
+def _search_flags(search_side, only_limited, counters_only):
+    """
+    検索の絞り込み（FLAG_* の組み合わせ）。
+    counters_only は検索した編成の相手側が勝った行だけ（＝検索した編成への勝ち筋）
+    """
+    flags = FLAG_LIMITED if only_limited else 0
+    if counters_only:
+        flags |= FLAG_DEF_WIN if search_side == "attack" else FLAG_ATK_WIN
+    return flags
+
+def _search_store(store, query_ids, search_side, only_limited, counters_only=False,
+                  before_key=None, limit=None, strict_pos=True):
+    flags = _search_flags(search_side, only_limited, counters_only)
+    return store.search(query_ids, search_side, before_key=before_key, limit=limit, flags=flags,
+                        strict_pos=strict_pos)
+
+def search_battlelog_page(query, search_side, seasons, positions=None, page_size=SEARCH_PAGE_SIZE,
+                          only_limited=False, counters_only=False, stores=None, strict_pos=True,
+                          versions=None):
+    """
+    検索結果を新しい順に page_size 件ずつ返す。
+    positions は {season: 並び順キー}（前ページで各シーズンのどこまで返したか。0 は読み切り）。
+    戻り値は ([(season, BattleRow), ...], 次ページの positions or None)。
+    各シーズンから page_size+1 件だけ引いてマージするので、ヒット件数が多くても1ページの手間は一定。
+    stores（{season: 追いつき済みのストア}）を渡せばそれを使う。渡さなければ1シーズンずつ読んで引く
+    （全シーズンのストアを同時には持たない）。strict_pos は SeasonStore.search と同じ。
+    versions（dict）を渡すと、引いた各シーズンのストアの version を入れて返す
+    """
+    positions = dict(positions or {})
+    if _is_blank_query(query):
+        return [], None
 
+    def search_one(season_key, store, catch_up=False):
+        before_key = positions.get(season_key)
+        if before_key == 0:
+            return []
+        if catch_up:
+            _catch_up_store(season_key, store)
+        if versions is not None:
+            versions[season_key] = store.version
+        query_ids = lookup_query_ids(query)
+        if None in query_ids:
+            return []
+        rows = _search_store(store, query_ids, search_side, only_limited, counters_only,
+                             before_key=before_key, limit=page_size + 1, strict_pos=strict_pos)
+        return [(season_key, r) for r in rows]
+
+    if stores is not None:
+        per_season = {s: search_one(s, stores[s]) for s in seasons}
+    elif len(seasons) == 1:
+        # get_season_store で追いつき済み
+        per_season = {seasons[0]: search_one(seasons[0], get_season_store(seasons[0]))}
+    else:
+        per_season = _season_shards.fan_out(
+            seasons, lambda season_key, store: search_one(season_key, store, catch_up=True))
+    merged = list(heapq.merge(*per_season.values(), key=lambda pair: pair[1].ts, reverse=True))
+    page = merged[:page_size]
+    if len(merged) <= page_size:
+        return page, None
+
+    # マージで使った分は各シーズンの先頭から連続しているので、最後に返した行の位置を覚えればよい
+    used = {}
+    for season_key, row in page:
+        used[season_key] = used.get(season_key, 0) + 1
+        positions[season_key] = row.key
+    for season_key, fetched in per_season.items():
+        if used.get(season_key, 0) == len(fetched):
+            # 引いた分を全部使い切った（page_size+1 件に満たなかった）シーズンは読み切り
+            positions[season_key] = 0
+    return page, positions
+
+# ========== 勝ち筋の編成別集計 ==========
+
+def counter_team_stats(query, search_side, seasons, top_k=COUNTER_STATS_TOP_K, only_limited=False,
+                       strict_pos=True):
+    """
+    検索した編成と当たった相手側の編成（4キャラ＋SP順不同）ごとに、対戦数・相手側の勝ち数・
+    ベイズ勝率を集計して上位 top_k 件を返す。
+    事前分布は一致した全対戦での相手側の勝率（対戦数 COUNTER_STATS_PRIOR_GAMES 分の重み）。
+    行dictは作らず、行のキャラIDだけで数える
+    """
+    if _is_blank_query(query):
+        return {"games": 0, "wins": 0, "teams": []}
+    opponent = "defense" if search_side == "attack" else "attack"
+    flags = _search_flags(search_side, only_limited, False)
+    stats = {}   # (4キャラID, SP ID 昇順) -> [対戦数, 勝ち数]
+    total_games = total_wins = 0
+    for season_key in seasons:
+        store = get_season_store(season_key)
+        query_ids = lookup_query_ids(query)
+        if None in query_ids:
+            continue
+        for row in store.search(query_ids, search_side, flags=flags, strict_pos=strict_pos):
+            team_ids = row.team_ids(opponent)
+            comp = team_ids[:4] + tuple(sorted(team_ids[4:6]))
+            stat = stats.get(comp)
+            if stat is None:
+                stat = stats[comp] = [0, 0]
+            stat[0] += 1
+            total_games += 1
+            if (row.def_result if opponent == "defense" else row.atk_result) == "Win":
+                stat[1] += 1
+                total_wins += 1
+
+    prior_games = COUNTER_STATS_PRIOR_GAMES
+    prior_wr = total_wins / total_games if total_games else 0.5
+    name_of = char_registry.name_of
+    teams = []
+    for comp, (games, wins) in stats.items():
+        teams.append({
+            "characters": [name_of(cid) for cid in comp],
+            "games": games,
+            "wins": wins,
+            "win_rate": round(wins / games, 3),
+            # defense_suggester.bayes_wr と同じ式
+            "bayes_win_rate": round((wins + prior_games * prior_wr) / (games + prior_games), 3),
+        })
+    teams.sort(key=lambda t: (-t["bayes_win_rate"], -t["games"]))
+    return {"games": total_games, "wins": total_wins, "teams": teams[:top_k]}
+
+def character_usage_stats(seasons, side=None):
+    """
+    キャラ×side×枠ごとの出場数・勝ち数・勝率（出場数の多い順）。
+    ストアが取り込み時に数えている値を足し合わせるだけなので、全件は読まない
+    """
+    totals = {}   # (side, slot, キャラID) -> [出場数, 勝ち数]
+    for season_key in seasons:
+        for row_side, slot, cid, games, wins in get_season_store(season_key).usage_table():
+            if side and row_side != side:
+                continue
+            stat = totals.get((row_side, slot, cid))
+            if stat is None:
+                stat = totals[(row_side, slot, cid)] = [0, 0]
+            stat[0] += games
+            stat[1] += wins
+    name_of = char_registry.name_of
+    characters = [
+        {
+            "name": name_of(cid),
+            "side": row_side,
+            "slot": SIDE_SLOT_KEYS[row_side][slot],
+            "games": games,
+            "wins": wins,
+            "win_rate": round(wins / games, 3),
+        }
+        for (row_side, slot, cid), (games, wins) in totals.items()
+    ]
+    characters.sort(key=lambda c: (-c["games"], c["side"], c["slot"], c["name"]))
+    return characters
+
+# ========== 検索結果（APIの返却形式）のキャッシュ ==========
+# よく検索される編成は同じページが何度も求められるので、組み立て済みの結果をLRUで持つ。
+# 各エントリは対象シーズンのストアの version とアイコンの更新時刻で札付けし、どちらかが変わっていれば作り直す
+# （取り込みがあったシーズンのエントリだけが外れる）
+
+_search_result_cache = OrderedDict()   # 検索キー -> {"version", "results", "positions"}
+_search_result_lock = threading.Lock()
+
+def _canonical_query_ids(query_ids, strict_pos=True):
+    # SP2枠は順不同なので並べ替えて同じキーにする（枠を問わない検索ならキャラ4枠も）
+    def order(x):
+        return (x is None, x if isinstance(x, tuple) else (x or 0,))
+    strikers = tuple(query_ids[:4]) if strict_pos else tuple(sorted(query_ids[:4], key=order))
+    return strikers + tuple(sorted(query_ids[4:6], key=order))
+
+def _build_search_result(row, search_side, icons, row_season=None):
     if search_side == "attack":
-        char_cols = ["A1", "A2", "A3", "A4", "ASP1", "ASP2"]
+        winner, loser = "defense", "attack"
+        winner_player, loser_player = row.defender, row.attacker
     else:
-        char_cols = ["D1", "D2", "D3", "D4", "DSP1", "DSP2"]
+        winner, loser = "attack", "defense"
+        winner_player, loser_player = row.attacker, row.defender
+    entry = {
+        "source": row.source,
+        "winner_type": winner,
+        "winner_icon": icons[winner],
+        "winner_winlose_icon": icons["win"],
+        "winner_player": winner_player,
+        "winner_characters": row.team(winner),
+        "loser_type": loser,
+        "loser_icon": icons[loser],
+        "loser_winlose_icon": icons["lose"],
+        "loser_player": loser_player,
+        "loser_characters": row.team(loser),
+        "date": row.date,
+    }
+    if row_season:
+        entry["season"] = row_season
+    return entry
+
+def _loaded_store_version(season_key):
+    """読み込み済みならそのストアの（追いついた後の）version。読み込んでいなければ None（読み込みはしない）"""
+    store = _season_shards.peek(season_key)
+    if store is None:
+        return None
+    _catch_up_store(season_key, store)
+    return store.version
+
+def _search_context(seasons):
+    """
+    検索に使うストア・アイコンを用意する。
+    1シーズンならストアを読み込んで（追いつき済みで）持つ。複数シーズンはストアを持たず、
+    検索のときに1シーズンずつ読む（全シーズンを同時に持つとメモリ予算を超え、毎回読み直しになる）。
+    結果に埋め込むのはその他アイコンだけなので、札はその更新時刻で足りる
+    """
+    stores = {seasons[0]: get_season_store(seasons[0])} if len(seasons) == 1 else None
+    _sync_masters_from_file()
+    _request_masters_refresh(_other_icon_cache)
+    icon_cache = _other_icon_cache   # 丸ごと差し替えられるので、1回読めば data と timestamp が揃う
+    icon_data = icon_cache["data"] or {}
+    return {
+        "stores": stores,
+        "icons": {
+            "win": icon_data.get("勝ち", ""),
+            "lose": icon_data.get("負け", ""),
+            "attack": icon_data.get("攻撃側", ""),
+            "defense": icon_data.get("防衛側", ""),
+        },
+        "icon_version": icon_cache["timestamp"],
+        # 表記ゆれの対応はキャラ名・マスタが増えると変わるので、名簿の版も札に入れる
+        "registry_version": char_registry.version,
+    }
 
-    query_norm = [normalize(x) for x in query]
-    if not any(query_norm):
-        print("全枠空欄のため検索しません")
-        return []
+def _search_version(context, seasons, versions):
+    # 各シーズンのストアの version（読み切ったシーズンは結果に関わらないので 0）・アイコン・名簿の版
+    return (tuple(versions.get(s) for s in seasons), context["icon_version"], context["registry_version"])
+
+def _search_results(context, query, search_side, seasons, positions, page_size, only_limited, strict_pos,
+                    use_cache=True):
+    query_ids = lookup_query_ids(query)
+    key = (
+        tuple(seasons), search_side, bool(strict_pos), _canonical_query_ids(query_ids, strict_pos),
+        bool(only_limited),
+        tuple(sorted((positions or {}).items())), page_size,
+    )
+    exhausted = {s: 0 for s in seasons if (positions or {}).get(s) == 0}
+    if use_cache:
+        # 読み込まれていないシーズンを含むならキャッシュは使わない（読み直したストアは版が変わるうえ、
+        # 読み込み前はキャラIDが払い出されておらず、検索キー・名簿の版もまだ決まらない）
+        if context["stores"] is not None:
+            before = {s: store.version for s, store in context["stores"].items()}
+        else:
+            before = {s: _loaded_store_version(s) for s in seasons if s not in exhausted}
+        before.update(exhausted)
+        use_cache = None not in before.values()
+    if use_cache:
+        with _search_result_lock:
+            cached = _search_result_cache.get(key)
+            if cached is not None and cached["version"] == _search_version(context, seasons, before):
+                _search_result_cache.move_to_end(key)
+                return cached["results"], cached["positions"]
+
+    versions = dict(exhausted)
+    matched, next_positions = search_battlelog_page(
+        query, search_side, seasons, positions=positions, page_size=page_size,
+        only_limited=only_limited, counters_only=True, stores=context["stores"], strict_pos=strict_pos,
+        versions=versions)
+    multi = len(seasons) > 1
+    results = [_build_search_result(row, search_side, context["icons"], row_season if multi else None)
+               for row_season, row in matched]
+    if not use_cache:
+        return results, next_positions
+
+    with _search_result_lock:
+        _search_result_cache[key] = {
+            "version": _search_version(context, seasons, versions), "results": results, "positions": next_positions,
+        }
+        _search_result_cache.move_to_end(key)
+        while len(_search_result_cache) > SEARCH_RESULT_CACHE_SIZE:
+            _search_result_cache.popitem(last=False)
+    return results, next_positions
 
-    result = []
-    for row in all_records_main:
-        match = True
-        for i in range(4):
-            if query_norm[i]:
-                if normalize(row.get(char_cols[i], "")) != query_norm[i]:
-                    match = False
-                    break
-        if not match:
-            continue
-        query_sp = set([q for q in query_norm[4:6] if q])
-        data_sp = set([normalize(row.get(char_cols[4], "")), normalize(row.get(char_cols[5], ""))])
-        if query_sp and not query_sp.issubset(data_sp):
+def search_battlelog_results(query, search_side, seasons, positions=None, page_size=SEARCH_PAGE_SIZE,
+                             only_limited=False, strict_pos=True, use_cache=True):
+    """
+    /api/search の1ページ分。検索した編成の相手側が勝った行を返却用dictにして
+    (結果リスト, 次ページの positions or None) を返す。複数シーズンなら各結果に season を付ける。
+    戻り値のリストはキャッシュと共有なので書き換えないこと。
+    use_cache=False ならキャッシュを見ず、結果も入れない（全ページを流すときに人気のページを追い出さないため）
+    """
+    if _is_blank_query(query):
+        return [], None
+    context = _search_context(seasons)
+    return _search_results(context, query, search_side, seasons, positions, page_size, only_limited, strict_pos,
+                           use_cache=use_cache)
+
+def search_battlelog_batch(queries, seasons, page_size=SEARCH_PAGE_SIZE, only_limited=False, strict_pos=True):
+    """
+    複数の検索をまとめて行う。queries は [(side, キャラ名6枠, positions or None), ...]、
+    戻り値は同じ順の [(結果リスト, 次ページの positions or None), ...]。
+    ストアの読込・追いつき、アイコン・版の取得はバッチ全体で1回だけ。
+    同じ編成（SP順違いを含む）が並んでいれば2件目以降はキャッシュから返る
+    """
+    context = _search_context(seasons)
+    out = []
+    for search_side, query, positions in queries:
+        if _is_blank_query(query):
+            out.append(([], None))
             continue
-        result.append(row)
-    return result
+        out.append(_search_results(context, query, search_side, seasons, positions, page_size, only_limited,
+                                   strict_pos))
+    return out
 
 # =========================
 # ▼▼▼ ここから新規追加 ▼▼▼
 # =========================
 
-def get_latest_loser_teams(n=5, season=None, only_limited=False):
+# 直近の負け編成はストアが件数上限つきで保持している行から組み立て、画像URLまで解決済みの形でキャッシュする
+# ストアへの取り込み（version）かマスタ・アイコンの更新があったときだけ作り直す
+
+_loser_teams_cache = {}   # (season, only_limited) -> {"version", "teams"}
+_char_image_map_cache = {"version": None, "map": {}}
+
+def _masters_version():
+    return (_striker_cache["timestamp"], _special_cache["timestamp"], _other_icon_cache["timestamp"])
+
+def _get_char_image_map():
     striker_list = get_striker_list_from_sheet()
     special_list = get_special_list_from_sheet()
-    char_image_map = {c["name"]: c["image"] for c in striker_list + special_list}
+    version = _masters_version()
+    if _char_image_map_cache["version"] != version:
+        _char_image_map_cache["map"] = {c["name"]: c["image"] for c in striker_list + special_list}
+        _char_image_map_cache["version"] = version
+    return _char_image_map_cache["map"]
+
+def _build_loser_teams(rows, n):
+    char_image_map = _get_char_image_map()
 
     side_icon_map = {
         "attack": get_other_icon("攻撃側"),
@@ -383,21 +891,16 @@ def get_latest_loser_teams(n=5, season=None, only_limited=False):
     }
     lose_icon = get_other_icon("負け")
 
-    logs = get_output_sheet_cache(season) or []
-    if only_limited:
-        logs = [row for row in logs if row.get("source") == "限定"]
     result = []
-
-    for row in logs:
+    for row in rows:
         team = None
         side = None
-        if row.get("勝敗", "") == "Lose":
+        if row.atk_result == "Lose":
             side = "attack"
-            chars = [row.get(f"A{i+1}", "") for i in range(4)] + [row.get("ASP1", ""), row.get("ASP2", "")]
-        elif row.get("勝敗_2", "") == "Lose":
+        elif row.def_result == "Lose":
             side = "defense"
-            chars = [row.get(f"D{i+1}", "") for i in range(4)] + [row.get("DSP1", ""), row.get("DSP2", "")]
         if side:
+            chars = row.team(side)
             char_objs = []
             for name in chars:
                 char_objs.append({
@@ -409,14 +912,45 @@ def get_latest_loser_teams(n=5, season=None, only_limited=False):
                 "side_icon": side_icon_map.get(side, ""),
                 "lose_icon": lose_icon,
                 "characters": char_objs,
-                "date": row.get("日付", ""),
-                "source": row.get("source", ""),
+                "date": row.date,
+                "source": row.source,
             }
             result.append(team)
         if len(result) >= n:
             break
     return result
 
+def get_latest_loser_teams(n=5, season=None, only_limited=False):
+    season_key = season or CURRENT_SEASON
+    store = get_season_store(season_key)
+    if n > RECENT_LOSERS_SIZE:
+        # 保持件数より多く要るときだけ全件を辿る
+        logs = store.iter_rows()
+        if only_limited:
+            logs = [row for row in logs if row.source == "限定"]
+        return _build_loser_teams(logs, n)
+
+    _get_char_image_map()   # マスタの更新を先に反映させてから version を見る
+    version = (store.version, _masters_version())
+    cached = _loser_teams_cache.get((season_key, only_limited))
+    if cached is None or cached["version"] != version:
+        teams = _build_loser_teams(store.recent_losers(only_limited), RECENT_LOSERS_SIZE)
+        cached = {"version": version, "teams": teams}
+        _loser_teams_cache[(season_key, only_limited)] = cached
+    return cached["teams"][:n]
+
 # =========================
 # ▲▲▲ ここまで新規追加 ▲▲▲
 # =========================
+
+# ========== 修復用コマンド ==========
+# 差分同期で前回位置を見失ったときなどに全件を取り直す（常駐ワーカーは次の参照時に読み直す）
+#   python spreadsheet_manager.py repair [シーズン名|all]
+if __name__ == "__main__":
+    import sys
+    if len(sys.argv) < 2 or sys.argv[1] != "repair":
+        print("Usage: python spreadsheet_manager.py repair [season|all]")
+        sys.exit(1)
+    target = sys.argv[2] if len(sys.argv) > 2 else CURRENT_SEASON
+    for season_key in (all_season_keys() if target == "all" else [target]):
+        print(f"{season_key}: {len(repair_output_sheet_cache(season_key))}件で再構築しました")
@@ -88,24 +88,66 @@ document.querySelector(".search-btn").onclick = async () => {
     return;
   }
   const side = atkOrDef === "攻撃" ? "attack" : "defense";
-  const res = await fetch("/api/search", {
-    method: "POST",
-    headers: {"Content-Type": "application/json"},
-    body: JSON.stringify({side: side, characters: charNames})
-  });
-  const data = await res.json();
-  showSearchResults(data.results || []);
+  lastSearchParams = {side: side, characters: charNames};
+  await fetchSearchPage(null);
 };
 
-// 検索結果表示
-function showSearchResults(results) {
+// 検索結果はページ単位（新しい順）で取得し、「もっと見る」で続きを追加する
+let lastSearchParams = null;
+let nextSearchCursor = null;
+let searchPageLoading = false;   // 取得中は「もっと見る」を押せない（同じページを二重に追加しない）
+let searchRequestSeq = 0;        // 新しい検索を始めたら、前の検索の続きの応答は捨てる
+async function fetchSearchPage(cursor) {
+  const seq = ++searchRequestSeq;
+  if (!cursor) nextSearchCursor = null;   // 新しい検索の間は前の検索の「もっと見る」を出さない
+  searchPageLoading = true;
+  renderLoadMore();
+  try {
+    const res = await fetch("/api/search", {
+      method: "POST",
+      headers: {"Content-Type": "application/json"},
+      body: JSON.stringify(Object.assign({cursor: cursor}, lastSearchParams))
+    });
+    const data = await res.json();
+    if (seq !== searchRequestSeq) return;
+    nextSearchCursor = data.next_cursor || null;
+    showSearchResults(data.results || [], !!cursor);
+  } finally {
+    if (seq === searchRequestSeq) {
+      searchPageLoading = false;
+      renderLoadMore();
+    }
+  }
+}
+function renderLoadMore() {
+  let btn = document.getElementById("loadMoreBtn");
+  if (!btn) {
+    btn = document.createElement("button");
+    btn.id = "loadMoreBtn";
+    btn.type = "button";
+    btn.textContent = "もっと見る";
+    btn.onclick = () => {
+      if (nextSearchCursor && !searchPageLoading) fetchSearchPage(nextSearchCursor);
+    };
+    document.getElementById("searchResultsSection").appendChild(btn);
+  }
+  btn.disabled = searchPageLoading;
+  btn.style.display = nextSearchCursor ? "block" : "none";
+}
+
+// 検索結果表示（append のときは既存の結果の後ろに追加）
+function showSearchResults(results, append) {
   const section = document.getElementById("searchResultsSection");
   const container = document.getElementById("searchResults");
-  section.style.display = results.length > 0 ? "block" : "none";
-  container.innerHTML = "";
-  if (results.length === 0) {
-    container.innerHTML = "<div style='color:#888;font-size:1.05em;'>該当するログはありませんでした。</div>";
-    return;
+  if (append) {
+    if (results.length === 0) return;
+  } else {
+    section.style.display = results.length > 0 ? "block" : "none";
+    container.innerHTML = "";
+    if (results.length === 0) {
+      container.innerHTML = "<div style='color:#888;font-size:1.05em;'>該当するログはありませんでした。</div>";
+      return;
+    }
   }
   results.forEach(res => {
     const winnerChars = res.winner_characters.map(name => charImageTag(name));
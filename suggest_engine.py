@@ -0,0 +1,207 @@
+# suggest_engine.py
+# 防衛サジェストの集計を列形式（NumPy）で行う
+# シーズンの全行を「枠ごとのキャラID・勝敗/出典ビット・テンプレID」の整数行列にして持っておき、
+# 攻めごとの絞り込みはブール配列、テンプレ・キャラごとの件数/勝ち数は bincount で数える。
+# 並び（初出順）も行ループ版（defense_suggester）と同じになるようにしている
+import threading
+import weakref
+
+import numpy as np
+
+from battlelog_store import FLAG_DEF_WIN
+
+# 行列の列（1列 = 全行分の連続した配列）
+_A = slice(0, 4)      # 攻め STRIKER 4枠
+_ASP = slice(4, 6)    # 攻め SP 2枠
+_D = slice(6, 10)     # 防衛 STRIKER 4枠
+_DSP = slice(10, 12)  # 防衛 SP 2枠
+_TPL = 12             # 防衛4枠のテンプレID
+_FLAGS = 13           # FLAG_*（勝敗・限定）
+_N_COLS = 14
+
+_columns = weakref.WeakKeyDictionary()   # ストア -> そのストアの最新の SeasonColumns
+_columns_lock = threading.Lock()
+
+def _isin(cols, cids):
+    """
+    cols（1列か、枠の列を並べた2次元）のどこかがキャラID cids（int か表記ゆれのタプル）のどれかに一致する行。
+    axis を使った any は遅いので、列ごとの比較を OR でまとめる
+    """
+    if cols.ndim == 1:
+        cols = (cols,)
+    if not isinstance(cids, tuple):
+        cids = (cids,)
+    matched = None
+    for col in cols:
+        for cid in cids:
+            if matched is None:
+                matched = col == cid
+            else:
+                matched |= col == cid
+    return matched
+
+def _ordered_counts(ids, wins):
+    """キャラID -> {"games", "wins"}（0 は数えない）。ids 上の初出順に並べる"""
+    keep = ids != 0
+    ids, wins = ids[keep], wins[keep]
+    if not ids.size:
+        return {}
+    uniq, first = np.unique(ids, return_index=True)
+    uniq = uniq[np.argsort(first)]
+    games = np.bincount(ids)
+    won = np.bincount(ids[wins], minlength=len(games))
+    return {int(cid): {"games": int(games[cid]), "wins": int(won[cid])} for cid in uniq}
+
+class SeasonColumns:
+    """
+    1シーズン分の行列（ある version 時点のもの。作った後は変えない）。
+    m は新しい順。取り込みで増える行はふつう既存のどの行より新しいので、
+    バッファの先頭側に空きを取っておき、そこへ前置きするだけで次の版を作る
+    （古い版は自分の範囲より前を見ないので、同じバッファを共有しても変わらない）。
+    古い日付の行が混ざったときだけ全体を並べ直す
+    """
+    def __init__(self, buf, key_buf, win_buf, start, front, versions, usage):
+        self.load_version, self.version, self.template_version = versions
+        self._buf = buf
+        self._key_buf = key_buf
+        self._win_buf = win_buf
+        self._start = start
+        self._front = front          # このバッファで使われている先頭位置（版の間で共有）
+        self.m = buf[:, start:]
+        self.keys = key_buf[start:]
+        self.def_win = win_buf[start:]
+        self.tpl = self.m[_TPL]
+        self.n = self.keys.size
+        self._usage = usage          # 同じ版のストアの防衛側の出場数（rows_since で受け取ったもの）
+
+    @staticmethod
+    def _encode(rows, flags):
+        """行を新しい順に並べた (行列, キー)"""
+        base = np.empty((_N_COLS, len(rows)), dtype=np.int32)
+        if rows:
+            base[:_FLAGS] = np.array(
+                [r.a_ids + r.asp_ids + r.d_ids + r.dsp_ids + (r.d_tpl,) for r in rows], dtype=np.int32
+            ).T
+        base[_FLAGS] = np.frombuffer(flags, dtype=np.uint8)
+        keys = np.fromiter((r.key for r in rows), dtype=np.int64, count=len(rows))
+        order = np.argsort(-keys)
+        return base[:, order], keys[order]
+
+    @classmethod
+    def _allocate(cls, m, keys, versions, usage):
+        """新しい順の m, keys を、先頭に空きを取った新しいバッファに置く"""
+        n = keys.size
+        head = max(1024, n // 8)
+        buf = np.empty((_N_COLS, head + n), dtype=np.int32)
+        buf[:, head:] = m
+        key_buf = np.empty(head + n, dtype=np.int64)
+        key_buf[head:] = keys
+        win_buf = np.empty(head + n, dtype=bool)
+        win_buf[head:] = (m[_FLAGS] & FLAG_DEF_WIN) != 0
+        return cls(buf, key_buf, win_buf, head, [head], versions, usage)
+
+    @classmethod
+    def build(cls, rows, flags, versions, usage):
+        m, keys = cls._encode(rows, flags)
+        return cls._allocate(m, keys, versions, usage)
+
+    def extend(self, rows, flags, versions, usage):
+        """後から取り込んだ行を足した新しい版（この版は変えない）"""
+        if not rows:
+            return SeasonColumns(self._buf, self._key_buf, self._win_buf, self._start, self._front,
+                                 versions, usage)
+        m, keys = self._encode(rows, flags)
+        k = keys.size
+        if self.n and keys[-1] < self.keys[0]:
+            # 既存の行より古い行が混ざった：全体を並べ直す
+            m = np.concatenate([m, self.m], axis=1)
+            keys = np.concatenate([keys, self.keys])
+            order = np.argsort(-keys)
+            return self._allocate(m[:, order], keys[order], versions, usage)
+        if k > self._start or self._front[0] != self._start:
+            # 先頭の空きが足りない（か、この版より新しい版がもう前置きしている）
+            return self._allocate(np.concatenate([m, self.m], axis=1), np.concatenate([keys, self.keys]),
+                                  versions, usage)
+        start = self._start - k
+        self._buf[:, start:self._start] = m
+        self._key_buf[start:self._start] = keys
+        self._win_buf[start:self._start] = (m[_FLAGS] & FLAG_DEF_WIN) != 0
+        self._front[0] = start
+        return SeasonColumns(self._buf, self._key_buf, self._win_buf, start, self._front, versions, usage)
+
+    def global_counts(self, part):
+        """
+        part="d"（D1〜D4）/"dsp"（DSP1/DSP2）の出現回数（キャラID -> 件数, 0件のキャラは含まない）。
+        ストアが取り込み時に数えているものを行列と同じ時点で受け取っている。返した dict は書き換えないこと
+        """
+        return self._usage["striker" if part == "d" else "sp"]
+
+    def filter_attack(self, attack_ids, strict_pos=False):
+        """
+        攻め6枠のキャラID（空欄は0, 表記ゆれはタプル）に一致する行の位置（新しい順）。
+        一致条件は defense_suggester.filter_records_by_attack_strikers と同じ
+        """
+        if not any(attack_ids):
+            return np.arange(self.n)
+        a, asp = self.m[_A], self.m[_ASP]
+        if strict_pos:
+            conds = [(a[slot], q) for slot, q in enumerate(attack_ids[:4]) if q]
+            conds += [(asp[slot], q) for slot, q in enumerate(attack_ids[4:6]) if q]
+        else:
+            conds = [(a, q) for q in attack_ids[:4] if q] + [(asp, q) for q in attack_ids[4:6] if q]
+        # 最初の条件だけ全行で見て、残りは残った行の位置だけで判定する
+        cols, q = conds[0]
+        idx = np.flatnonzero(_isin(cols, q))
+        for cols, q in conds[1:]:
+            if not idx.size:
+                break
+            idx = idx[_isin(cols[..., idx], q)]
+        return idx
+
+    def template_counts(self, idx):
+        """行の位置 idx をテンプレIDごとに数える。[(テンプレID, 件数, 防衛勝ち数), ...]（初出順, 0 は除く）"""
+        tids = self.tpl[idx]
+        keep = tids != 0
+        tids, wins = tids[keep], self.def_win[idx][keep]
+        if not tids.size:
+            return []
+        uniq, first = np.unique(tids, return_index=True)
+        uniq = uniq[np.argsort(first)]
+        games = np.bincount(tids)
+        won = np.bincount(tids[wins], minlength=len(games))
+        return [(int(tid), int(games[tid]), int(won[tid])) for tid in uniq]
+
+    def template_rows(self, idx, tid):
+        """idx のうちテンプレIDが tid の行の位置（新しい順のまま）"""
+        return idx[self.tpl[idx] == tid]
+
+    def defense_stats(self, idx):
+        """
+        行の位置 idx（この並びで連結済み）の防衛側の集計。
+        (枠ごとの キャラID -> {"games", "wins"} ×4, SP の キャラID -> {"games", "wins"})。どれも初出順
+        """
+        d = self.m[_D][:, idx]
+        wins = self.def_win[idx]
+        slot_stats = [_ordered_counts(d[slot], wins) for slot in range(4)]
+        # SP は行ごとに SP1, SP2 の順
+        sp_stats = _ordered_counts(self.m[_DSP][:, idx].T.ravel(), np.repeat(wins, 2))
+        return slot_stats, sp_stats
+
+def get_season_columns(store):
+    """ストアの現在の版の行列。前の版から行が増えただけなら、増えた行だけ変換して足す"""
+    with _columns_lock:
+        cols = _columns.get(store)
+        if cols is not None and (cols.version, cols.template_version) == (store.version, store.template_version):
+            return cols
+        start = cols.n if cols is not None else 0
+        rows, flags, versions, usage = store.rows_since(start)
+        load_version, _, template_version = versions
+        if cols is None or (cols.load_version, cols.template_version) != (load_version, template_version):
+            if start:
+                rows, flags, versions, usage = store.rows_since(0)
+            cols = SeasonColumns.build(rows, flags, versions, usage)
+            print(f"サジェスト用の行列を作成: {store.season}（{cols.n}件）")
+        else:
+            cols = cols.extend(rows, flags, versions, usage)
+        _columns[store] = cols
+        return cols
@@ -0,0 +1,55 @@
+# template_registry.py
+# 4枠の「テンプレ」（各枠のキャラの (射程, 遮蔽) の並び）を小さな整数IDで扱う
+# 行のテンプレIDはストアに取り込むときに1回だけ求め、STRIKERマスタが変わったときだけ作り直す
+import threading
+
+class TemplateRegistry:
+    """
+    タグの並び ⇔ テンプレID。ID 0 は「マスタに無いキャラ（空欄含む）がいる」（テンプレ扱いしない）。
+    一度払い出したIDは変わらない（マスタが変わっても同じタグの並びは同じID）。
+    version は STRIKER マスタの内容が変わるたびに増える
+    """
+    def __init__(self):
+        self._ids = {}            # (タグ, タグ, タグ, タグ) -> テンプレID
+        self._tags = [None]       # テンプレID -> タグの並び
+        self._char_tags = {}      # キャラID -> (射程, 遮蔽)
+        self._memo = {}           # 4枠のキャラID -> テンプレID（マスタが変わったら捨てる）
+        self._lock = threading.Lock()
+        self.version = 0
+
+    def set_striker_master(self, char_tags):
+        """char_tags: キャラID -> (射程, 遮蔽)。内容が変わったときだけ version を進める"""
+        with self._lock:
+            if char_tags == self._char_tags:
+                return
+            self._char_tags = dict(char_tags)
+            self._memo = {}
+            self.version += 1
+        print(f"テンプレ判定用のSTRIKERマスタを更新しました（{len(char_tags)}キャラ, version={self.version}）")
+
+    def template_id(self, ids):
+        """4枠のキャラID → テンプレID"""
+        # マスタの差し替えと並行しても、同じ版の表とメモだけを使う
+        char_tags, memo = self._char_tags, self._memo
+        tid = memo.get(ids)
+        if tid is None:
+            tags = tuple(char_tags.get(cid) for cid in ids)
+            if None in tags:
+                tid = 0
+            else:
+                with self._lock:
+                    tid = self._ids.get(tags)
+                    if tid is None:
+                        tid = self._ids[tags] = len(self._tags)
+                        self._tags.append(tags)
+            memo[ids] = tid
+        return tid
+
+    def id_of(self, tags):
+        """タグの並び → テンプレID（まだどの行にも出てこない並びなら None）"""
+        return self._ids.get(tags)
+
+    def tags_of(self, tid):
+        return self._tags[tid]
+
+template_registry = TemplateRegistry()
@@ -0,0 +1,131 @@
+# tests/test_battlelog_cache.py
+# ジャーナル追記 → 畳み込み → 読み直しで同じ行になるか、畳み込みが途中で落ちたときと
+# スタンプが古い番号に戻ったとき（fsync 前の電源断）に続きから正しく番号を振れるかを確かめる
+import os
+import sys
+import tempfile
+import unittest
+from unittest import mock
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if ROOT not in sys.path:
+    sys.path.insert(0, ROOT)
+
+import battlelog_cache  # noqa: E402
+from battlelog_cache import (  # noqa: E402
+    append_journal, compact_journal, load_output_cache, load_season_snapshot, read_journal_since,
+    read_stamp, save_output_cache,
+)
+from shared_state import save_shared_json  # noqa: E402
+
+# cache/ は作業ディレクトリ基準なので一時ディレクトリで動かす
+_workdir = {}
+
+def setUpModule():
+    _workdir["orig"] = os.getcwd()
+    _workdir["tmp"] = tempfile.TemporaryDirectory(ignore_cleanup_errors=True)
+    os.chdir(_workdir["tmp"].name)
+
+def tearDownModule():
+    os.chdir(_workdir["orig"])
+    _workdir["tmp"].cleanup()
+
+def make_row(i):
+    return {
+        "日付": f"2024-05-01 00:{i // 60:02d}:{i % 60:02d}", "プレイヤー名": f"p{i}", "勝敗": "Win",
+        "A1": "ホシノ", "A2": f"C{i % 7}", "A3": "", "A4": "", "ASP1": "ヒビキ", "ASP2": "",
+        "空欄": "", "プレイヤー名_2": "q", "勝敗_2": "Lose",
+        "D1": "ミカ", "D2": "", "D3": "", "D4": "", "DSP1": "", "DSP2": "",
+        "source": "一般",
+    }
+
+def newest_first(rows):
+    return list(reversed(rows))
+
+class JournalTest(unittest.TestCase):
+    def setUp(self):
+        # シーズンごとに開いたジャーナルをプロセス内で持つので、テストごとに別のシーズンにする
+        self.season = self.id().rsplit(".", 1)[-1]
+        self.addCleanup(self.forget_process_state)
+
+    def forget_process_state(self):
+        """このプロセスで開いたジャーナル・読み位置を捨てる（別プロセスで開き直したのと同じ）"""
+        state = battlelog_cache._journals.pop(self.season, None)
+        if state is not None:
+            state["fh"].close()
+        battlelog_cache._readers.pop(self.season, None)
+
+    def append(self, rows):
+        return [append_journal(self.season, row) for row in rows]
+
+    def test_append_compact_reload_gives_same_rows(self):
+        base = [make_row(i) for i in range(10)]
+        save_output_cache(self.season, newest_first(base))
+        rows = [make_row(i) for i in range(10, 30)]
+        self.assertEqual(self.append(rows), list(range(1, 21)))
+        expected = newest_first(base + rows)
+        self.assertEqual(load_output_cache(self.season), expected)
+
+        compact_journal(self.season)
+        self.assertEqual(load_output_cache(self.season), expected)
+        stamp = read_stamp(self.season)
+        self.assertEqual((stamp["seq"], stamp["compacted_seq"]), (20, 20))
+        tail, snapshot, _ = load_season_snapshot(self.season)
+        with snapshot:
+            self.assertEqual((tail, len(snapshot), snapshot.journal_seq), ([], 30, 20))
+
+        # 畳み込んだ後の追記も続きの番号で読める
+        more = [make_row(i) for i in range(30, 35)]
+        self.assertEqual(self.append(more), list(range(21, 26)))
+        self.assertEqual(load_output_cache(self.season), newest_first(base + rows + more))
+        self.assertEqual([seq for seq, _ in read_journal_since(self.season, 20)], list(range(21, 26)))
+
+    def test_journal_read_past_compaction_needs_full_reload(self):
+        self.append([make_row(i) for i in range(5)])
+        self.assertEqual(len(read_journal_since(self.season, 0)), 5)
+        compact_journal(self.season)
+        self.append([make_row(5)])
+        self.assertEqual([seq for seq, _ in read_journal_since(self.season, 5)], [6])
+        # 2〜5 はスナップショットへ移ったので、ジャーナルだけでは追いつけない
+        battlelog_cache._readers.pop(self.season)
+        self.assertIsNone(read_journal_since(self.season, 1))
+
+    def test_interrupted_compaction_is_resumed(self):
+        rows = [make_row(i) for i in range(10)]
+        self.append(rows[:4])
+        compact_journal(self.season)
+        self.append(rows[4:8])
+        # スナップショットの書き出しが途中で落ちても元の例外が出る（BufferError で隠れない）
+        def broken(season, rows, journal_seq):
+            # ジャーナルの4件を過ぎて、既存スナップショットの行を読んでいる途中で落ちる
+            for i, _ in enumerate(rows):
+                if i == 5:
+                    raise OSError("disk full")
+        with mock.patch.object(battlelog_cache, "_write_snapshot", broken):
+            with self.assertRaisesRegex(OSError, "disk full"):
+                compact_journal(self.season)
+        compacting = battlelog_cache._get_compacting_filepath(self.season)
+        self.assertTrue(os.path.exists(compacting))
+        # 畳み込み中のファイルも読むので行は欠けない。追記は新しいジャーナルへ続く
+        self.assertEqual(load_output_cache(self.season), newest_first(rows[:8]))
+        self.append(rows[8:])
+        self.assertEqual(load_output_cache(self.season), newest_first(rows))
+
+        compact_journal(self.season)
+        self.assertFalse(os.path.exists(compacting))
+        self.assertEqual(load_output_cache(self.season), newest_first(rows))
+        self.assertEqual(read_stamp(self.season)["compacted_seq"], 8)
+
+    def test_stale_stamp_is_recovered_from_journal(self):
+        rows = [make_row(i) for i in range(6)]
+        self.append(rows[:5])
+        # 追記のスタンプは fsync しないので、電源断の後は古い番号に戻っていることがある
+        save_shared_json(f"{self.season}.stamp", {"generation": 0, "seq": 2})
+        self.forget_process_state()
+        self.assertEqual(self.append(rows[5:]), [6])
+        self.assertEqual(read_stamp(self.season)["seq"], 6)
+        self.assertEqual([seq for seq, _ in read_journal_since(self.season, 0)], list(range(1, 7)))
+        self.assertEqual(load_output_cache(self.season), newest_first(rows))
+
+if __name__ == "__main__":
+    unittest.main()
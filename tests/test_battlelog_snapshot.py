@@ -0,0 +1,95 @@
+# tests/test_battlelog_snapshot.py
+# バイナリスナップショット：書いて読み直すと同じ行になること（想定外の列・空欄・同じ文字列の共有を含む）、
+# 途中で止まった読み出しがあっても close() できること
+import os
+import sys
+import tempfile
+import unittest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if ROOT not in sys.path:
+    sys.path.insert(0, ROOT)
+
+from battlelog_store import ROW_FIELDS, SeasonStore  # noqa: E402
+from battlelog_snapshot import SnapshotReader, read_snapshot_seq, write_snapshot  # noqa: E402
+
+def make_rows(n):
+    return [(tuple(f"{k}{i}" for k in ROW_FIELDS), None) for i in range(n)]
+
+def make_battle_rows():
+    """実際の行に近い形：キャラ名は行をまたいで同じ、空欄あり、一部の行だけ想定外の列がある"""
+    rows = []
+    for i in range(40):
+        row = dict(zip(ROW_FIELDS, [""] * len(ROW_FIELDS)))
+        row.update({
+            "日付": f"2024-05-{1 + i % 28:02d} 12:00:{i % 60:02d}", "プレイヤー名": f"先生{i % 5}",
+            "勝敗": "Win" if i % 3 else "Lose", "プレイヤー名_2": "相手", "勝敗_2": "Lose" if i % 3 else "Win",
+            "A1": "シロコ（水着）", "A2": f"C{i % 4}", "ASP1": "ヒビキ",
+            "D1": "ホシノ", "D2": f"C{i % 6}", "DSP1": "アコ", "DSP2": "" if i % 2 else "ハナエ",
+            "source": "限定" if i % 4 == 0 else "一般",
+        })
+        extra = {"空欄": "", "メモ": f"備考{i}"} if i % 10 == 0 else None
+        rows.append((tuple(row[k] for k in ROW_FIELDS), extra))
+    return rows
+
+class RoundTripTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+        self.path = os.path.join(self.tmp.name, "test.bin")
+        self.rows = make_battle_rows()
+
+    def test_rows_read_back_unchanged(self):
+        self.assertEqual(write_snapshot(self.path, iter(self.rows), 123), len(self.rows))
+        self.assertEqual(read_snapshot_seq(self.path), 123)
+        with SnapshotReader(self.path) as snapshot:
+            self.assertEqual((len(snapshot), snapshot.journal_seq), (len(self.rows), 123))
+            self.assertEqual(list(snapshot.iter_rows()), self.rows)
+            self.assertEqual(snapshot.row(10), self.rows[10])
+            self.assertEqual(snapshot.row(len(self.rows) - 1), self.rows[-1])
+            with self.assertRaises(IndexError):
+                snapshot.row(len(self.rows))
+            dicts = list(snapshot.iter_dicts())
+        self.assertEqual(dicts[0], dict(zip(ROW_FIELDS, self.rows[0][0]), 空欄="", メモ="備考0"))
+        self.assertEqual(dicts[1], dict(zip(ROW_FIELDS, self.rows[1][0])))
+
+    def test_empty_snapshot(self):
+        write_snapshot(self.path, [], 0)
+        with SnapshotReader(self.path) as snapshot:
+            self.assertEqual((len(snapshot), list(snapshot.iter_rows())), (0, []))
+
+    def test_store_loaded_from_snapshot_matches_dicts(self):
+        # スナップショット＋ジャーナル末尾から読んだストアは、行dictから読んだストアと同じ
+        write_snapshot(self.path, self.rows[5:], 0)
+        dicts = [dict(zip(ROW_FIELDS, fields), **(extra or {})) for fields, extra in self.rows]
+        from_dicts = SeasonStore("test")
+        from_dicts.load(dicts)
+        from_snapshot = SeasonStore("test")
+        with SnapshotReader(self.path) as snapshot:
+            from_snapshot.load(dicts[:5], snapshot)
+        self.assertEqual([r.to_dict() for r in from_snapshot.rows], [r.to_dict() for r in from_dicts.rows])
+        self.assertEqual([r.key for r in from_snapshot.rows], [r.key for r in from_dicts.rows])
+
+class SnapshotReaderTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+        self.path = os.path.join(self.tmp.name, "test.bin")
+        write_snapshot(self.path, make_rows(5), 3)
+
+    def test_close_after_iteration_failed_midway(self):
+        # 書き出し中の例外などで iter_rows が途中のまま残っても、BufferError で元の例外を隠さない
+        def write(rows):
+            # 例外のトレースバックがこのフレーム（＝途中の rows）を掴んだままになる
+            for i, _ in enumerate(rows):
+                if i == 2:
+                    raise RuntimeError("disk full")
+        snapshot = SnapshotReader(self.path)
+        with self.assertRaisesRegex(RuntimeError, "disk full"):
+            try:
+                write(snapshot.iter_rows())
+            finally:
+                snapshot.close()
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,40 @@
+# tests/test_battlelog_store.py
+# シーズンストア：同じ対戦の判定（シートとAPIの表記の違い）
+import os
+import sys
+import unittest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if ROOT not in sys.path:
+    sys.path.insert(0, ROOT)
+
+from battlelog_store import SeasonStore, row_fingerprint  # noqa: E402
+
+def make_row(**kw):
+    row = {
+        "日付": "2024-05-01 09:05:00", "プレイヤー名": "x", "勝敗": "Win",
+        "A1": "ホシノ", "A2": "シロコ", "A3": "", "A4": "", "ASP1": "ヒビキ", "ASP2": "",
+        "空欄": "", "プレイヤー名_2": "y", "勝敗_2": "Lose",
+        "D1": "ミカ", "D2": "", "D3": "", "D4": "", "DSP1": "", "DSP2": "",
+        "source": "一般",
+    }
+    row.update(kw)
+    return row
+
+class FingerprintTest(unittest.TestCase):
+    def test_same_battle_written_differently(self):
+        store = SeasonStore("test")
+        store.load([make_row()])
+        # シート側は桁揃えなしの日付・前後の空白・sourceが違っても同じ対戦
+        self.assertTrue(store.has_row(make_row(日付="2024-5-1 9:05:00", A1=" ホシノ ", source="限定")))
+        self.assertEqual(row_fingerprint(make_row()), store.rows[0].fingerprint())
+
+    def test_different_battles(self):
+        store = SeasonStore("test")
+        store.load([make_row()])
+        self.assertFalse(store.has_row(make_row(日付="2024-05-01 09:05:01")))
+        self.assertFalse(store.has_row(make_row(A1="シロコ", A2="ホシノ")))
+        self.assertFalse(store.has_row(make_row(プレイヤー名_2="z")))
+
+if __name__ == "__main__":
+    unittest.main()
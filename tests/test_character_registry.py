@@ -0,0 +1,96 @@
+# tests/test_character_registry.py
+# キャラ名のあいまい一致（2-gram の候補絞り込み・編集距離の上限・同距離の扱い）と、
+# 検索での表記ゆれの広げ方を確かめる
+import os
+import sys
+import random
+import unittest
+from unittest import mock
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if ROOT not in sys.path:
+    sys.path.insert(0, ROOT)
+
+import character_registry  # noqa: E402
+from character_registry import CharacterRegistry, NameGramIndex, edit_distance, _max_edits  # noqa: E402
+
+class MaxEditsTest(unittest.TestCase):
+    def test_budget_is_one_per_three_chars_capped(self):
+        self.assertEqual(_max_edits("ab"), 0)
+        self.assertEqual(_max_edits("abc"), 1)
+        self.assertEqual(_max_edits("abcde"), 1)
+        self.assertEqual(_max_edits("abcdef"), 2)
+        self.assertEqual(_max_edits("a" * 30), 2)   # FUZZY_NAME_MAX_EDITS
+        self.assertEqual(_max_edits("abcdef", 1), 1)
+
+    def test_short_names_match_exactly_only(self):
+        registry = CharacterRegistry()
+        registry.register_master_names(["ミカ"])
+        self.assertIsNone(registry.nearest_master_name("ミク"))
+        self.assertEqual(registry.nearest_master_name("ミカ"), "ミカ")
+
+class NameGramIndexTest(unittest.TestCase):
+    def test_gram_filter_skips_distance_for_unrelated_names(self):
+        index = NameGramIndex()
+        for key in ("abcdefgh", "abcdefxy", "zzzzzzzz", "hgfedcba"):
+            index.add(key)
+        checked = []
+        def counting(a, b, limit):
+            checked.append(b)
+            return edit_distance(a, b, limit)
+        with mock.patch.object(character_registry, "edit_distance", counting):
+            near = index.near("abcdefgX", 2)
+        self.assertEqual(near, [(1, "abcdefgh"), (2, "abcdefxy")])
+        self.assertNotIn("zzzzzzzz", checked)
+        self.assertNotIn("hgfedcba", checked)
+
+    def test_gram_filter_keeps_every_name_within_budget(self):
+        # 絞り込みで本来の候補を落とさない（全件の距離計算と同じ結果になる）
+        rnd = random.Random(7)
+        alphabet = "アイウエオカキ"
+        keys = {"".join(rnd.choice(alphabet) for _ in range(rnd.randrange(2, 9))) for _ in range(300)}
+        index = NameGramIndex()
+        for key in keys:
+            index.add(key)
+        for _ in range(200):
+            query = "".join(rnd.choice(alphabet) for _ in range(rnd.randrange(2, 9)))
+            for k in (0, 1, 2):
+                expected = sorted((edit_distance(query, key, k), key) for key in keys
+                                  if edit_distance(query, key, k) <= k)
+                self.assertEqual(index.near(query, k), expected, (query, k))
+
+class NearestMasterTest(unittest.TestCase):
+    def test_equal_distance_to_two_masters_is_no_match(self):
+        registry = CharacterRegistry()
+        registry.register_master_names(["アイウエオカ", "アイウエオキ"])
+        self.assertIsNone(registry.nearest_master_name("アイウエオク"))
+        # 片方が近ければそちらに決まる
+        self.assertEqual(registry.nearest_master_name("アイウエオカカ"), "アイウエオカ")
+
+    def test_outside_budget_is_no_match(self):
+        registry = CharacterRegistry()
+        registry.register_master_names(["アイウエオカ"])
+        self.assertIsNone(registry.nearest_master_name("アイクケコカ"))
+
+class LookupIdsTest(unittest.TestCase):
+    def setUp(self):
+        self.registry = CharacterRegistry()
+        self.registry.register_master_names(["ハルナ(正月)"])
+        self.master = self.registry.lookup_id("ハルナ(正月)")
+        self.ocr = self.registry.get_id("ハルナ(正用)")      # OCR誤読（1文字違い）
+        self.new = self.registry.get_id("ハルナ(新春)")      # マスタ未登録の別キャラ（2文字違い）
+
+    def test_exact_by_default(self):
+        self.assertEqual(self.registry.lookup_ids("ハルナ(正月)"), self.master)
+        self.assertEqual(self.registry.lookup_ids("ハルナ(新春)"), self.new)
+        self.assertIsNone(self.registry.lookup_ids("ハルナ(水着)"))
+
+    def test_query_expansion_keeps_distant_names_apart(self):
+        self.assertEqual(self.registry.lookup_ids("ハルナ(正月)", max_edits=1), (self.master, self.ocr))
+        # 2文字違いの別キャラは、マスタの結果に混ざらず自分の結果だけ
+        self.assertEqual(self.registry.lookup_ids("ハルナ(新春)", max_edits=1), self.new)
+        # 上限を取り込みと同じ 2 にすると混ざる（検索では使わない）
+        self.assertEqual(self.registry.lookup_ids("ハルナ(正月)", max_edits=2), (self.master, self.ocr, self.new))
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,194 @@
+# tests/test_defense_suggester.py
+# 防衛サジェストの集計エンジン（"python" 行ループ版 / "numpy" 行列版）が同じ結果を返し、
+# 行列版を入れる前（849b849）の結果とも一致するかを、決まった乱数で作った行で確かめる。
+# 変更前の結果は JSON にした結果の sha256 で持つ（作り方は _golden_digests の説明）
+import os
+import sys
+import json
+import random
+import hashlib
+import tempfile
+import unittest
+from unittest import mock
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if ROOT not in sys.path:
+    sys.path.insert(0, ROOT)
+
+from battlelog_store import SeasonStore  # noqa: E402
+
+# defense_suggester は読み込み時に cache/ を読み書きする（作業ディレクトリ基準）ので、
+# 一時ディレクトリへ移ってから setUpModule で読み込む
+defense_suggester = None
+_workdir = {}
+
+def setUpModule():
+    global defense_suggester
+    _workdir["orig"] = os.getcwd()
+    _workdir["tmp"] = tempfile.TemporaryDirectory(ignore_cleanup_errors=True)
+    os.chdir(_workdir["tmp"].name)
+    import defense_suggester as module
+    defense_suggester = module
+
+def tearDownModule():
+    os.chdir(_workdir["orig"])
+    _workdir["tmp"].cleanup()
+
+SEASON = "test"
+N_ROWS = 3000
+STRIKERS = [f"S{i}" for i in range(30)]   # S26〜S29 はマスタ外（テンプレIDが付かない行になる）
+RARE = ["R0", "R1", "R2"]                 # 出場数が CHAR_MIN_GAMES に届かないキャラ
+SPECIALS = [f"P{i}" for i in range(8)] + ["シロコ（水着）"]
+
+# 849b849 の defense_suggester で同じ手順を回したときの sha256
+GOLDEN = {
+    "suggest": "29c3f8f19e92d3bb06ef9cef6e0fb538eee9114b7948612ee98d42817aa874db",
+    "template": "a19d5e9595909343a607cca40d37510902d8bbe3b06b0ebd5a1c0ac7f85ab71f",
+    "after_ingest": "09d9e670921e6a170749c55e243b936db4a08cc0569f683d6c5f838d475927f9",
+}
+
+def make_master(rnd):
+    return [{"name": n, "image": "", "射程": rnd.choice([350, 550, 750]), "遮蔽": rnd.random() < 0.5}
+            for n in STRIKERS[:26] + RARE]
+
+def make_rows(rnd, n):
+    rows = []
+    for _ in range(n):
+        a = rnd.sample(STRIKERS, 4)
+        d = rnd.sample(STRIKERS[:28], 4)
+        if rnd.random() < 0.1:
+            a[rnd.randrange(4)] = ""
+        if rnd.random() < 0.01:
+            d[rnd.randrange(4)] = rnd.choice(RARE)
+        asp = [rnd.choice(SPECIALS), rnd.choice(SPECIALS + [""])]
+        dsp = [rnd.choice(SPECIALS), rnd.choice(SPECIALS + [""])]
+        win = rnd.random() < 0.5
+        rows.append({
+            "日付": f"2024-05-{1 + rnd.randrange(28):02d} {rnd.randrange(24):02d}:{rnd.randrange(60):02d}:{rnd.randrange(60):02d}",
+            "プレイヤー名": "x", "勝敗": "Win" if win else "Lose",
+            "A1": a[0], "A2": a[1], "A3": a[2], "A4": a[3], "ASP1": asp[0], "ASP2": asp[1],
+            "空欄": "", "プレイヤー名_2": "y", "勝敗_2": "Lose" if win else "Win",
+            "D1": d[0], "D2": d[1], "D3": d[2], "D4": d[3], "DSP1": dsp[0], "DSP2": dsp[1],
+            "source": "限定" if rnd.random() < 0.3 else "一般",
+        })
+    rows.sort(key=lambda r: r["日付"], reverse=True)
+    return rows
+
+def make_attack_sets(rnd, rows):
+    recent = [[r[k] for k in ("A1", "A2", "A3", "A4", "ASP1", "ASP2")] for r in rows[:300]]
+    def random_attack():
+        return [rnd.choice(STRIKERS + [""] * 6) for _ in range(4)] + [rnd.choice(SPECIALS + [""] * 6) for _ in range(2)]
+    sets = [[["", "", "", "", "", ""]], [["S99", "", "", "", "", ""]], []]
+    for _ in range(30):
+        sets.append([
+            rnd.choice([random_attack(), rnd.choice(recent), rnd.choice(recent)[:2] + ["", ""] + rnd.choice(recent)[4:]])
+            for _ in range(rnd.randrange(1, 6))
+        ])
+    return sets
+
+def digest(results):
+    text = json.dumps(results, ensure_ascii=False, sort_keys=True)
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+def build_fixture():
+    """決まった乱数で (ストア, STRIKERマスタ, 攻めの組, 後から足す行)"""
+    rnd = random.Random(20240501)
+    master = make_master(rnd)
+    rows = make_rows(rnd, N_ROWS)
+    attack_sets = make_attack_sets(rnd, rows)
+    store = SeasonStore(SEASON)
+    store.load(rows)
+    # 取り込み後：既存のどの行より新しい行（前置きで足す）と古い行（並べ直し）
+    later = [dict(rows[i], 日付=f"2024-06-01 00:00:{i:02d}", D1="S3") for i in range(5)]
+    later.append(dict(rows[7], 日付="2024-04-01 00:00:00", D2="R1"))
+    return store, master, attack_sets, later
+
+def patched(module, store, master):
+    return mock.patch.multiple(
+        module,
+        get_season_store=lambda season=None: store,
+        get_striker_list_from_sheet=lambda: master,
+    )
+
+def run_suggest(suggest, attack_sets):
+    return [suggest(attacks, SEASON, strict_pos) for attacks in attack_sets for strict_pos in (False, True)]
+
+def run_template(suggest_team, attack_sets, suggestions):
+    """各提案の決定過程の上位テンプレ（とテンプレ外 ()）での単一テンプレ案"""
+    out = []
+    cases = [(attacks, strict_pos) for attacks in attack_sets for strict_pos in (False, True)]
+    for (attacks, strict_pos), result in zip(cases, suggestions):
+        for tpl in [s["タグセット"] for s in result["テンプレ決定過程"][:3]] + [()]:
+            out.append(suggest_team(tpl, attacks, SEASON, strict_pos))
+    return out
+
+def _golden_digests(module, suggest):
+    """
+    GOLDEN の作り方：849b849 の defense_suggester.py を別名で読み込み、
+    _golden_digests(その module, lambda a, s, p: module.suggest_defense_teams(a, season=s, strict_pos=p)) を表示する
+    """
+    store, master, attack_sets, later = build_fixture()
+    with patched(module, store, master):
+        suggestions = run_suggest(suggest, attack_sets)
+        out = {"suggest": digest(suggestions)}
+        out["template"] = digest(run_template(module.suggest_team_for_template, attack_sets, suggestions))
+        for row in later:
+            store.add_row(row)
+        out["after_ingest"] = digest(run_suggest(suggest, attack_sets[:10]))
+    return out
+
+class SuggestEngineTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.store, cls.master, cls.attack_sets, cls.later = build_fixture()
+        cls.patcher = patched(defense_suggester, cls.store, cls.master)
+        cls.patcher.start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.patcher.stop()
+
+    def suggest(self, engine):
+        return lambda attacks, season, strict_pos: defense_suggester.suggest_defense_teams(
+            attacks, season=season, strict_pos=strict_pos, engine=engine)
+
+    def assert_engines_match(self, attack_sets):
+        by_engine = {engine: run_suggest(self.suggest(engine), attack_sets) for engine in ("python", "numpy")}
+        cases = [(attacks, strict_pos) for attacks in attack_sets for strict_pos in (False, True)]
+        for case, py, np_ in zip(cases, by_engine["python"], by_engine["numpy"]):
+            self.assertEqual(py, np_, case)
+        return by_engine["numpy"]
+
+    def test_engines_and_pre_change_output(self):
+        suggestions = self.assert_engines_match(self.attack_sets)
+        self.assertEqual(digest(suggestions), GOLDEN["suggest"])
+
+        templates = run_template(defense_suggester.suggest_team_for_template, self.attack_sets, suggestions)
+        self.assertEqual(digest(templates), GOLDEN["template"])
+
+        # セッション経由のテンプレ詳細も、どちらのエンジンでも単一テンプレ案と同じ
+        for engine in ("python", "numpy"):
+            with mock.patch.dict(defense_suggester.SUGGEST_CONFIG, {"ENGINE": engine}):
+                for attacks in self.attack_sets[:10]:
+                    result, handle = defense_suggester.open_suggest_session(attacks, season=SEASON)
+                    for s in result["テンプレ決定過程"][:3]:
+                        detail = defense_suggester.template_detail_from_session(
+                            handle, s["タグセット"], attacks, SEASON, False)
+                        self.assertEqual(
+                            detail,
+                            defense_suggester.suggest_team_for_template(s["タグセット"], attacks, SEASON, False),
+                            (engine, attacks))
+
+        # 取り込み後（行列は差分で足す・古い行が混ざれば並べ直す）も一致し、セッションは使えなくなる
+        attacks = next(a for a, r in zip(self.attack_sets, suggestions[::2]) if r["テンプレ決定過程"])
+        result, handle = defense_suggester.open_suggest_session(attacks, season=SEASON)
+        tags = result["テンプレ決定過程"][0]["タグセット"]
+        self.assertIsNotNone(defense_suggester.template_detail_from_session(handle, tags, attacks, SEASON, False))
+        for row in self.later:
+            self.store.add_row(row)
+        suggestions = self.assert_engines_match(self.attack_sets[:10])
+        self.assertEqual(digest(suggestions), GOLDEN["after_ingest"])
+        self.assertIsNone(defense_suggester.template_detail_from_session(handle, tags, attacks, SEASON, False))
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,151 @@
+# tests/test_search.py
+# 編成検索のページ送り：複数シーズンをまたいでカーソル（positions）で最後まで送ると、
+# 条件に合う行が新しい順に1回ずつだけ返るかを、全行を素直に調べた結果と比べて確かめる
+import os
+import sys
+import random
+import tempfile
+import unittest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if ROOT not in sys.path:
+    sys.path.insert(0, ROOT)
+
+from battlelog_store import SeasonStore  # noqa: E402
+
+# spreadsheet_manager は読み込み時に cache/ を読み書きする（作業ディレクトリ基準）ので、
+# 一時ディレクトリへ移ってから setUpModule で読み込む
+spreadsheet_manager = None
+_workdir = {}
+
+def setUpModule():
+    global spreadsheet_manager
+    _workdir["orig"] = os.getcwd()
+    _workdir["tmp"] = tempfile.TemporaryDirectory(ignore_cleanup_errors=True)
+    os.chdir(_workdir["tmp"].name)
+    import spreadsheet_manager as module
+    spreadsheet_manager = module
+
+def tearDownModule():
+    os.chdir(_workdir["orig"])
+    _workdir["tmp"].cleanup()
+
+# 2文字の名前はあいまい一致の対象外（他のテストがマスタを登録していても表記ゆれ扱いにならない）
+STRIKERS = [f"X{i}" for i in range(8)]
+SPECIALS = ["Y0", "Y1", "Y2"]
+
+def make_rows(rnd, n):
+    rows = []
+    for _ in range(n):
+        a, d = rnd.sample(STRIKERS, 4), rnd.sample(STRIKERS, 4)
+        win = rnd.random() < 0.5
+        rows.append({
+            # 同じ日時の行がシーズン内にもシーズン間にもできるよう、日時の幅は狭くする
+            "日付": f"2024-05-01 00:00:{rnd.randrange(40):02d}",
+            "プレイヤー名": "x", "勝敗": "Win" if win else "Lose",
+            "A1": a[0], "A2": a[1], "A3": a[2], "A4": a[3],
+            "ASP1": rnd.choice(SPECIALS), "ASP2": rnd.choice(SPECIALS + [""]),
+            "空欄": "", "プレイヤー名_2": "y", "勝敗_2": "Lose" if win else "Win",
+            "D1": d[0], "D2": d[1], "D3": d[2], "D4": d[3],
+            "DSP1": rnd.choice(SPECIALS), "DSP2": rnd.choice(SPECIALS + [""]),
+            "source": "限定" if rnd.random() < 0.3 else "一般",
+        })
+    return rows
+
+def matches(row, query, side, strict_pos):
+    """SeasonStore.search と同じ条件を1行ずつ素直に調べる"""
+    team = row.team(side)
+    strikers, sps = query[:4], [c for c in query[4:] if c]
+    if strict_pos:
+        if any(q and q != team[slot] for slot, q in enumerate(strikers)):
+            return False
+    elif not {q for q in strikers if q} <= set(team[:4]):
+        return False
+    if len(sps) == 2 and sps[0] != sps[1]:
+        return sorted(sps) == sorted(team[4:])
+    return all(c in team[4:] for c in sps)
+
+def page_through(query, side, seasons, stores, page_size, **kw):
+    """最後のページまで送って [(season, BattleRow), ...]（ページごとの件数も確かめる）"""
+    out, positions = [], None
+    while True:
+        page, positions = spreadsheet_manager.search_battlelog_page(
+            query, side, seasons, positions=positions, page_size=page_size, stores=stores, **kw)
+        assert len(page) <= page_size
+        out.extend(page)
+        if positions is None:
+            return out
+        assert len(page) == page_size
+
+class CursorPagingTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        rnd = random.Random(3)
+        cls.seasons = ["p1", "p2", "p3"]
+        cls.stores = {}
+        for season, n in zip(cls.seasons, (300, 120, 0)):
+            store = SeasonStore(season)
+            store.load(make_rows(rnd, n))
+            cls.stores[season] = store
+        cls.queries = [
+            ["X1", "", "", "", "", ""],
+            ["", "X2", "X3", "", "", ""],
+            ["X0", "", "", "", "Y1", ""],
+            ["", "", "", "", "Y0", "Y2"],
+            ["", "", "", "", "Y1", "Y1"],
+            ["X4", "X5", "", "", "", ""],
+        ]
+
+    def expected(self, query, side, strict_pos=True, flag=lambda row: True):
+        rows = [(s, r) for s in self.seasons for r in self.stores[s].rows
+                if matches(r, query, side, strict_pos) and flag(r)]
+        return sorted(rows, key=lambda pair: (pair[0], pair[1].rid))
+
+    def assert_each_once_newest_first(self, got, expected):
+        ids = [(s, r.rid) for s, r in got]
+        self.assertEqual(len(ids), len(set(ids)))
+        self.assertEqual(sorted(ids), [(s, r.rid) for s, r in expected])
+        self.assertEqual([r.ts for _, r in got], sorted((r.ts for _, r in got), reverse=True))
+
+    def test_every_row_exactly_once_across_seasons(self):
+        for query in self.queries:
+            for side in ("attack", "defense"):
+                for strict_pos in (True, False):
+                    expected = self.expected(query, side, strict_pos)
+                    self.assertTrue(expected, query)
+                    for page_size in (1, 7, 50, 1000):
+                        got = page_through(query, side, self.seasons, self.stores, page_size,
+                                           strict_pos=strict_pos)
+                        with self.subTest(query=query, side=side, strict_pos=strict_pos, page_size=page_size):
+                            self.assert_each_once_newest_first(got, expected)
+
+    def test_paging_with_filters(self):
+        query = ["X1", "", "", "", "", ""]
+        # 限定のみ・検索した編成の相手側が勝った行（勝ち筋）のみ
+        expected = self.expected(query, "attack", flag=lambda r: r.source == "限定" and r.def_result == "Win")
+        got = page_through(query, "attack", self.seasons, self.stores, 5, only_limited=True, counters_only=True)
+        self.assert_each_once_newest_first(got, expected)
+
+    def test_rows_added_between_pages_do_not_repeat(self):
+        query = ["X2", "", "", "", "", ""]
+        store = SeasonStore("p4")
+        store.load(make_rows(random.Random(4), 200))
+        stores = {"p4": store, "p1": self.stores["p1"]}
+        before = {(s, r.rid) for s, r in self.expected(query, "attack") if s == "p1"} | {
+            ("p4", r.rid) for r in store.rows if matches(r, query, "attack", True)}
+
+        page, positions = spreadsheet_manager.search_battlelog_page(
+            query, "attack", ["p4", "p1"], page_size=10, stores=stores)
+        got = list(page)
+        # 1ページ目の後に、どの行よりも新しい行が取り込まれても続きのページには出てこない
+        store.add_row(dict(store.rows[0].to_dict(), 日付="2024-06-01 00:00:00", A1="X2"))
+        while positions is not None:
+            page, positions = spreadsheet_manager.search_battlelog_page(
+                query, "attack", ["p4", "p1"], positions=positions, page_size=10, stores=stores)
+            got.extend(page)
+        ids = [(s, r.rid) for s, r in got]
+        self.assertEqual(len(ids), len(set(ids)))
+        self.assertEqual(set(ids), before)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,185 @@
+# upload_queue.py
+# アップロード確定行の書き込み遅延キュー（write-behind）
+# 確定時はローカルのスプールに追記するだけで返し、「変換前」シートへの挿入は
+# 数秒おき（または一定件数ごと）にシーズンごと1回にまとめて行う。その後しらす式変換を1回呼び、差分同期で検索に反映
+# スプールは全ワーカー共有で、書き込みは代表ワーカーだけが行う
+import os
+import json
+import time
+import uuid
+import threading
+
+from config import CACHE_DIR, CURRENT_SEASON
+from google_clients import call_apps_script
+from shared_state import file_lock, is_leader
+from spreadsheet_manager import update_spreadsheet_rows, refresh_output_sheet_cache
+
+_FLUSH_INTERVAL = 5.0   # 最長この秒数ごとにまとめて書き込む
+_FLUSH_EVERY = 20       # この件数たまったら待たずに書き込む
+_RETRY_INTERVAL = 30.0  # シート書き込みに失敗したときの再試行間隔（秒）
+
+_wakeup = threading.Event()
+_flush_lock = threading.Lock()
+
+def get_spool_filepath():
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    return os.path.join(CACHE_DIR, "upload_spool.jsonl")
+
+def get_unconfirmed_filepath():
+    # 挿入中に落ちて、シートに入ったかどうか分からない行（手で確認する用）
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    return os.path.join(CACHE_DIR, "upload_spool_unconfirmed.jsonl")
+
+# ===== スプール（落ちても未書き込みの行を失わないため） =====
+
+def _load_spool():
+    path = get_spool_filepath()
+    if not os.path.exists(path):
+        return []
+    entries = []
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                entries.append(json.loads(line))
+            except Exception:
+                print(f"スプールの壊れた行をスキップ: {path}")
+    return entries
+
+def _rewrite_spool(entries):
+    # 呼び出し側でスプールのロックを保持していること
+    path = get_spool_filepath()
+    tmp = path + ".tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        for entry in entries:
+            f.write(json.dumps(entry, ensure_ascii=False) + "\n")
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+
+def enqueue_upload(data, season=None):
+    """確定行をスプールに追記する（シートへの書き込みは後でまとめて）"""
+    season_key = season or CURRENT_SEASON
+    # ワーカーをまたいでも重複しないID
+    entry = {"id": uuid.uuid4().hex, "season": season_key, "row": list(data)}
+    with file_lock("upload_spool"):
+        with open(get_spool_filepath(), "a", encoding="utf-8") as f:
+            f.write(json.dumps(entry, ensure_ascii=False) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+        pending = len(_load_spool())
+    # 件数での前倒しは自分が代表ワーカーのときだけ（他のワーカーの分は次の定期書き込みで拾う）
+    if pending >= _FLUSH_EVERY and is_leader():
+        _wakeup.set()
+    print(f"アップロード行をキューに追加[{season_key}]（未書き込み{pending}件）:", data)
+    return entry["id"]
+
+# ===== まとめて書き込み =====
+# スプールの行の状態（"state"）：なし＝未挿入 / "inflight"＝挿入中 / "inserted"＝挿入済み・変換待ち。
+# 挿入の前に inflight にしておき、挿入中に落ちた行は二重に挿入しないよう退避する。
+# 変換に失敗した行は inserted のまま残し、次の書き込みで変換だけやり直す
+
+def flush_uploads():
+    """
+    キューの行をシーズンごとに1回の挿入で「変換前」シートへ書き込み、
+    しらす式変換を1回呼んでから差分同期する。変換まで済んだ件数を返す
+    """
+    with _flush_lock:
+        return _flush_uploads()
+
+def _set_state(entry_ids, state):
+    # スプールを読み直して entry_ids の行の状態を変える（state=None で未挿入に戻す）
+    with file_lock("upload_spool"):
+        entries = _load_spool()
+        for e in entries:
+            if e["id"] not in entry_ids:
+                continue
+            if state is None:
+                e.pop("state", None)
+            else:
+                e["state"] = state
+        _rewrite_spool(entries)
+
+def _set_aside_unconfirmed():
+    """
+    前回の挿入中に落ちた行（挿入済みかもしれない）は二重に挿入しないよう
+    スプールから外して別ファイルに残す。残りのスプールの行を返す
+    """
+    with file_lock("upload_spool"):
+        entries = _load_spool()
+        stale = [e for e in entries if e.get("state") == "inflight"]
+        if not stale:
+            return entries
+        with open(get_unconfirmed_filepath(), "a", encoding="utf-8") as f:
+            for e in stale:
+                f.write(json.dumps(e, ensure_ascii=False) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+        entries = [e for e in entries if e.get("state") != "inflight"]
+        _rewrite_spool(entries)
+    for e in stale:
+        print(f"挿入済みか不明な行を退避しました[{e['season']}]（{get_unconfirmed_filepath()}）:", e["row"])
+    return entries
+
+def _flush_uploads():
+    # シート書き込み中も追記を受け付けられるよう、ロックはスプールを読み書きする時だけ取る
+    batch = _set_aside_unconfirmed()
+    if not batch:
+        return 0
+
+    # 前回挿入までは済んで変換に失敗した行は、挿入し直さず変換だけ待つ
+    inserted = [e for e in batch if e.get("state") == "inserted"]
+    by_season = {}
+    for entry in batch:
+        if entry.get("state") != "inserted":
+            by_season.setdefault(entry["season"], []).append(entry)
+
+    if by_season:
+        _set_state({e["id"] for entries in by_season.values() for e in entries}, "inflight")
+    for season_key, entries in by_season.items():
+        ids = {e["id"] for e in entries}
+        try:
+            update_spreadsheet_rows([e["row"] for e in entries], season=season_key)
+        except Exception as e:
+            # このシーズン分は未挿入に戻して次回再試行
+            print(f"変換前シートへの一括書き込み失敗[{season_key}]: {e}")
+            _set_state(ids, None)
+            continue
+        _set_state(ids, "inserted")
+        inserted.extend(entries)
+    if not inserted:
+        raise Exception("変換前シートへの書き込みに全て失敗しました")
+
+    # しらす式変換は変換前シートの未変換の行をまとめて変換する前提で、挿入の後に1回だけ呼ぶ
+    try:
+        call_apps_script()
+    except Exception as e:
+        raise Exception(f"しらす式変換エラー（挿入済み{len(inserted)}件は次回変換し直します）: {e}")
+
+    done_ids = {e["id"] for e in inserted}
+    with file_lock("upload_spool"):
+        _rewrite_spool([e for e in _load_spool() if e["id"] not in done_ids])
+
+    for season_key in {e["season"] for e in inserted}:
+        try:
+            refresh_output_sheet_cache(season_key)
+        except Exception as e:
+            print(f"アップロード後の差分同期失敗[{season_key}]: {e}")
+    return len(inserted)
+
+def _flush_scheduler():
+    while True:
+        _wakeup.wait(_FLUSH_INTERVAL)
+        _wakeup.clear()
+        # 前回落ちたワーカーが書き込めなかった行もスプールに残っているので、代表がまとめて拾う
+        if not is_leader() or not os.path.exists(get_spool_filepath()):
+            continue
+        try:
+            flush_uploads()
+        except Exception as e:
+            print(f"アップロードキューの書き込み失敗: {e}")
+            time.sleep(_RETRY_INTERVAL)
+
+threading.Thread(target=_flush_scheduler, daemon=True).start()